@@ -0,0 +1,71 @@
+"""
+Per-step CPU latency of the eager (matmul + softmax + repeat_kv) and SDPA attention paths.
+
+Every row decodes one token at its own position after a prefill of --context tokens, which is the
+step the continuous batching scheduler runs over and over.
+
+    python benchmarks/attention.py --contexts 128,512,1024 --batch_size 8
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+def decode_latency(model, batch_size: int, context: int, steps: int) -> float:
+    tokens = torch.randint(3, model.vocab_size, (batch_size, context))
+    model.forward(tokens, 0)
+    next_tokens = tokens[:, -1:]
+    start_pos = torch.full((batch_size,), context)
+    start = time.perf_counter()
+    for step in range(steps):
+        model.forward(next_tokens, start_pos + step)
+    return (time.perf_counter() - start) / steps
+
+
+def main(
+    contexts=(128, 512, 1024),
+    batch_size: int = 8,
+    steps: int = 20,
+    dim: int = 512,
+    n_layers: int = 4,
+    n_heads: int = 8,
+    n_kv_heads: int = 2,
+):
+    contexts = [int(c) for c in (contexts.split(",") if isinstance(contexts, str) else contexts)]
+    max_seq_len = max(contexts) + steps
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        models = {
+            impl: build_tiny_llama(
+                tokenizer_path,
+                max_seq_len=max_seq_len,
+                max_batch_size=batch_size,
+                dim=dim,
+                n_layers=n_layers,
+                n_heads=n_heads,
+                n_kv_heads=n_kv_heads,
+                attention_impl=impl,
+            ).model
+            for impl in ("eager", "sdpa")
+        }
+
+    print(f"{'context':>8} {'eager ms':>9} {'sdpa ms':>9} {'speedup':>8}")
+    for context in contexts:
+        latency = {
+            impl: decode_latency(model, batch_size, context, steps)
+            for impl, model in models.items()
+        }
+        print(
+            f"{context:>8} {latency['eager'] * 1e3:>9.2f} {latency['sdpa'] * 1e3:>9.2f} "
+            f"{latency['eager'] / latency['sdpa']:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
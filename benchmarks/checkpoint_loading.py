@@ -0,0 +1,89 @@
+"""
+Checkpoint load time and peak host memory: torch.load + load_state_dict vs. the mmap loader.
+
+Each mode runs in a fresh process so its peak RSS is not hidden by an earlier run. The page cache
+is not dropped between runs (that needs root), so both modes read the checkpoint from memory; run
+with a cold cache to see the disk bound case.
+
+    python benchmarks/checkpoint_loading.py --dim 2048 --n_layers 8 --dtypes bfloat16,float32
+"""
+
+import multiprocessing
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.checkpoint import load_checkpoint
+from chimera_llama_grpc.llama.model import ModelArgs, Transformer
+from chimera_llama_grpc.llama.tiny import TINY_MODEL_PARAMS, init_model_parallel
+
+
+def model_args(dim: int, n_layers: int) -> ModelArgs:
+    params = {
+        **TINY_MODEL_PARAMS,
+        "dim": dim,
+        "n_layers": n_layers,
+        "n_heads": 16,
+        "n_kv_heads": 16,
+    }
+    return ModelArgs(max_seq_len=128, max_batch_size=1, vocab_size=32000, **params)
+
+
+def load(args: ModelArgs, ckpt_path: Path, mode: str, dtype: torch.dtype, results) -> None:
+    init_model_parallel()
+    torch.set_default_dtype(dtype)
+    start = time.perf_counter()
+    model = Transformer(args)
+    if mode == "mmap":
+        load_checkpoint(model, ckpt_path)
+    else:
+        model.load_state_dict(torch.load(ckpt_path, map_location="cpu"), strict=False)
+    # touch every weight like the first forward pass would
+    with torch.no_grad():
+        checksum = sum(float(p.float().sum()) for p in model.parameters())
+    seconds = time.perf_counter() - start
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, checksum))
+
+
+def save(args: ModelArgs, ckpt_path: Path) -> None:
+    init_model_parallel()
+    torch.set_default_dtype(torch.bfloat16)
+    model = Transformer(args)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.normal_(std=0.02)
+    torch.save(model.state_dict(), ckpt_path)
+
+
+def main(dim: int = 2048, n_layers: int = 8, dtypes=("bfloat16", "float32")):
+    if isinstance(dtypes, str):
+        dtypes = dtypes.split(",")
+    ctx = multiprocessing.get_context("spawn")
+    args = model_args(dim, n_layers)
+    with tempfile.TemporaryDirectory() as tmp:
+        ckpt_path = Path(tmp) / "consolidated.00.pth"
+        process = ctx.Process(target=save, args=(args, ckpt_path))
+        process.start()
+        process.join()
+        size_mb = ckpt_path.stat().st_size / 2**20
+        print(f"checkpoint: {size_mb:.0f} MB bfloat16")
+
+        print(f"{'mode':>12} {'dtype':>9} {'seconds':>8} {'peak RSS MB':>12}")
+        for load_dtype in dtypes:
+            for mode in ("torch.load", "mmap"):
+                results = ctx.Queue()
+                process = ctx.Process(
+                    target=load, args=(args, ckpt_path, mode, getattr(torch, load_dtype), results)
+                )
+                process.start()
+                seconds, peak_mb, _ = results.get()
+                process.join()
+                print(f"{mode:>12} {load_dtype:>9} {seconds:>8.2f} {peak_mb:>12.0f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,100 @@
+"""
+Inter-token latency of short requests decoding on the continuous batching Scheduler while long
+prompts arrive, with the whole prompt prefilled in one step (chunk 0) and with chunked prefill.
+
+Short requests decode for the whole run, a long prompt is submitted every --interval steps. Reports
+the inter-token latency of the short requests, the time to first token of the long ones and the wall
+time of the run.
+
+    python benchmarks/chunked_prefill.py --long_len 2048 --chunk_sizes 0,128,512
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.benchmark import summarize
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+def run(llama, chunk_size: int, short_prompts, long_prompts, gen_len: int, interval: int):
+    scheduler = Scheduler(llama, prefill_chunk_size=chunk_size)
+    timestamps = [[] for _ in short_prompts]
+    shorts = [
+        scheduler.submit(
+            t,
+            temperature=0,
+            max_gen_len=gen_len,
+            on_token=lambda _, i=i: timestamps[i].append(time.perf_counter()),
+        )
+        for i, t in enumerate(short_prompts)
+    ]
+    longs = []
+    start = time.perf_counter()
+    step = 0
+    while scheduler.has_unfinished() or len(longs) < len(long_prompts):
+        if step % interval == interval // 2 and len(longs) < len(long_prompts):
+            longs.append(scheduler.submit(long_prompts[len(longs)], temperature=0, max_gen_len=8))
+        scheduler.step()
+        step += 1
+    elapsed = time.perf_counter() - start
+    assert all(len(s.future.result()) == gen_len for s in shorts)
+
+    gaps = [(b - a) * 1e3 for ts in timestamps for a, b in zip(ts, ts[1:])]
+    ttft = [(s.first_token_at - s.submitted_at) * 1e3 for s in longs]
+    return summarize(gaps), summarize(ttft), elapsed
+
+
+def main(
+    chunk_sizes=(0, 128, 512),
+    long_len: int = 2048,
+    long_requests: int = 4,
+    short_requests: int = 4,
+    gen_len: int = 128,
+    interval: int = 24,
+    dim: int = 512,
+    n_layers: int = 4,
+):
+    if isinstance(chunk_sizes, (int, str)):
+        chunk_sizes = [int(n) for n in str(chunk_sizes).split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=long_len + 64,
+            max_batch_size=short_requests + long_requests,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so the short requests decode through every long prefill
+    llama.tokenizer.eos_id = -1
+    rng = random.Random(0)
+    n_words = llama.tokenizer.n_words
+    short_prompts = [[1] + [rng.randrange(3, n_words) for _ in range(15)]] * short_requests
+    long_prompts = [
+        [1] + [rng.randrange(3, n_words) for _ in range(long_len - 1)] for _ in range(long_requests)
+    ]
+    run(llama, 0, short_prompts[:1], long_prompts[:1], 4, 2)  # warmup
+
+    print(
+        f"{short_requests} short requests x {gen_len} tokens, "
+        f"{long_requests} prompts of {long_len} tokens every {interval} steps"
+    )
+    print(
+        f"{'chunk':>6} {'itl p50 ms':>11} {'itl p99 ms':>11} {'itl max ms':>11} "
+        f"{'long ttft ms':>13} {'seconds':>8}"
+    )
+    for chunk_size in chunk_sizes:
+        gaps, ttft, elapsed = run(llama, chunk_size, short_prompts, long_prompts, gen_len, interval)
+        print(
+            f"{chunk_size:>6} {gaps['p50']:>11.1f} {gaps['p99']:>11.1f} {gaps['max']:>11.1f} "
+            f"{ttft['mean']:>13.1f} {elapsed:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
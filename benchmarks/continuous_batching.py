@@ -0,0 +1,70 @@
+"""
+Generated tokens/s of the continuous batching scheduler vs. number of concurrent requests.
+
+Concurrency 1 is what the server did before: every request ran alone on the model.
+
+    python benchmarks/continuous_batching.py --requests 16 --max_gen_len 32
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def run(scheduler: Scheduler, prompt_tokens, requests: int, concurrency: int, max_gen_len: int):
+    pending = list(range(requests))
+    running = []
+    generated = 0
+    start = time.perf_counter()
+    while pending or running:
+        while pending and len(running) < concurrency:
+            pending.pop()
+            running.append(scheduler.submit(prompt_tokens, temperature=0, max_gen_len=max_gen_len))
+        scheduler.step()
+        for sequence in [s for s in running if s.finished]:
+            generated += len(sequence.output_tokens)
+            running.remove(sequence)
+    return generated / (time.perf_counter() - start)
+
+
+def main(
+    requests: int = 16,
+    max_gen_len: int = 32,
+    dim: int = 256,
+    n_layers: int = 4,
+    max_batch_size: int = 16,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=256,
+            max_batch_size=max_batch_size,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so every request generates exactly max_gen_len tokens
+    llama.tokenizer.eos_id = -1
+    scheduler = Scheduler(llama)
+    prompt_tokens = llama.tokenizer.encode(PROMPT, bos=True, eos=False)
+    run(scheduler, prompt_tokens, 2, 2, 4)  # warmup
+
+    print(f"{'concurrency':>12} {'tokens/s':>10} {'speedup':>8}")
+    baseline = None
+    concurrency = 1
+    while concurrency <= max_batch_size:
+        tps = run(scheduler, prompt_tokens, requests, concurrency, max_gen_len)
+        baseline = baseline or tps
+        print(f"{concurrency:>12} {tps:>10.1f} {tps / baseline:>7.2f}x")
+        concurrency *= 2
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,70 @@
+"""
+Streaming detokenization throughput: decoding the whole generation again for every token (what
+StreamDecoder used to do) against IncrementalDetokenizer, for one row and for a batch of rows pushed
+one step at a time.
+
+    python benchmarks/detokenizer.py --lengths 256,1024,4096 --batch_size 32
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.tiny import build_tiny_tokenizer
+from chimera_llama_grpc.llama.tokenizer import IncrementalDetokenizer, Tokenizer
+
+
+def redecode(tokenizer: Tokenizer, tokens):
+    text, emitted = "", []
+    for i in range(1, len(tokens) + 1):
+        decoded = tokenizer.decode(tokens[:i])
+        if decoded.endswith("�"):
+            continue
+        emitted.append(decoded[len(text) :])
+        text = decoded
+    return "".join(emitted) + tokenizer.decode(tokens)[len(text) :]
+
+
+def incremental(tokenizer: Tokenizer, tokens):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    return "".join(detokenizer.push_row(0, t) for t in tokens) + detokenizer.flush_row(0)
+
+
+def main(lengths=(256, 1024, 4096), batch_size: int = 32):
+    if isinstance(lengths, str):
+        lengths = [int(n) for n in lengths.split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer = Tokenizer(str(build_tiny_tokenizer(Path(tmp) / "tokenizer.model")))
+    rng = random.Random(0)
+    tokenizer.piece_table()
+
+    print(f"{'tokens':>6} {'redecode tok/s':>15} {'incremental tok/s':>18} {'speedup':>8}")
+    for n in lengths:
+        tokens = [rng.randrange(3, tokenizer.n_words) for _ in range(n)]
+        start = time.perf_counter()
+        expected = redecode(tokenizer, tokens)
+        before = n / (time.perf_counter() - start)
+        start = time.perf_counter()
+        assert incremental(tokenizer, tokens) == expected == tokenizer.decode(tokens)
+        after = n / (time.perf_counter() - start)
+        print(f"{n:>6} {before:>15.0f} {after:>18.0f} {after / before:>7.0f}x")
+
+    n = max(lengths)
+    rows = [[rng.randrange(3, tokenizer.n_words) for _ in range(n)] for _ in range(batch_size)]
+    detokenizer = IncrementalDetokenizer(tokenizer, batch_size)
+    start = time.perf_counter()
+    for step in range(n):
+        detokenizer.push([row[step] for row in rows])
+    detokenizer.flush()
+    elapsed = time.perf_counter() - start
+    print(
+        f"\nbatch of {batch_size} rows x {n} steps: {batch_size * n / elapsed:.0f} tokens/s, "
+        f"{elapsed / n * 1e6:.1f} us per step"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,70 @@
+"""
+Decode step latency of Llama.generate as rows of a skewed-length batch finish.
+
+Row i generates (i + 1) * max_gen_len / batch_size tokens, finished rows are compacted out of the
+batch so later steps run on fewer rows. Without compaction every step costs as much as the first
+decode step, which is what the "full batch" estimate assumes.
+
+    python benchmarks/early_retirement.py --batch_size 8 --max_gen_len 128
+"""
+
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def main(batch_size: int = 8, max_gen_len: int = 128, dim: int = 512, n_layers: int = 4):
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=max_gen_len + 32,
+            max_batch_size=batch_size,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so every row generates exactly its max_gen_len tokens
+    llama.tokenizer.eos_id = -1
+
+    steps = []
+    forward = llama.model.forward
+
+    def timed_forward(tokens, start_pos, slots=None):
+        start = time.perf_counter()
+        logits = forward(tokens, start_pos, slots=slots)
+        steps.append((tokens.shape[0], tokens.shape[1], time.perf_counter() - start))
+        return logits
+
+    llama.model.forward = timed_forward
+    prompt_tokens = [llama.tokenizer.encode(PROMPT, bos=True, eos=False)] * batch_size
+    max_gen_lens = [(i + 1) * max_gen_len // batch_size for i in range(batch_size)]
+    llama.generate(prompt_tokens, 4, temperature=0)  # warmup
+    steps.clear()
+
+    start = time.perf_counter()
+    llama.generate(prompt_tokens, max_gen_lens, temperature=0)
+    total = time.perf_counter() - start
+
+    latency = defaultdict(list)
+    for rows, seqlen, seconds in steps:
+        if seqlen == 1:
+            latency[rows].append(seconds)
+    print(f"{'active rows':>12} {'steps':>6} {'step ms':>8}")
+    for rows in sorted(latency, reverse=True):
+        step_ms = sum(latency[rows]) / len(latency[rows]) * 1e3
+        print(f"{rows:>12} {len(latency[rows]):>6} {step_ms:>8.2f}")
+
+    full_step = sum(latency[batch_size]) / len(latency[batch_size])
+    decode_steps = sum(len(v) for v in latency.values())
+    print(f"generate: {total:.2f}s, full batch for every step: ~{full_step * decode_steps:.2f}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
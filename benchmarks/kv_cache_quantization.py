@@ -0,0 +1,86 @@
+"""
+KV cache quantization on CPU: cache memory, decode latency and output divergence of int8 and fp8
+caches against the cache in the model dtype.
+
+The reference model teacher-forces a sampled continuation; every cache dtype scores the same tokens
+so the KL divergence and top-1 agreement measure only what the cache loses. "sequences" is how many
+max_seq_len sequences fit in the memory the reference cache takes for --max_batch_size of them.
+
+    python benchmarks/kv_cache_quantization.py --dtype bfloat16 --max_seq_len 1024
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def cache_nbytes(llama) -> int:
+    return sum(
+        buffer.nbytes for layer in llama.model.layers for buffer in layer.attention.cache.buffers()
+    )
+
+
+def main(
+    dim: int = 512,
+    n_layers: int = 4,
+    max_seq_len: int = 512,
+    max_batch_size: int = 8,
+    max_gen_len: int = 64,
+    dtype: str = "float32",
+    std: float = 0.05,
+):
+    torch.set_default_dtype(getattr(torch, dtype))
+    kwargs = dict(max_seq_len=max_seq_len, max_batch_size=max_batch_size, dim=dim, n_heads=8)
+    kwargs.update(n_kv_heads=8, n_layers=n_layers)
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llamas = {dtype: build_tiny_llama(tokenizer_path, **kwargs)}
+        for kv_cache_dtype in ("int8", "fp8"):
+            llamas[kv_cache_dtype] = build_tiny_llama(
+                tokenizer_path, kv_cache_dtype=kv_cache_dtype, **kwargs
+            )
+    with torch.no_grad():
+        for name, param in llamas[dtype].model.named_parameters():
+            if not name.endswith("norm.weight"):
+                param.normal_(mean=0.0, std=std)
+    for kv_cache_dtype in ("int8", "fp8"):
+        llamas[kv_cache_dtype].model.load_state_dict(llamas[dtype].model.state_dict())
+
+    reference = llamas[dtype]
+    reference.tokenizer.eos_id = -1
+    prompt = reference.tokenizer.encode(PROMPT, bos=True, eos=False)
+    text, _ = reference.generate([prompt], max_seq_len - len(prompt) - 1, 1.0, top_p=1.0)
+    tokens = torch.tensor([prompt + text[0]])
+    expected = torch.log_softmax(reference.model.forward(tokens, 0).float(), dim=-1)
+    reference_bytes = cache_nbytes(reference)
+
+    print(
+        f"{'kv cache':>8} {'cache MB':>9} {'sequences':>10} {'ms/token':>9} {'mean KL':>9} "
+        f"{'top-1 agree':>12}"
+    )
+    for name, llama in llamas.items():
+        llama.tokenizer.eos_id = -1
+        llama.generate([prompt], 4, temperature=0)  # warmup
+        start = time.perf_counter()
+        llama.generate([prompt], max_gen_len, temperature=0)
+        ms_per_token = (time.perf_counter() - start) / max_gen_len * 1e3
+
+        logprobs = torch.log_softmax(llama.model.forward(tokens, 0).float(), dim=-1)
+        kl_divergence = (expected.exp() * (expected - logprobs)).sum(dim=-1).mean()
+        agreement = (logprobs.argmax(-1) == expected.argmax(-1)).float().mean()
+        nbytes = cache_nbytes(llama)
+        print(
+            f"{name:>8} {nbytes / 2**20:>9.1f} {max_batch_size * reference_bytes // nbytes:>10} "
+            f"{ms_per_token:>9.2f} {kl_divergence:>9.5f} {agreement:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
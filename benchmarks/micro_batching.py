@@ -0,0 +1,74 @@
+"""
+Load generator for micro batching: generated tokens/s at 1/4/8/16 concurrent clients.
+
+Every client sends its requests back to back and awaits each result, like an RPC client would.
+
+    python benchmarks/micro_batching.py --requests 32 --max_wait_ms 5
+"""
+
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+from chimera_llama_grpc.service import MicroBatcher
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+async def run(batcher: MicroBatcher, prompt_tokens, requests: int, clients: int, max_gen_len: int):
+    generated = 0
+
+    async def client(n: int):
+        nonlocal generated
+        for _ in range(n):
+            tokens = await batcher.submit(prompt_tokens, temperature=0, max_gen_len=max_gen_len)
+            generated += len(tokens)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(requests // clients) for _ in range(clients)))
+    return generated / (time.perf_counter() - start)
+
+
+def main(
+    requests: int = 32,
+    max_gen_len: int = 32,
+    max_wait_ms: float = 5.0,
+    dim: int = 256,
+    n_layers: int = 4,
+    clients=(1, 4, 8, 16),
+):
+    max_batch_size = max(clients)
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=256,
+            max_batch_size=max_batch_size,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so every request generates exactly max_gen_len tokens
+    llama.tokenizer.eos_id = -1
+    prompt_tokens = llama.tokenizer.encode(PROMPT, bos=True, eos=False)
+
+    async def bench():
+        batcher = MicroBatcher(
+            lambda: llama, max_wait_ms=max_wait_ms, max_batch_size=max_batch_size
+        )
+        await run(batcher, prompt_tokens, 2, 2, 4)  # warmup
+        print(f"{'clients':>8} {'tokens/s':>10} {'speedup':>8}")
+        baseline = None
+        for n in clients:
+            tps = await run(batcher, prompt_tokens, requests, n, max_gen_len)
+            baseline = baseline or tps
+            print(f"{n:>8} {tps:>10.1f} {tps / baseline:>7.2f}x")
+
+    asyncio.run(bench())
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,103 @@
+"""
+Llama.generate latency for batches mixing short and long prompts: the previous loop that started
+decoding at the shortest prompt length and fed the rest of the longer prompts one position per
+step, against prefilling every prompt in one pass and decoding each row at its own position.
+
+    python benchmarks/mixed_length_prefill.py --short_len 16 --long_lens 128,512,1024 --batch_size 4
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+@torch.inference_mode()
+def generate_before(llama, prompt_tokens, max_gen_len: int):
+    """Greedy decoding with the min_prompt_len loop generate used to run."""
+    bsz = len(prompt_tokens)
+    min_prompt_len = min(len(t) for t in prompt_tokens)
+    total_len = max(len(t) for t in prompt_tokens) + max_gen_len
+    pad_id = llama.tokenizer.pad_id
+    tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long)
+    for k, t in enumerate(prompt_tokens):
+        tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long)
+    input_text_mask = tokens != pad_id
+    prev_pos = 0
+    for cur_pos in range(min_prompt_len, total_len):
+        logits = llama.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+        next_token = torch.argmax(logits[:, -1], dim=-1)
+        tokens[:, cur_pos] = torch.where(
+            input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+        )
+        prev_pos = cur_pos
+    return [tokens[k, len(t) : len(t) + max_gen_len].tolist() for k, t in enumerate(prompt_tokens)]
+
+
+def timed(f, forward_calls):
+    forward_calls.clear()
+    start = time.perf_counter()
+    out = f()
+    return out, time.perf_counter() - start, len(forward_calls)
+
+
+def main(
+    short_len: int = 16,
+    long_lens=(128, 512, 1024),
+    batch_size: int = 4,
+    max_gen_len: int = 32,
+    dim: int = 512,
+    n_layers: int = 4,
+):
+    if isinstance(long_lens, (int, str)):
+        long_lens = [int(n) for n in str(long_lens).split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=max(long_lens) + max_gen_len,
+            max_batch_size=batch_size,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so both loops generate max_gen_len tokens per row
+    llama.tokenizer.eos_id = -1
+    forward_calls = []
+    forward = llama.model.forward
+
+    def counted_forward(*args, **kwargs):
+        forward_calls.append(None)
+        return forward(*args, **kwargs)
+
+    llama.model.forward = counted_forward
+    rng = random.Random(0)
+    n_words = llama.tokenizer.n_words
+
+    print(f"{batch_size} rows, one of {short_len} tokens, {max_gen_len} generated tokens each")
+    print(
+        f"{'long len':>8} {'before s':>9} {'forwards':>8} {'after s':>8} {'forwards':>8} "
+        f"{'speedup':>8}"
+    )
+    for long_len in long_lens:
+        lengths = [short_len] + [long_len] * (batch_size - 1)
+        prompt_tokens = [[1] + [rng.randrange(3, n_words) for _ in range(n - 1)] for n in lengths]
+        expected, before, before_calls = timed(
+            lambda: generate_before(llama, prompt_tokens, max_gen_len), forward_calls
+        )
+        (out_tokens, _), after, after_calls = timed(
+            lambda: llama.generate(prompt_tokens, max_gen_len, temperature=0), forward_calls
+        )
+        assert out_tokens == expected
+        print(
+            f"{long_len:>8} {before:>9.2f} {before_calls:>8} {after:>8.2f} {after_calls:>8} "
+            f"{before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,78 @@
+"""
+Request latency when clients alternate between two models: a single resident model reloads on
+every switch, a memory budget for both keeps them resident.
+
+    python benchmarks/model_pool.py --dim 1024 --n_layers 8 --requests 20
+"""
+
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.tiny import (
+    TINY_MODEL_PARAMS,
+    build_tiny_llama,
+    build_tiny_tokenizer,
+)
+from chimera_llama_grpc.log import logger
+from chimera_llama_grpc.model_manager import ModelManager
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+MODELS = ["llama-a", "llama-b"]
+
+
+def run(manager: ModelManager, requests: int, max_gen_len: int):
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        llama = manager.get_model_host(MODELS[i % len(MODELS)]).model
+        prompt_tokens = llama.tokenizer.encode(PROMPT, bos=True, eos=False)
+        llama.generate([prompt_tokens], max_gen_len, temperature=0)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main(
+    dim: int = 1024,
+    n_layers: int = 8,
+    requests: int = 20,
+    max_gen_len: int = 8,
+    dtype: str = "bfloat16",
+):
+    logger.remove()
+    params = {**TINY_MODEL_PARAMS, "dim": dim, "n_layers": n_layers}
+    # float32 checkpoints loaded as bfloat16 are converted on every load, like fp16 ones on CUDA
+    model_params = {"max_seq_len": 64, "max_batch_size": 1, "device": "cpu", "dtype": dtype}
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        for seed, name in enumerate(MODELS):
+            model_dir = Path(tmp) / "ckpt" / name
+            model_dir.mkdir(parents=True)
+            llama = build_tiny_llama(tokenizer_path, seed=seed, dim=dim, n_layers=n_layers)
+            torch.save(llama.model.state_dict(), model_dir / "consolidated.00.pth")
+            (model_dir / "params.json").write_text(json.dumps(params))
+            del llama
+
+        print(f"{'budget GiB':>10} {'p50 ms':>8} {'max ms':>8} {'total s':>8}")
+        for budget_gb in (0, 4):
+            manager = ModelManager(
+                Path(tmp) / "ckpt",
+                tokenizer_path,
+                dict(model_params),
+                memory_budget=int(budget_gb * 2**30),
+            )
+            latencies = run(manager, requests, max_gen_len)
+            manager.unload_models()
+            print(
+                f"{budget_gb:>10} {statistics.median(latencies) * 1e3:>8.1f} "
+                f"{max(latencies) * 1e3:>8.1f} {sum(latencies):>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,72 @@
+"""
+Memory accounting of the paged KV cache against the dense per-row cache.
+
+Runs a skewed mix of short and long requests through the scheduler on a tiny CPU model, samples the
+block pool while it is busy and prints how many bytes the same number of sequences would have
+reserved with the dense cache.
+
+    python benchmarks/paged_kv_cache.py --max_batch_size 32 --kv_num_blocks 64
+"""
+
+import random
+import tempfile
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+def main(
+    requests: int = 64,
+    max_seq_len: int = 512,
+    max_batch_size: int = 32,
+    kv_block_size: int = 16,
+    kv_num_blocks: int = 128,
+    seed: int = 0,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=max_seq_len,
+            max_batch_size=max_batch_size,
+            kv_block_size=kv_block_size,
+            kv_num_blocks=kv_num_blocks,
+        )
+    llama.tokenizer.eos_id = -1
+    block_manager = llama.model.block_manager
+    scheduler = Scheduler(llama)
+
+    rng = random.Random(seed)
+    for _ in range(requests):
+        # most requests are short, a few are long
+        prompt_len = rng.choice([8, 16, 32, 256])
+        max_gen_len = rng.choice([8, 32, 128])
+        scheduler.submit(
+            [1] + [rng.randrange(3, 300) for _ in range(prompt_len - 1)], 0, 0.9, max_gen_len
+        )
+
+    peak_rows, peak_report = 0, block_manager.memory_report()
+    steps = 0
+    while scheduler.has_unfinished():
+        scheduler.step()
+        steps += 1
+        report = block_manager.memory_report()
+        if report["active_rows"] > peak_rows:
+            peak_rows, peak_report = report["active_rows"], report
+
+    dense_row_bytes = peak_report["dense_equivalent_bytes"] / max_batch_size
+    print(f"steps: {steps}")
+    for key, value in peak_report.items():
+        print(f"{key:>24}: {value}")
+    print(f"{'peak concurrent rows':>24}: {peak_rows}")
+    print(f"{'dense bytes for them':>24}: {int(dense_row_bytes * peak_rows)}")
+    print(
+        f"{'dense rows in the pool':>24}: {int(peak_report['reserved_bytes'] // dense_row_bytes)}"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
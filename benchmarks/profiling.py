@@ -0,0 +1,57 @@
+"""
+Cost of the generation phase hooks: a disabled PROFILER.phase() call, and decode throughput of a tiny
+CPU model with profiling off, with phase timings on, and the phase breakdown it reports.
+
+    python benchmarks/profiling.py --dim 512 --n_layers 8 --max_gen_len 64
+"""
+
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.profiling import PROFILER
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+def tokens_per_second(llama, prompts, max_gen_len: int, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        llama.generate(prompts, max_gen_len, temperature=0.8)
+    return repeats * len(prompts) * max_gen_len / (time.perf_counter() - start)
+
+
+def main(dim: int = 512, n_layers: int = 8, batch_size: int = 4, max_gen_len: int = 64):
+    calls = 1_000_000
+    seconds = timeit.timeit(lambda: PROFILER.phase("sample").__enter__(), number=calls)
+    print(f"disabled phase(): {seconds / calls * 1e9:.0f} ns per call")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path, max_seq_len=256, max_batch_size=batch_size, dim=dim, n_layers=n_layers
+        )
+    llama.tokenizer.eos_id = -1
+    prompt = llama.tokenizer.encode("the quick brown fox jumps over the lazy dog", True, False)
+    prompts = [prompt] * batch_size
+    torch.manual_seed(0)
+    tokens_per_second(llama, prompts, 8, 1)
+
+    print(f"\n{'profiling':>9} {'tokens/s':>9}")
+    for enabled in (False, True, False, True):
+        PROFILER.enabled = enabled
+        print(f"{str(enabled):>9} {tokens_per_second(llama, prompts, max_gen_len, 3):>9.1f}")
+    PROFILER.enabled = False
+
+    timings = PROFILER.drain()
+    total = sum(seconds for _, seconds in timings.values())
+    print(f"\n{'phase':>11} {'calls':>6} {'ms/call':>8} {'share':>6}")
+    for phase, (calls, seconds) in timings.items():
+        print(f"{phase:>11} {calls:>6} {seconds / calls * 1e3:>8.3f} {seconds / total:>6.1%}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,105 @@
+"""
+Weight-only quantization on CPU: checkpoint size, decode latency and perplexity of bf16, int8 and
+int4 models.
+
+A random bf16 model samples the evaluation text at temperature 1, so its own perplexity is the
+reference and the delta is what quantization costs. Random weights are much less smooth than trained
+ones and the error of every layer grows through the next ones, the deltas, int4 in particular, are
+far above what trained checkpoints show; --std sets how chaotic the random model is.
+
+    python benchmarks/quantization.py --dim 1024 --n_layers 4 --int4_group_size 128
+"""
+
+import json
+import math
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.quantization import quantize_checkpoint
+from chimera_llama_grpc.llama.tiny import (
+    TINY_MODEL_PARAMS,
+    build_tiny_llama,
+    build_tiny_tokenizer,
+)
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def perplexity(llama: Llama, tokens: torch.Tensor) -> float:
+    logits = llama.model.forward(tokens[:, :-1], 0).float()
+    nll = torch.nn.functional.cross_entropy(logits.transpose(1, 2), tokens[:, 1:])
+    return math.exp(nll.item())
+
+
+def main(
+    dim: int = 1024,
+    n_layers: int = 4,
+    n_heads: int = 8,
+    max_gen_len: int = 64,
+    eval_len: int = 256,
+    int4_group_size: int = 128,
+    std: float = 0.05,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        tokenizer_path = build_tiny_tokenizer(tmp / "tokenizer.model")
+        params = {**TINY_MODEL_PARAMS, "dim": dim, "n_layers": n_layers, "n_heads": n_heads}
+        params.update(n_kv_heads=n_heads, multiple_of=256)
+        torch.set_default_dtype(torch.bfloat16)
+        reference = build_tiny_llama(tokenizer_path, eval_len + 1, 1, **params)
+        with torch.no_grad():
+            for name, param in reference.model.named_parameters():
+                if not name.endswith("norm.weight"):
+                    param.normal_(mean=0.0, std=std)
+        model_dirs = {"bf16": tmp / "llama-bench"}
+        model_dirs["bf16"].mkdir()
+        torch.save(reference.model.state_dict(), model_dirs["bf16"] / "consolidated.00.pth")
+        (model_dirs["bf16"] / "params.json").write_text(json.dumps(params))
+        for mode, group_size in (("int8", 0), ("int4", int4_group_size)):
+            model_dirs[mode] = quantize_checkpoint(
+                model_dirs["bf16"], tmp / f"llama-bench-{mode}", mode, group_size
+            )
+
+        # never stop on EOS so every run generates exactly max_gen_len tokens
+        reference.tokenizer.eos_id = -1
+        prompt = reference.tokenizer.encode(PROMPT, bos=True, eos=False)
+        text, _ = reference.generate([prompt], eval_len - len(prompt), temperature=1.0, top_p=1.0)
+        tokens = torch.tensor([prompt + text[0]])
+
+        print(
+            f"{'weights':>8} {'ckpt MB':>8} {'ms/token':>9} {'prefill ms':>11} {'ppl':>8} {'delta':>7}"
+        )
+        reference_ppl = None
+        for name, model_dir in model_dirs.items():
+            llama = Llama.build(
+                model_dir.as_posix(),
+                tokenizer_path.as_posix(),
+                max_seq_len=eval_len + 1,
+                max_batch_size=1,
+                device="cpu",
+                dtype=torch.bfloat16,
+            )
+            llama.tokenizer.eos_id = -1
+            size = sum(p.stat().st_size for p in model_dir.glob("*.pth")) / 2**20
+            llama.generate([prompt], 4, temperature=0)  # warmup
+            start = time.perf_counter()
+            llama.generate([prompt], max_gen_len, temperature=0)
+            ms_per_token = (time.perf_counter() - start) / max_gen_len * 1e3
+            with torch.inference_mode():
+                start = time.perf_counter()
+                ppl = perplexity(llama, tokens)
+                prefill_ms = (time.perf_counter() - start) * 1e3
+            reference_ppl = reference_ppl or ppl
+            print(
+                f"{name:>8} {size:>8.1f} {ms_per_token:>9.2f} {prefill_ms:>11.1f} {ppl:>8.2f} "
+                f"{ppl - reference_ppl:>+7.2f}"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
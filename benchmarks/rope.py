@@ -0,0 +1,85 @@
+"""
+Rotary embedding tables: cost of building freqs_cis for every model against the shared cache, and
+perplexity of a tiny CPU model over contexts beyond max_seq_len / rope_scaling_factor.
+
+Random weights have no trained context length, so the perplexities only show that the scaled models
+run over the whole context and how far each scaling moves the model from the unscaled one.
+
+    python benchmarks/rope.py --head_dim 128 --max_seq_lens 4096,16384,32768
+"""
+
+import math
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.model import cached_freqs_cis, precompute_freqs_cis
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+
+def perplexity(llama, tokens: torch.Tensor) -> float:
+    logits = llama.model.forward(tokens[:, :-1], 0)
+    nll = torch.nn.functional.cross_entropy(logits.transpose(1, 2), tokens[:, 1:])
+    return math.exp(nll.item())
+
+
+def main(
+    head_dim: int = 128,
+    max_seq_lens=(4096, 16384, 32768),
+    models: int = 4,
+    context: int = 512,
+    scaling_factor: float = 4.0,
+):
+    if isinstance(max_seq_lens, str):
+        max_seq_lens = [int(n) for n in max_seq_lens.split(",")]
+    device = torch.device("cpu")
+    print(f"{'max_seq_len':>11} {'table MB':>9} {'build ms':>9} {'cached ms':>10} {'saved MB':>9}")
+    for max_seq_len in max_seq_lens:
+        start = time.perf_counter()
+        table = precompute_freqs_cis(head_dim, max_seq_len * 2)
+        build = time.perf_counter() - start
+        cached_freqs_cis(head_dim, max_seq_len * 2, 10000.0, device)
+        start = time.perf_counter()
+        for _ in range(models):
+            cached_freqs_cis(head_dim, max_seq_len * 2, 10000.0, device)
+        cached = (time.perf_counter() - start) / models
+        size = table.nbytes / 2**20
+        # a pool of `models` models used to hold one table each
+        print(
+            f"{max_seq_len:>11} {size:>9.1f} {build * 1e3:>9.2f} {cached * 1e3:>10.4f} "
+            f"{size * (models - 1):>9.1f}"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llamas = {
+            scaling: build_tiny_llama(
+                tokenizer_path,
+                max_seq_len=context,
+                max_batch_size=1,
+                rope_scaling=scaling,
+                rope_scaling_factor=scaling_factor,
+            )
+            for scaling in (None, "linear", "ntk")
+        }
+    base = llamas[None]
+    for llama in llamas.values():
+        llama.model.load_state_dict(base.model.state_dict())
+    torch.manual_seed(0)
+    base.tokenizer.eos_id = -1
+    prompt = base.tokenizer.encode("the quick brown fox", bos=True, eos=False)
+    text, _ = base.generate([prompt], context - len(prompt), temperature=1.0, top_p=1.0)
+    tokens = torch.tensor([prompt + text[0]])
+
+    lengths = [int(context / scaling_factor), context // 2, context]
+    print(f"\n{'rope_scaling':>12} " + " ".join(f"{f'ppl@{n}':>9}" for n in lengths))
+    for scaling, llama in llamas.items():
+        ppls = " ".join(f"{perplexity(llama, tokens[:, :n]):>9.2f}" for n in lengths)
+        print(f"{str(scaling):>12} {ppls}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,56 @@
+"""
+CPU time of one sampling step: full-vocabulary sort (sample_top_p) vs. the top-k prefiltered sampler.
+
+Logits are drawn with a standard deviation of --scale, real LLM logits are peaked enough that the
+nucleus fits in the prefilter; --scale 0.5 shows the full sort fallback on flat distributions.
+
+    python benchmarks/sampling.py --vocab_size 32000 --batch_sizes 1,8,32
+"""
+
+import time
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama.generation import sample_top_p
+from chimera_llama_grpc.llama.sampling import sample
+
+
+def timeit(fn, repeat: int) -> float:
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(
+    vocab_size: int = 32000,
+    batch_sizes=(1, 8, 32),
+    temperature: float = 0.6,
+    top_p: float = 0.9,
+    scale: float = 4.0,
+    repeat: int = 50,
+):
+    if isinstance(batch_sizes, (int, str)):
+        batch_sizes = [int(b) for b in str(batch_sizes).split(",")]
+    torch.manual_seed(0)
+    print(f"{'bsz':>4} {'sort ms':>8} {'prefilter ms':>13} {'greedy ms':>10} {'speedup':>8}")
+    for bsz in batch_sizes:
+        logits = torch.randn(bsz, vocab_size) * scale
+        temperatures = torch.full((bsz,), temperature)
+        top_ps = torch.full((bsz,), top_p)
+
+        current = timeit(
+            lambda: sample_top_p(torch.softmax(logits / temperature, dim=-1), top_p), repeat
+        )
+        optimized = timeit(lambda: sample(logits, temperatures, top_ps), repeat)
+        greedy = timeit(lambda: torch.argmax(logits, dim=-1), repeat)
+        print(
+            f"{bsz:>4} {current * 1e3:>8.3f} {optimized * 1e3:>13.3f} {greedy * 1e3:>10.3f} "
+            f"{current / optimized:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,73 @@
+"""
+Speculative decoding on CPU: acceptance rate and generated tokens/s against plain generate.
+
+Random weights give a draft that never agrees with its target, so the target is made "distillable":
+the layers after the first draft_layers get their output projections scaled by --residual_scale,
+and the draft is a copy of the target truncated to draft_layers. Lower scales mean a better draft.
+
+    python benchmarks/speculative.py --n_layers 8 --draft_layers 2 --num_speculative_tokens 4
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.speculative import SpeculativeStats
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def main(
+    batch_size: int = 1,
+    max_gen_len: int = 128,
+    dim: int = 512,
+    n_layers: int = 8,
+    draft_layers: int = 2,
+    num_speculative_tokens: int = 4,
+    residual_scale: float = 0.05,
+    temperature: float = 0,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        kwargs = dict(max_seq_len=max_gen_len + 32, max_batch_size=batch_size, dim=dim)
+        target = build_tiny_llama(tokenizer_path, n_layers=n_layers, **kwargs)
+        draft = build_tiny_llama(tokenizer_path, n_layers=draft_layers, **kwargs)
+
+    with torch.no_grad():
+        for layer in target.model.layers[draft_layers:]:
+            layer.attention.wo.weight.mul_(residual_scale)
+            layer.feed_forward.w2.weight.mul_(residual_scale)
+    state_dict = {k: v for k, v in target.model.state_dict().items() if not k.startswith("layers.")}
+    for i in range(draft_layers):
+        state_dict.update(
+            {f"layers.{i}.{k}": v for k, v in target.model.layers[i].state_dict().items()}
+        )
+    draft.model.load_state_dict(state_dict)
+
+    # never stop on EOS so both runs generate exactly max_gen_len tokens
+    target.tokenizer.eos_id = -1
+    speculative = Llama(
+        target.model, target.tokenizer, draft=draft, num_speculative_tokens=num_speculative_tokens
+    )
+    prompt_tokens = [target.tokenizer.encode(PROMPT, bos=True, eos=False)] * batch_size
+
+    print(f"{'mode':>12} {'tokens/s':>9} {'acceptance':>11} {'tokens/round':>13}")
+    for name, llama in (("plain", target), ("speculative", speculative)):
+        llama.generate(prompt_tokens, 8, temperature=temperature)  # warmup
+        llama.speculative_stats = SpeculativeStats()
+        start = time.perf_counter()
+        out_tokens, _ = llama.generate(prompt_tokens, max_gen_len, temperature=temperature)
+        tokens_per_s = sum(len(t) for t in out_tokens) / (time.perf_counter() - start)
+        stats = llama.speculative_stats
+        acceptance = f"{stats.acceptance_rate:.2f}" if llama.draft else "-"
+        per_round = f"{stats.tokens_per_round:.2f}" if llama.draft else "1.00"
+        print(f"{name:>12} {tokens_per_s:>9.1f} {acceptance:>11} {per_round:>13}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,101 @@
+"""
+Tokens and time saved by stopping rows inside the decode loop instead of generating to max_gen_len
+and cutting the text afterwards, with Llama.generate and with the continuous batching Scheduler.
+
+Rows are seeded so a row samples the same tokens with and without stop strings until it stops. The
+random tiny model mostly emits byte tokens, the default stop strings are single characters that show
+up every hundred tokens or so. Also reports the cost of checking a token against the stop strings.
+
+    python benchmarks/stop_sequences.py --batch_size 8 --max_gen_len 256 --stop "\\n,."
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.stopping import StopCriteria, truncate_at_stop
+from chimera_llama_grpc.llama.tiny import build_tiny_llama, build_tiny_tokenizer
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+
+def run_generate(llama, prompt_tokens, max_gen_len: int, stop):
+    start = time.perf_counter()
+    out_tokens, _ = llama.generate(
+        prompt_tokens,
+        max_gen_len,
+        temperature=1.0,
+        seeds=list(range(len(prompt_tokens))),
+        stop=None if stop is None else [stop] * len(prompt_tokens),
+    )
+    return out_tokens, time.perf_counter() - start
+
+
+def run_scheduler(llama, prompt_tokens, max_gen_len: int, stop):
+    scheduler = Scheduler(llama)
+    start = time.perf_counter()
+    sequences = [
+        scheduler.submit(t, temperature=1.0, max_gen_len=max_gen_len, seed=i, stop=stop)
+        for i, t in enumerate(prompt_tokens)
+    ]
+    while scheduler.has_unfinished():
+        scheduler.step()
+    return [s.future.result() for s in sequences], time.perf_counter() - start
+
+
+def main(
+    batch_size: int = 8,
+    max_gen_len: int = 256,
+    stop=("\n", "."),
+    dim: int = 512,
+    n_layers: int = 4,
+):
+    if isinstance(stop, str):
+        stop = stop.encode().decode("unicode_escape").split(",")
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        llama = build_tiny_llama(
+            tokenizer_path,
+            max_seq_len=max_gen_len + 64,
+            max_batch_size=batch_size,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    # never stop on EOS so rows without a stop string generate exactly max_gen_len tokens
+    llama.tokenizer.eos_id = -1
+    tokenizer = llama.tokenizer
+    prompt_tokens = [tokenizer.encode(PROMPT, bos=True, eos=False)] * batch_size
+    run_generate(llama, prompt_tokens, 4, None)  # warmup
+
+    print(f"stop strings {stop!r}, {batch_size} rows x {max_gen_len} tokens")
+    print(f"{'':>9} {'stop':>4} {'tokens':>7} {'seconds':>8} {'saved':>6}")
+    for name, run in (("generate", run_generate), ("scheduler", run_scheduler)):
+        full, full_seconds = run(llama, prompt_tokens, max_gen_len, None)
+        stopped, seconds = run(llama, prompt_tokens, max_gen_len, stop)
+        # the same text once the client cuts the full generation at the stop string
+        for full_tokens, stopped_tokens in zip(full, stopped):
+            assert full_tokens[: len(stopped_tokens)] == stopped_tokens
+            assert truncate_at_stop(tokenizer.decode(full_tokens), stop) == truncate_at_stop(
+                tokenizer.decode(stopped_tokens), stop
+            )
+        full_count = sum(len(t) for t in full)
+        count = sum(len(t) for t in stopped)
+        print(f"{name:>9} {'off':>4} {full_count:>7} {full_seconds:>8.2f}")
+        print(f"{name:>9} {'on':>4} {count:>7} {seconds:>8.2f} {1 - count / full_count:>6.1%}")
+
+    rng = random.Random(0)
+    tokens = [rng.randrange(3, tokenizer.n_words) for _ in range(100_000)]
+    criteria = StopCriteria(tokenizer, ["\nUser:", "</s>", "###"])
+    start = time.perf_counter()
+    for token in tokens:
+        criteria.push(token)
+    elapsed = time.perf_counter() - start
+    print(f"\nstop string check: {elapsed / len(tokens) * 1e6:.2f} us per token")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
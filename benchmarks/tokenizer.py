@@ -0,0 +1,115 @@
+"""
+Dialog encoding cost for 2 to 200 turns: the previous per-turn encode concatenated with
+sum([...], []), the batched encoder with a cold cache, and a chat that sends its history again with
+every new turn (each turn after the first hits the cache). Also per-token decoding of logprobs
+outputs with decode([token]) against the precomputed token table.
+
+    python benchmarks/tokenizer.py --turns 2,10,50,200
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+from chimera_llama_grpc.llama.generation import B_INST, B_SYS, E_INST, E_SYS
+from chimera_llama_grpc.llama.tiny import build_tiny_tokenizer
+from chimera_llama_grpc.llama.tokenizer import Tokenizer
+
+WORDS = "the quick brown fox jumps over lazy dog llama model server request token cache".split()
+
+
+def make_dialog(turns: int, rng: random.Random):
+    dialog = [{"role": "system", "content": " ".join(rng.choice(WORDS) for _ in range(60))}]
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        dialog.append({"role": role, "content": " ".join(rng.choice(WORDS) for _ in range(40))})
+    if dialog[-1]["role"] != "user":
+        dialog.append({"role": "user", "content": "what is your name"})
+    return dialog
+
+
+def merge_system(dialog):
+    if dialog[0]["role"] != "system":
+        return dialog
+    content = B_SYS + dialog[0]["content"] + E_SYS + dialog[1]["content"]
+    return [{"role": dialog[1]["role"], "content": content}] + dialog[2:]
+
+
+def encode_dialog_before(tokenizer: Tokenizer, dialog):
+    dialog = merge_system(dialog)
+    sp = tokenizer.sp_model
+    tokens = sum(
+        [
+            [tokenizer.bos_id]
+            + sp.encode(f"{B_INST} {p['content'].strip()} {E_INST} {a['content'].strip()} ")
+            + [tokenizer.eos_id]
+            for p, a in zip(dialog[::2], dialog[1::2])
+        ],
+        [],
+    )
+    return tokens + [tokenizer.bos_id] + sp.encode(f"{B_INST} {dialog[-1]['content']} {E_INST}")
+
+
+def encode_dialog_after(tokenizer: Tokenizer, dialog):
+    dialog = merge_system(dialog)
+    turns = tokenizer.encode_batch(
+        [
+            f"{B_INST} {p['content'].strip()} {E_INST} {a['content'].strip()} "
+            for p, a in zip(dialog[::2], dialog[1::2])
+        ],
+        bos=True,
+        eos=True,
+    )
+    tokens = []
+    for turn in turns:
+        tokens.extend(turn)
+    return tokens + tokenizer.encode(f"{B_INST} {dialog[-1]['content']} {E_INST}", True, False)
+
+
+def timed(f, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main(turns=(2, 10, 50, 200), repeats: int = 5, tokens: int = 4096):
+    if isinstance(turns, str):
+        turns = [int(n) for n in turns.split(",")]
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer_path = build_tiny_tokenizer(Path(tmp) / "tokenizer.model")
+        print(f"{'turns':>5} {'tokens':>7} {'before ms':>10} {'cold ms':>8} {'chat ms':>8}")
+        for n in turns:
+            dialog = make_dialog(n, random.Random(n))
+            cold = Tokenizer(str(tokenizer_path), cache_size=0)
+            expected = encode_dialog_before(cold, dialog)
+            assert encode_dialog_after(cold, dialog) == expected
+            before = timed(lambda: encode_dialog_before(cold, dialog), repeats)
+            after = timed(lambda: encode_dialog_after(cold, dialog), repeats)
+
+            # a chat sends the whole history again with every user turn
+            warm = Tokenizer(str(tokenizer_path))
+            prefixes = [
+                dialog[:i] for i in range(2, len(dialog) + 1) if dialog[i - 1]["role"] == "user"
+            ]
+            for prefix in prefixes[:-1]:
+                encode_dialog_after(warm, prefix)
+            chat = timed(lambda: encode_dialog_after(warm, dialog), repeats)
+            print(f"{n:>5} {len(expected):>7} {before:>10.3f} {after:>8.3f} {chat:>8.3f}")
+
+        tokenizer = Tokenizer(str(tokenizer_path))
+        rng = random.Random(0)
+        ids = [rng.randrange(3, tokenizer.n_words) for _ in range(tokens)]
+        per_token = timed(lambda: [tokenizer.sp_model.decode(i) for i in ids], repeats)
+        tokenizer.token_texts(ids[:1])
+        table = timed(lambda: tokenizer.token_texts(ids), repeats)
+        print(
+            f"\ndecode {tokens} tokens one by one: {per_token:.3f} ms, token table {table:.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
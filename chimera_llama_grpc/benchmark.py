@@ -0,0 +1,300 @@
+"""
+Load test of the gRPC service with a tiny random-weights model on CPU.
+
+run_benchmark builds a tiny checkpoint, serves it with LlamaServicer on a local port and drives
+Completion or Chat from concurrent clients. The report (throughput, latency and time to first token
+percentiles) is plain JSON, so results can be stored and compared between commits.
+"""
+
+import asyncio
+import json
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import grpc
+import torch
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+
+from chimera_llama_grpc import metrics
+from chimera_llama_grpc.llama.tiny import (
+    TINY_MODEL_PARAMS,
+    build_tiny_llama,
+    build_tiny_tokenizer,
+)
+from chimera_llama_grpc.llama.tokenizer import Tokenizer
+from chimera_llama_grpc.service import (
+    LlamaServicer,
+    LLMStreamStub,
+    add_streaming_handlers_to_server,
+)
+from chimera_llama_grpc.tools import run_in_threadpool
+
+BENCHMARK_RPCS = ("completion", "chat")
+PERCENTILES = (50, 95, 99)
+
+_WORDS = "the quick brown fox jumps over lazy dog llama model server request token cache".split()
+
+
+def length_distribution(spec: Union[str, int]) -> Callable[[random.Random], int]:
+    """
+    Parse a token length distribution.
+
+    Args:
+        spec (Union[str, int]): "32" for a fixed length, "16-64" for lengths drawn uniformly from
+            the range (inclusive), "16,32,128" for lengths drawn from the list.
+
+    Returns:
+        Callable[[random.Random], int]: Draws a length with the given generator.
+
+    Raises:
+        ValueError: If spec is malformed or a length is not positive.
+    """
+    spec = str(spec).strip()
+    try:
+        if "," in spec:
+            choices = [int(n) for n in spec.split(",")]
+            lengths, sample = choices, lambda rng: rng.choice(choices)
+        elif "-" in spec:
+            low, high = (int(n) for n in spec.split("-"))
+            lengths, sample = [low, high], lambda rng: rng.randint(low, high)
+        else:
+            length = int(spec)
+            lengths, sample = [length], lambda rng: length
+    except ValueError:
+        raise ValueError(f"Invalid length distribution: {spec!r}") from None
+    if min(lengths) < 1 or ("-" in spec and lengths[0] > lengths[1]):
+        raise ValueError(f"Invalid length distribution: {spec!r}")
+    return sample
+
+
+def summarize(values: List[float]) -> Optional[Dict[str, float]]:
+    """Mean, max and PERCENTILES of values (nearest rank), None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    summary = {"mean": statistics.fmean(ordered), "max": ordered[-1]}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+    return summary
+
+
+def make_prompt(tokenizer: Tokenizer, n_tokens: int, rng: random.Random) -> str:
+    """Random words making up about n_tokens tokens."""
+    words: List[str] = []
+    while len(tokenizer.encode(" ".join(words), bos=False, eos=False)) < n_tokens:
+        words.append(rng.choice(_WORDS))
+    return " ".join(words)
+
+
+def build_tiny_checkpoint(ckpt_dir: Path, seed: int = 0, **params) -> Path:
+    """
+    Write a tiny chat model to ckpt_dir in the layout ModelManager loads.
+
+    Args:
+        ckpt_dir (Path): Directory to create the model and the tokenizer in.
+        seed (int, optional): Seed of the random weights. Defaults to 0.
+        **params: Overrides for TINY_MODEL_PARAMS, e.g. dim or n_layers.
+
+    Returns:
+        Path: The tokenizer model.
+    """
+    model_dir = ckpt_dir / "llama-tiny-chat"
+    model_dir.mkdir(parents=True)
+    tokenizer_path = build_tiny_tokenizer(ckpt_dir / "tokenizer.model")
+    llama = build_tiny_llama(tokenizer_path, seed=seed, **params)
+    torch.save(llama.model.state_dict(), model_dir / "consolidated.00.pth")
+    (model_dir / "params.json").write_text(json.dumps({**TINY_MODEL_PARAMS, **params}))
+    return tokenizer_path
+
+
+def _total(counter: metrics.Counter) -> float:
+    return sum(value for _, _, value in counter.samples())
+
+
+async def _request(
+    stub: chimera_llm_pb2_grpc.LLMStub,
+    stream_stub: LLMStreamStub,
+    rpc: str,
+    stream: bool,
+    prompt: str,
+    inference_args: chimera_llm_pb2.InferenceArgs,
+) -> Optional[float]:
+    """Run one request, return the time to its first streamed response."""
+    if rpc == "completion":
+        request = chimera_llm_pb2.CompletionRequest(prompt=prompt, inference_args=inference_args)
+        call = stream_stub.CompletionStream if stream else stub.Completion
+    else:
+        request = chimera_llm_pb2.ChatRequest(
+            messages=[chimera_llm_pb2.ChatMessage(role=chimera_llm_pb2.USER, content=prompt)],
+            inference_args=inference_args,
+        )
+        call = stream_stub.ChatStream if stream else stub.Chat
+    if not stream:
+        await call(request)
+        return None
+    start, first = time.perf_counter(), None
+    async for _ in call(request):
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+
+async def _tiny_servicer(
+    tmp: Path,
+    seed: int,
+    max_seq_len: int,
+    max_batch_size: int,
+    batching: str,
+    model_params: Dict[str, Any],
+) -> LlamaServicer:
+    ckpt_dir = tmp / "ckpt"
+    tokenizer_path = build_tiny_checkpoint(ckpt_dir, seed=seed, **model_params)
+    servicer = LlamaServicer(
+        str(ckpt_dir),
+        str(tokenizer_path),
+        max_seq_len=max_seq_len,
+        max_batch_size=max_batch_size,
+        device="cpu",
+        dtype="float32",
+        batching=batching,
+    )
+    await run_in_threadpool(servicer.model_manager.prewarm)
+    # random weights stop at random points, never stopping makes every gen_len exact
+    host = servicer.model_manager.model_host
+    host.model.tokenizer.eos_id = -1
+    if host.scheduler is not None:
+        host.scheduler.eos_id = -1
+    return servicer
+
+
+async def run_benchmark(
+    rpc: str = "completion",
+    requests: int = 64,
+    concurrency: int = 8,
+    prompt_len: Union[str, int] = "16-64",
+    gen_len: Union[str, int] = "16-64",
+    stream: bool = True,
+    max_batch_size: int = 8,
+    max_seq_len: int = 256,
+    batching: str = "continuous",
+    seed: int = 0,
+    **model_params,
+) -> Dict[str, Any]:
+    """
+    Serve a tiny model on CPU and measure it under load.
+
+    Every request asks for exactly its drawn number of tokens: the model never stops at EOS.
+
+    Args:
+        rpc (str, optional): "completion" or "chat". Defaults to "completion".
+        requests (int, optional): Number of requests to send. Defaults to 64.
+        concurrency (int, optional): Number of clients sending requests back to back. Defaults to 8.
+        prompt_len (Union[str, int], optional): Prompt tokens, see length_distribution. Defaults to
+            "16-64".
+        gen_len (Union[str, int], optional): Generated tokens, see length_distribution. Defaults to
+            "16-64".
+        stream (bool, optional): Use the streaming RPCs, needed to measure the time to first token.
+            Defaults to True.
+        max_batch_size (int, optional): Maximum batch size of the server. Defaults to 8.
+        max_seq_len (int, optional): Maximum sequence length of the server. Defaults to 256.
+        batching (str, optional): "continuous" or "micro", see LlamaServicer. Defaults to
+            "continuous".
+        seed (int, optional): Seed of the model weights and the request lengths. Defaults to 0.
+        **model_params: Overrides for TINY_MODEL_PARAMS, e.g. dim or n_layers.
+
+    Returns:
+        Dict[str, Any]: The configuration, error count, duration, requests and generated tokens per
+            second, and latency and time to first token summaries in seconds (see summarize).
+
+    Raises:
+        ValueError: If rpc is unknown or prompts and responses do not fit in max_seq_len.
+    """
+    if rpc not in BENCHMARK_RPCS:
+        raise ValueError(f"rpc must be one of {BENCHMARK_RPCS}, got {rpc}")
+    config = {
+        "rpc": rpc,
+        "requests": requests,
+        "concurrency": concurrency,
+        "prompt_len": str(prompt_len),
+        "gen_len": str(gen_len),
+        "stream": stream,
+        "max_batch_size": max_batch_size,
+        "max_seq_len": max_seq_len,
+        "batching": batching,
+        "seed": seed,
+        "model": {**TINY_MODEL_PARAMS, **model_params},
+    }
+    sample_prompt_len = length_distribution(prompt_len)
+    sample_gen_len = length_distribution(gen_len)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        servicer = await _tiny_servicer(
+            Path(tmp), seed, max_seq_len, max_batch_size, batching, model_params
+        )
+        tokenizer = servicer.model.tokenizer
+        rng = random.Random(seed)
+        queue: "asyncio.Queue[Tuple[str, chimera_llm_pb2.InferenceArgs]]" = asyncio.Queue()
+        for _ in range(requests):
+            prompt = make_prompt(tokenizer, sample_prompt_len(rng), rng)
+            n_gen = sample_gen_len(rng)
+            # leave room for the chat template
+            if len(tokenizer.encode(prompt, bos=True, eos=False)) + n_gen + 16 > max_seq_len:
+                raise ValueError(f"Prompt and response lengths exceed max_seq_len {max_seq_len}")
+            args = chimera_llm_pb2.InferenceArgs(
+                max_gen_len=n_gen,
+                json_extra_args=json.dumps({"temperature": 0.8, "seed": rng.randrange(2**31)}),
+            )
+            queue.put_nowait((prompt, args))
+
+        latencies: List[float] = []
+        ttfts: List[float] = []
+        errors = 0
+
+        async def client(stub, stream_stub):
+            nonlocal errors
+            while not queue.empty():
+                prompt, args = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    ttft = await _request(stub, stream_stub, rpc, stream, prompt, args)
+                except grpc.aio.AioRpcError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                if ttft is not None:
+                    ttfts.append(ttft)
+
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(servicer, server)
+        add_streaming_handlers_to_server(servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                stub, stream_stub = chimera_llm_pb2_grpc.LLMStub(channel), LLMStreamStub(channel)
+                prompt_tokens = _total(metrics.PROMPT_TOKENS)
+                generated_tokens = _total(metrics.GENERATED_TOKENS)
+                start = time.perf_counter()
+                await asyncio.gather(*(client(stub, stream_stub) for _ in range(concurrency)))
+                duration = time.perf_counter() - start
+                prompt_tokens = _total(metrics.PROMPT_TOKENS) - prompt_tokens
+                generated_tokens = _total(metrics.GENERATED_TOKENS) - generated_tokens
+        finally:
+            await server.stop(None)
+            await run_in_threadpool(servicer.model_manager.unload_models)
+
+    return {
+        "config": config,
+        "errors": errors,
+        "duration_s": duration,
+        "requests_per_s": len(latencies) / duration,
+        "prompt_tokens": int(prompt_tokens),
+        "generated_tokens": int(generated_tokens),
+        "tokens_per_s": generated_tokens / duration,
+        "latency_s": summarize(latencies),
+        "ttft_s": summarize(ttfts),
+    }
@@ -1,10 +1,19 @@
+import asyncio
+import json
 import re
 import sys
 from pathlib import Path
 
 import click
 
+from chimera_llama_grpc.benchmark import BENCHMARK_RPCS, run_benchmark
 from chimera_llama_grpc.entrypoint import DEFAULT_CKPT_DIR, DEFAULT_TOKENIZER_PATH
+from chimera_llama_grpc.llama.quantization import (
+    QUANTIZATION_MODES,
+    quantize_checkpoint,
+)
+from chimera_llama_grpc.llama.tiny import TINY_MODEL_PARAMS
+from chimera_llama_grpc.service import BATCHING_MODES
 from chimera_llama_grpc.tools import load_entry_point
 
 _HERE = Path(__file__).parent
@@ -25,6 +34,51 @@ ENTRYPOINT = _HERE / "entrypoint.py"
 @click.option("--tokenizer-path", default=DEFAULT_TOKENIZER_PATH)
 @click.option("--max-seq-len", default=None)
 @click.option("--max-batch-size", default=None)
+@click.option(
+    "--device",
+    type=click.Choice(["cuda", "cpu"]),
+    default=None,
+    help="Defaults to cuda when available",
+)
+@click.option(
+    "--dtype",
+    type=click.Choice(["float16", "bfloat16", "float32"]),
+    default=None,
+    help="Defaults to float16 on cuda and bfloat16 on cpu",
+)
+@click.option(
+    "--batching",
+    type=click.Choice(["continuous", "micro"]),
+    default="continuous",
+    help="continuous: per-step scheduler, micro: group concurrent requests into generate calls",
+)
+@click.option(
+    "--batch-wait-ms",
+    type=float,
+    default=5.0,
+    help="Micro batching: how long to collect requests before dispatching a batch",
+)
+@click.option(
+    "--memory-budget-gb",
+    type=float,
+    default=0,
+    help="Memory the resident models may use together, 0 keeps a single model resident",
+)
+@click.option(
+    "--double-buffer/--no-double-buffer",
+    default=True,
+    help="Keep serving the current model while LoadModel loads the next one",
+)
+@click.option(
+    "--prewarm/--no-prewarm",
+    default=True,
+    help="Load and warm up the preferred model at startup instead of on the first request",
+)
+@click.option(
+    "--metrics-port",
+    default=50052,
+    help="Port of the Prometheus /metrics endpoint served by the first worker, 0 disables it",
+)
 def start(
     nnodes,
     nproc_per_node,
@@ -37,6 +91,14 @@ def start(
     tokenizer_path,
     max_seq_len,
     max_batch_size,
+    device,
+    dtype,
+    batching,
+    batch_wait_ms,
+    memory_budget_gb,
+    double_buffer,
+    prewarm,
+    metrics_port,
 ):
     sys.argv[0] = re.sub(r"(-script\.pyw|\.exe)?$", "", sys.argv[0])
 
@@ -66,16 +128,115 @@ def start(
         sys.argv.extend(["--max_seq_len", f"{max_seq_len}"])
     if max_batch_size:
         sys.argv.extend(["--max_batch_size", f"{max_batch_size}"])
+    if device:
+        sys.argv.extend(["--device", f"{device}"])
+    if dtype:
+        sys.argv.extend(["--dtype", f"{dtype}"])
+    sys.argv.extend(["--batching", f"{batching}"])
+    sys.argv.extend(["--batch_wait_ms", f"{batch_wait_ms}"])
+    sys.argv.extend(["--memory_budget_gb", f"{memory_budget_gb}"])
+    sys.argv.extend(["--double_buffer", f"{double_buffer}"])
+    sys.argv.extend(["--prewarm", f"{prewarm}"])
+    sys.argv.extend(["--metrics_port", f"{metrics_port}"])
 
     sys.exit(load_entry_point("torch", "console_scripts", "torchrun")())
 
 
+@click.command()
+@click.argument("model_dir", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option("--mode", type=click.Choice(QUANTIZATION_MODES), default="int8")
+@click.option(
+    "--group-size",
+    type=int,
+    default=0,
+    help="Input channels sharing a scale, defaults to a whole row for int8 and 128 for int4",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Defaults to MODEL_DIR-MODE next to MODEL_DIR, where start finds it",
+)
+def quantize(model_dir, mode, group_size, output_dir):
+    """Write a weight-only quantized copy of the checkpoint in MODEL_DIR."""
+    if output_dir is None:
+        output_dir = model_dir.parent / f"{model_dir.name}-{mode}"
+    click.echo(quantize_checkpoint(model_dir, output_dir, mode, group_size))
+
+
+@click.command()
+@click.option("--rpc", type=click.Choice(BENCHMARK_RPCS), default="completion")
+@click.option("--requests", default=64, help="Number of requests to send")
+@click.option("--concurrency", default=8, help="Number of clients sending requests back to back")
+@click.option(
+    "--prompt-len",
+    default="16-64",
+    help='Prompt tokens: fixed "32", uniform range "16-64" or choice "16,32,128"',
+)
+@click.option("--gen-len", default="16-64", help="Generated tokens, same format as --prompt-len")
+@click.option(
+    "--stream/--no-stream",
+    default=True,
+    help="Use the streaming RPCs, the time to first token is only measured when streaming",
+)
+@click.option("--max-batch-size", default=8)
+@click.option("--max-seq-len", default=256)
+@click.option("--batching", type=click.Choice(BATCHING_MODES), default="continuous")
+@click.option("--dim", default=TINY_MODEL_PARAMS["dim"], help="Width of the tiny model")
+@click.option("--n-layers", default=TINY_MODEL_PARAMS["n_layers"], help="Depth of the tiny model")
+@click.option("--seed", default=0)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Also write the JSON report to this file",
+)
+def benchmark(
+    rpc,
+    requests,
+    concurrency,
+    prompt_len,
+    gen_len,
+    stream,
+    max_batch_size,
+    max_seq_len,
+    batching,
+    dim,
+    n_layers,
+    seed,
+    output,
+):
+    """Load test the service with a tiny random-weights model on CPU and report JSON."""
+    report = asyncio.run(
+        run_benchmark(
+            rpc=rpc,
+            requests=requests,
+            concurrency=concurrency,
+            prompt_len=prompt_len,
+            gen_len=gen_len,
+            stream=stream,
+            max_batch_size=max_batch_size,
+            max_seq_len=max_seq_len,
+            batching=batching,
+            seed=seed,
+            dim=dim,
+            n_layers=n_layers,
+        )
+    )
+    report = json.dumps(report, indent=2)
+    if output is not None:
+        output.write_text(report + "\n")
+    click.echo(report)
+
+
 @click.group()
 def cli():
     pass
 
 
 cli.add_command(start)
+cli.add_command(quantize)
+cli.add_command(benchmark)
 
 if __name__ == "__main__":
     cli()
@@ -1,4 +1,5 @@
 import asyncio
+import os
 from typing import Optional
 
 import fire
@@ -6,7 +7,9 @@ import grpc
 from chimera_llm_proto import chimera_llm_pb2_grpc
 
 from chimera_llama_grpc.log import logger
-from chimera_llama_grpc.service import LlamaServicer
+from chimera_llama_grpc.metrics import REGISTRY, start_metrics_server
+from chimera_llama_grpc.service import LlamaServicer, add_streaming_handlers_to_server
+from chimera_llama_grpc.tools import run_in_threadpool
 
 DEFAULT_CKPT_DIR = "./ckpt/"
 DEFAULT_TOKENIZER_PATH = "./ckpt/tokenizer.model"
@@ -18,20 +21,43 @@ async def serve(
     tokenizer_path: str = DEFAULT_TOKENIZER_PATH,
     max_seq_len: Optional[int] = None,
     max_batch_size: Optional[int] = None,
+    device: Optional[str] = None,
+    dtype: Optional[str] = None,
+    batching: str = "continuous",
+    batch_wait_ms: float = 5.0,
+    memory_budget_gb: float = 0,
+    double_buffer: bool = True,
+    prewarm: bool = True,
+    metrics_port: int = 50052,
 ) -> None:
     server = grpc.aio.server()
-    chimera_llm_pb2_grpc.add_LLMServicer_to_server(
-        LlamaServicer(
-            ckpt_dir=ckpt_dir,
-            tokenizer_path=tokenizer_path,
-            max_seq_len=max_seq_len,
-            max_batch_size=max_batch_size,
-        ),
-        server,
+    servicer = LlamaServicer(
+        ckpt_dir=ckpt_dir,
+        tokenizer_path=tokenizer_path,
+        max_seq_len=max_seq_len,
+        max_batch_size=max_batch_size,
+        device=device,
+        dtype=dtype,
+        batching=batching,
+        batch_wait_ms=batch_wait_ms,
+        memory_budget_gb=memory_budget_gb,
+        double_buffer=double_buffer,
     )
+    chimera_llm_pb2_grpc.add_LLMServicer_to_server(servicer, server)
+    add_streaming_handlers_to_server(servicer, server)
     server.add_insecure_port(f"[::]:{port}")
     logger.info(f"Starting server on port {port}")
     await server.start()
+    # every torchrun worker runs serve, only the first one on the node exposes /metrics
+    if metrics_port and int(os.environ.get("LOCAL_RANK", 0)) == 0:
+        REGISTRY.add_collector(servicer.collect_metrics)
+        start_metrics_server(metrics_port)
+    if prewarm:
+        # Inspect reports the load progress meanwhile, requests wait for the model
+        try:
+            await run_in_threadpool(servicer.model_manager.prewarm)
+        except Exception as e:
+            logger.exception(e)
     await server.wait_for_termination()
 
 
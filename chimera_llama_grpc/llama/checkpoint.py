@@ -0,0 +1,115 @@
+"""
+Loading consolidated.*.pth checkpoints without a second copy of the weights in host memory.
+
+torch.load reads the whole file into anonymous memory before load_state_dict copies it into the
+model, so a model switch peaks at about twice the model size. With mmap=True torch.load only reads
+the tensor metadata, the data is paged in from the file while each tensor is copied into its
+parameter and can be dropped from the page cache right after.
+
+Both need torch>=2.1 (torch.load(mmap=...) and load_state_dict(assign=...)), older versions read
+the checkpoint and copy every tensor instead.
+"""
+
+import inspect
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+import torch
+from torch import nn
+
+from chimera_llama_grpc.log import logger
+
+HAS_MMAP = "mmap" in inspect.signature(torch.load).parameters
+HAS_ASSIGN = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _ignore_progress(phase: str, fraction: float) -> None:
+    pass
+
+
+def open_checkpoint(ckpt_path: Union[Path, str], mmap: bool = True) -> Dict[str, torch.Tensor]:
+    """
+    Open a checkpoint on the CPU, memory mapped if possible.
+
+    Checkpoints saved in the legacy (non zipfile) format, or opened with torch<2.1, cannot be mapped
+    and are read into memory.
+
+    Args:
+        ckpt_path (Union[Path, str]): Path of the checkpoint.
+        mmap (bool, optional): Map the file instead of reading it. Defaults to True.
+
+    Returns:
+        Dict[str, torch.Tensor]: State dict of CPU tensors.
+    """
+    if mmap and not HAS_MMAP:
+        logger.warning(f"torch {torch.__version__} cannot mmap {ckpt_path}, reading it into memory")
+    elif mmap:
+        try:
+            return torch.load(ckpt_path, map_location="cpu", mmap=True)
+        except RuntimeError as e:
+            logger.warning(f"Cannot mmap {ckpt_path}, reading it into memory: {e}")
+    return torch.load(ckpt_path, map_location="cpu")
+
+
+def load_checkpoint(
+    model: nn.Module,
+    ckpt_path: Union[Path, str],
+    mmap: bool = True,
+    on_progress: Optional[Callable[[str, float], None]] = None,
+) -> Dict[str, float]:
+    """
+    Load a checkpoint into model, tensor by tensor.
+
+    Tensors whose device, dtype and shape already match their parameter (a CPU model in the
+    checkpoint dtype) are assigned to the module as they are, the parameters then share the memory
+    map and nothing is copied at all (torch>=2.1). The others are copied into the existing parameters. Keys the
+    model does not have, e.g. rope.freqs, are ignored.
+
+    Args:
+        model (nn.Module): Model with parameters already allocated on their device.
+        ckpt_path (Union[Path, str]): Path of the checkpoint.
+        mmap (bool, optional): Memory map the checkpoint, see open_checkpoint. Defaults to True.
+        on_progress (Callable[[str, float], None], optional): Called with the phase and the
+            fraction of it done, after opening and after every tensor. Defaults to None.
+
+    Returns:
+        Dict[str, float]: Seconds spent opening the checkpoint ("open") and filling the
+            parameters ("copy").
+    """
+    if on_progress is None:
+        on_progress = _ignore_progress
+    start = time.perf_counter()
+    on_progress("open", 0.0)
+    checkpoint = open_checkpoint(ckpt_path, mmap=mmap)
+    opened = time.perf_counter()
+    on_progress("open", 1.0)
+
+    state_dict = model.state_dict()
+    assign, copy = {}, {}
+    for key, tensor in checkpoint.items():
+        target = state_dict.get(key)
+        if target is None:
+            continue
+        same = (
+            mmap
+            and HAS_ASSIGN
+            and tensor.device == target.device
+            and tensor.dtype == target.dtype
+            and tensor.shape == target.shape
+        )
+        (assign if same else copy)[key] = tensor
+    del state_dict
+    # one tensor per call to report progress, a call costs little more than a walk of the modules
+    total, done = len(assign) + len(copy), 0
+    for tensors, is_assign in ((assign, True), (copy, False)):
+        for key in list(tensors):
+            if is_assign:
+                model.load_state_dict({key: tensors.pop(key)}, strict=False, assign=True)
+            else:
+                model.load_state_dict({key: tensors.pop(key)}, strict=False)
+            done += 1
+            on_progress("copy", done / total)
+    del checkpoint
+
+    return {"open": opened - start, "copy": time.perf_counter() - opened}
@@ -6,17 +6,33 @@ import os
 import sys
 import time
 from pathlib import Path
-from typing import List, Literal, Optional, Tuple, TypedDict
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 import torch
 import torch.nn.functional as F
 from fairscale.nn.model_parallel.initialize import (
     get_model_parallel_rank,
+    get_model_parallel_world_size,
     initialize_model_parallel,
     model_parallel_is_initialized,
 )
 
+from chimera_llama_grpc.llama.checkpoint import load_checkpoint
 from chimera_llama_grpc.llama.model import ModelArgs, Transformer
+from chimera_llama_grpc.llama.profiling import PROFILER
+from chimera_llama_grpc.llama.sampling import multinomial, sample
+from chimera_llama_grpc.llama.speculative import SpeculativeStats, speculative_generate
+from chimera_llama_grpc.llama.stopping import Stop, StopCriteria
 from chimera_llama_grpc.llama.tokenizer import Tokenizer
 
 Role = Literal["system", "user", "assistant"]
@@ -48,6 +64,42 @@ SPECIAL_TAGS = [B_INST, E_INST, "<<SYS>>", "<</SYS>>"]
 UNSAFE_ERROR = "Error: special tags are not allowed as part of the prompt."
 
 
+CUDA_TENSOR_TYPES = {
+    torch.float16: torch.cuda.HalfTensor,
+    torch.bfloat16: torch.cuda.BFloat16Tensor,
+    torch.float32: torch.cuda.FloatTensor,
+}
+
+
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_dtype(
+    device: Union[str, torch.device], dtype: Union[str, torch.dtype, None]
+) -> torch.dtype:
+    """
+    Parameter dtype for a device, float16 on CUDA and bfloat16 on CPU unless given.
+
+    Args:
+        device (Union[str, torch.device]): Device the model runs on.
+        dtype (Union[str, torch.dtype, None]): A torch dtype or its name, e.g. "bfloat16".
+
+    Returns:
+        torch.dtype: The resolved dtype.
+
+    Raises:
+        ValueError: If dtype is not float16, bfloat16 or float32.
+    """
+    if dtype is None:
+        return torch.float16 if torch.device(device).type == "cuda" else torch.bfloat16
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype, None)
+    if dtype not in CUDA_TENSOR_TYPES:
+        raise ValueError(f"Unsupported dtype: {dtype}")
+    return dtype
+
+
 class Llama:
     @staticmethod
     def build(
@@ -57,6 +109,19 @@ class Llama:
         max_batch_size: int,
         model_parallel_size: Optional[int] = None,
         seed: int = 1,
+        kv_block_size: int = 0,
+        kv_num_blocks: Optional[int] = None,
+        prefix_cache_bytes: int = 0,
+        prefill_chunk_size: int = 0,
+        kv_cache_dtype: Optional[str] = None,
+        rope_scaling: Optional[str] = None,
+        rope_scaling_factor: float = 1.0,
+        device: Optional[str] = None,
+        dtype: Union[str, torch.dtype, None] = None,
+        draft_ckpt_dir: Optional[str] = None,
+        num_speculative_tokens: int = 4,
+        mmap: bool = True,
+        on_progress: Optional[Callable[[str, float], None]] = None,
     ) -> "Llama":
         """
         Build a Llama instance by initializing and loading a pre-trained model.
@@ -68,6 +133,32 @@ class Llama:
             max_batch_size (int): Maximum batch size for inference.
             model_parallel_size (Optional[int], optional): Number of model parallel processes.
                 If not provided, it's determined from the environment. Defaults to None.
+            kv_block_size (int, optional): Positions per block of the paged KV cache, 0 keeps the
+                dense per-row cache. Defaults to 0.
+            kv_num_blocks (Optional[int], optional): Number of blocks in the paged KV cache pool.
+                Defaults to as many positions as the dense cache would reserve.
+            prefix_cache_bytes (int, optional): Paged KV cache memory the scheduler may keep to reuse
+                prompt prefixes across requests, requires kv_block_size. Defaults to 0 (disabled).
+            prefill_chunk_size (int, optional): Prompt tokens per prefill forward pass, bounds how
+                long a long prompt stalls the decode steps of other sequences. Defaults to 0 (the
+                whole prompt at once).
+            kv_cache_dtype (Optional[str], optional): "int8" or "fp8" quantizes the KV cache with
+                per-head scales, about halving it in float16. Defaults to None (the model dtype).
+            rope_scaling (Optional[str], optional): "linear" or "ntk" RoPE scaling, to serve a
+                max_seq_len beyond the context the model was trained on. Defaults to None.
+            rope_scaling_factor (float, optional): Context extension factor of rope_scaling, e.g.
+                2.0 for 8192 tokens with Llama 2. Defaults to 1.0.
+            device (Optional[str], optional): "cuda" or "cpu". Defaults to CUDA when available.
+            dtype (Union[str, torch.dtype, None], optional): Parameter dtype, e.g. "bfloat16" or
+                "float32". Defaults to float16 on CUDA and bfloat16 on CPU.
+            draft_ckpt_dir (Optional[str], optional): Checkpoint of a smaller model sharing the
+                tokenizer, enables speculative decoding in generate. Defaults to None.
+            num_speculative_tokens (int, optional): Tokens the draft model proposes per round.
+                Defaults to 4.
+            mmap (bool, optional): Memory map the checkpoint and stream it into the parameters
+                instead of reading it into host memory first. Defaults to True.
+            on_progress (Optional[Callable[[str, float], None]], optional): Called with the load
+                phase ("init", "open", "copy") and the fraction of it done. Defaults to None.
 
         Returns:
             Llama: An instance of the Llama class with the loaded model and tokenizer.
@@ -77,19 +168,23 @@ class Llama:
                 or if the model parallel size does not match the number of checkpoint files.
 
         Note:
-            This method initializes the distributed process group, sets the device to CUDA,
-            and loads the pre-trained model and tokenizer.
+            This method initializes the distributed process group (NCCL on CUDA, gloo on CPU), sets
+            the device and loads the pre-trained model and tokenizer.
 
         """
+        device = torch.device(device or default_device())
+        dtype = resolve_dtype(device, dtype)
         if not torch.distributed.is_initialized():
-            torch.distributed.init_process_group("nccl")
+            torch.distributed.init_process_group("nccl" if device.type == "cuda" else "gloo")
         if not model_parallel_is_initialized():
             if model_parallel_size is None:
                 model_parallel_size = int(os.environ.get("WORLD_SIZE", 1))
             initialize_model_parallel(model_parallel_size)
+        model_parallel_size = get_model_parallel_world_size()
 
         local_rank = int(os.environ.get("LOCAL_RANK", 0))
-        torch.cuda.set_device(local_rank)
+        if device.type == "cuda":
+            torch.cuda.set_device(local_rank)
 
         # seed must be the same in all processes
         torch.manual_seed(seed)
@@ -104,48 +199,126 @@ class Llama:
             checkpoints
         ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {model_parallel_size}"
         ckpt_path = checkpoints[get_model_parallel_rank()]
-        checkpoint = torch.load(ckpt_path, map_location="cpu")
         with open(Path(ckpt_dir) / "params.json", "r") as f:
             params = json.loads(f.read())
 
         model_args: ModelArgs = ModelArgs(
             max_seq_len=max_seq_len,
             max_batch_size=max_batch_size,
+            kv_block_size=kv_block_size,
+            kv_num_blocks=kv_num_blocks,
+            prefix_cache_bytes=prefix_cache_bytes,
+            prefill_chunk_size=prefill_chunk_size,
+            kv_cache_dtype=kv_cache_dtype,
+            rope_scaling=rope_scaling,
+            rope_scaling_factor=rope_scaling_factor,
             **params,
         )
         tokenizer = Tokenizer(model_path=tokenizer_path)
         model_args.vocab_size = tokenizer.n_words
-        torch.set_default_tensor_type(torch.cuda.HalfTensor)
+        if device.type == "cuda":
+            torch.set_default_tensor_type(CUDA_TENSOR_TYPES[dtype])
+        else:
+            torch.set_default_dtype(dtype)
+        init_time = time.time()
+        if on_progress is not None:
+            on_progress("init", 0.0)
         model = Transformer(model_args)
-        model.load_state_dict(checkpoint, strict=False)
-        print(f"Loaded in {time.time() - start_time:.2f} seconds")
+        load_timings = {"init": time.time() - init_time}
+        load_timings.update(load_checkpoint(model, ckpt_path, mmap=mmap, on_progress=on_progress))
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in load_timings.items())
+        print(f"Loaded in {time.time() - start_time:.2f} seconds ({phases})")
+
+        draft = None
+        if draft_ckpt_dir is not None:
+            draft = Llama.build(
+                draft_ckpt_dir,
+                tokenizer_path,
+                max_seq_len,
+                max_batch_size,
+                model_parallel_size=model_parallel_size,
+                seed=seed,
+                kv_block_size=kv_block_size,
+                kv_num_blocks=kv_num_blocks,
+                kv_cache_dtype=kv_cache_dtype,
+                rope_scaling=rope_scaling,
+                rope_scaling_factor=rope_scaling_factor,
+                device=device,
+                dtype=dtype,
+                mmap=mmap,
+                on_progress=on_progress,
+            )
+        llama = Llama(model, tokenizer, draft=draft, num_speculative_tokens=num_speculative_tokens)
+        llama.load_timings = load_timings
+        return llama
+
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        draft: Optional["Llama"] = None,
+        num_speculative_tokens: int = 4,
+    ):
+        """
+        Initialize a Llama.
 
-        return Llama(model, tokenizer)
+        Args:
+            model (Transformer): The target model.
+            tokenizer (Tokenizer): Tokenizer shared by the target and the draft model.
+            draft (Optional[Llama], optional): Draft model for speculative decoding. Defaults to None.
+            num_speculative_tokens (int, optional): Tokens the draft proposes per round. Defaults to 4.
 
-    def __init__(self, model: Transformer, tokenizer: Tokenizer):
+        Attributes:
+            speculative_stats (SpeculativeStats): Acceptance and throughput of speculative decoding.
+            load_timings (Dict[str, float]): Seconds spent in each phase of Llama.build, empty for
+                models built otherwise.
+
+        """
         self.model = model
         self.tokenizer = tokenizer
+        if draft is not None and draft.model.vocab_size != model.vocab_size:
+            raise ValueError(
+                f"Draft vocab size {draft.model.vocab_size} != target vocab size {model.vocab_size}"
+            )
+        self.draft = draft
+        self.num_speculative_tokens = num_speculative_tokens
+        self.speculative_stats = SpeculativeStats()
+        self.load_timings: Dict[str, float] = {}
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.tok_embeddings.weight.device
 
     @torch.inference_mode()
     def generate(
         self,
         prompt_tokens: List[List[int]],
-        max_gen_len: int,
-        temperature: float = 0.6,
-        top_p: float = 0.9,
+        max_gen_len: Union[int, Sequence[int]],
+        temperature: Union[float, Sequence[float]] = 0.6,
+        top_p: Union[float, Sequence[float]] = 0.9,
         logprobs: bool = False,
         echo: bool = False,
+        seeds: Optional[Sequence[Optional[int]]] = None,
+        top_k: Union[int, Sequence[int]] = 0,
+        min_p: Union[float, Sequence[float]] = 0.0,
+        stop: Optional[Sequence[Stop]] = None,
+        stop_token_ids: Optional[Sequence[Optional[Sequence[int]]]] = None,
     ) -> Tuple[List[List[int]], Optional[List[List[float]]]]:
         """
         Generate text sequences based on provided prompts using the language generation model.
 
         Args:
             prompt_tokens (List[List[int]]): List of tokenized prompts, where each prompt is represented as a list of integers.
-            max_gen_len (int): Maximum length of the generated text sequence.
-            temperature (float, optional): Temperature value for controlling randomness in sampling. Defaults to 0.6.
-            top_p (float, optional): Top-p probability threshold for nucleus sampling. Defaults to 0.9.
+            max_gen_len (Union[int, Sequence[int]]): Maximum length of the generated text sequence, shared or one per prompt.
+            temperature (Union[float, Sequence[float]], optional): Temperature value for controlling randomness in sampling, shared or one per prompt. Defaults to 0.6.
+            top_p (Union[float, Sequence[float]], optional): Top-p probability threshold for nucleus sampling, shared or one per prompt. Defaults to 0.9.
             logprobs (bool, optional): Flag indicating whether to compute token log probabilities. Defaults to False.
             echo (bool, optional): Flag indicating whether to include prompt tokens in the generated output. Defaults to False.
+            seeds (Sequence[Optional[int]], optional): Random seed of every prompt, a seeded prompt samples the same tokens whatever else is in the batch. Defaults to None.
+            top_k (Union[int, Sequence[int]], optional): Sample from the top_k most likely tokens only, 0 disables it. Defaults to 0.
+            min_p (Union[float, Sequence[float]], optional): Drop tokens less likely than min_p times the most likely one, 0 disables it. Defaults to 0.0.
+            stop (Sequence[Stop], optional): Stop strings of every prompt, a row stops on the token completing one of them and keeps it, see stopping.truncate_at_stop for the text. Defaults to None.
+            stop_token_ids (Sequence[Optional[Sequence[int]]], optional): Stop token IDs of every prompt, a row stops on one of them like on EOS. Defaults to None.
 
         Returns:
             Tuple[List[List[int]], Optional[List[List[float]]]]: A tuple containing generated token sequences and, if logprobs is True, corresponding token log probabilities.
@@ -153,70 +326,226 @@ class Llama:
         Note:
             This method uses the provided prompts as a basis for generating text. It employs nucleus sampling to produce text with controlled randomness.
             If logprobs is True, token log probabilities are computed for each generated token.
+            Prompts of different lengths are prefilled together in one pass, then every row decodes at its own position.
+            With a draft model attached, generation is speculative unless logprobs are requested.
+            Seeds, top_k and min_p are not used by speculative decoding.
 
         """
         params = self.model.params
         bsz = len(prompt_tokens)
         assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
 
-        min_prompt_len = min(len(t) for t in prompt_tokens)
         max_prompt_len = max(len(t) for t in prompt_tokens)
         assert max_prompt_len <= params.max_seq_len
-        total_len = min(params.max_seq_len, max_gen_len + max_prompt_len)
+        max_gen_lens = row_params(max_gen_len, bsz)
+        total_len = min(
+            params.max_seq_len, max(len(t) + n for t, n in zip(prompt_tokens, max_gen_lens))
+        )
 
+        device = self.device
+        temperatures = row_params(temperature, bsz)
+        greedy = all(t == 0 for t in temperatures)
+        temperature = torch.tensor(temperatures, device=device)
+        top_p = torch.tensor(row_params(top_p, bsz), device=device)
+        top_ks, min_ps = row_params(top_k, bsz), row_params(min_p, bsz)
+        top_k = torch.tensor(top_ks, device=device) if any(top_ks) else None
+        min_p = torch.tensor(min_ps, device=device) if any(min_ps) else None
+        generators = None
+        if seeds is not None and any(seed is not None for seed in row_params(seeds, bsz)):
+            generators = [
+                None if seed is None else torch.Generator(device=device).manual_seed(seed)
+                for seed in row_params(seeds, bsz)
+            ]
+        criteria = None
+        if stop is not None or stop_token_ids is not None:
+            criteria = [
+                StopCriteria(self.tokenizer, row_stop, row_stop_token_ids)
+                for row_stop, row_stop_token_ids in zip(
+                    [None] * bsz if stop is None else row_params(stop, bsz),
+                    [None] * bsz if stop_token_ids is None else row_params(stop_token_ids, bsz),
+                )
+            ]
+        if self.draft is not None and not logprobs:
+            out_tokens = speculative_generate(
+                self,
+                prompt_tokens,
+                max_gen_lens,
+                temperature,
+                top_p,
+                self.num_speculative_tokens,
+                self.speculative_stats,
+            )
+            if criteria is not None:
+                out_tokens = [c.truncate(t) for c, t in zip(criteria, out_tokens)]
+            if echo:
+                out_tokens = [p + t for p, t in zip(prompt_tokens, out_tokens)]
+            return out_tokens, None
+
+        # a row is done once it generated max_gen_len tokens or reached max_seq_len
+        prompt_lens = [len(t) for t in prompt_tokens]
+        end_pos = [min(total_len, n + g) for n, g in zip(prompt_lens, max_gen_lens)]
         pad_id = self.tokenizer.pad_id
-        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device="cuda")
+        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device=device)
         for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
+            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device=device)
         if logprobs:
             token_logprobs = torch.zeros_like(tokens, dtype=torch.float)
-
-        prev_pos = 0
-        eos_reached = torch.tensor([False] * bsz, device="cuda")
-        input_text_mask = tokens != pad_id
-        if min_prompt_len == total_len:
-            logits = self.model.forward(tokens, prev_pos)
-            token_logprobs = -F.cross_entropy(
-                input=logits.transpose(1, 2),
-                target=tokens,
-                reduction="none",
-                ignore_index=pad_id,
+        block_manager = self.model.block_manager
+        if block_manager is not None:
+            # the prefill writes every row up to the longest prompt
+            for row in range(bsz):
+                block_manager.allocate(row, max(max_prompt_len, end_pos[row]))
+
+        # stop token IDs are matched on the device, padded with -1, stop strings need the text of
+        # every row on the host so the sampled tokens are read one step late like the done flags
+        stop_ids = None
+        if criteria is not None and any(c.stop_token_ids for c in criteria):
+            width = max(len(c.stop_token_ids) for c in criteria)
+            stop_ids = torch.tensor(
+                [
+                    sorted(c.stop_token_ids) + [-1] * (width - len(c.stop_token_ids))
+                    for c in criteria
+                ],
+                dtype=torch.long,
+                device=device,
             )
-
-        for cur_pos in range(min_prompt_len, total_len):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
-            if temperature > 0:
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
-
-            next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token)
-            tokens[:, cur_pos] = next_token
+        check_stop_strings = criteria is not None and any(c.stop for c in criteria)
+        pending_tokens: Optional[Tuple[List[int], int, HostCopy]] = None
+        # end of the output of a row: after the token completing a stop string, or before the first
+        # EOS or stop token, which are never fed to the stop strings
+        stop_end: List[Optional[int]] = [None] * bsz
+
+        # every prompt is prefilled from position 0 in a single pass, or prefill_chunk_size tokens
+        # at a time, shorter prompts are padded: causal attention keeps the padding out of their
+        # prompt, and decoding overwrites it before any later position can attend to it
+        last_pos = torch.tensor([n - 1 for n in prompt_lens], device=device)
+        prefill_tokens = tokens[:, :max_prompt_len]
+        prefill_tokens = prefill_tokens.masked_fill(prefill_tokens == pad_id, 0)
+        chunk = params.prefill_chunk_size or max_prompt_len
+        logits = None
+        for prev_pos in range(0, max_prompt_len, chunk):
+            cur_pos = min(prev_pos + chunk, max_prompt_len)
+            with PROFILER.phase("prefill"):
+                chunk_logits = self.model.forward(prefill_tokens[:, prev_pos:cur_pos], prev_pos)
+            # the logits at the last prompt position of every row predict its first token
+            index = (last_pos - prev_pos).clamp(0, cur_pos - prev_pos - 1)
+            row_logits = chunk_logits[torch.arange(bsz, device=device), index]
+            if logits is not None:
+                row_logits = torch.where((last_pos >= prev_pos)[:, None], row_logits, logits)
+            logits = row_logits
             if logprobs:
+                target = tokens[:, prev_pos + 1 : cur_pos + 1]
                 token_logprobs[:, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
-                    input=logits.transpose(1, 2),
-                    target=tokens[:, prev_pos + 1 : cur_pos + 1],
+                    input=chunk_logits[:, : target.shape[1]].transpose(1, 2),
+                    target=target,
                     reduction="none",
                     ignore_index=pad_id,
                 )
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (next_token == self.tokenizer.eos_id)
-            prev_pos = cur_pos
-            if all(eos_reached):
-                break
 
+        # rows that are still decoding, finished rows are compacted out of the batch and release
+        # their KV cache blocks
+        active_rows = [row for row in range(bsz) if prompt_lens[row] < end_pos[row]]
+        if block_manager is not None:
+            for row in range(bsz):
+                if prompt_lens[row] >= end_pos[row]:
+                    block_manager.free(row)
+        active = torch.tensor(active_rows, dtype=torch.long, device=device)
+        logits = logits[active]
+        # position of the last token of every row, all rows advance by one per step
+        cur_pos = last_pos.clone()
+        eos_reached = torch.tensor([False] * bsz, device=device)
+        # finished flags of the previous step, read one step late so the host never waits for the
+        # step it just launched
+        pending_done: Optional[HostCopy] = None
+        step = 0
+        while active_rows:
+            if step > 0:
+                positions = cur_pos[active]
+                # the last token of a row sits at prompt_lens[row] + step - 1
+                kv_len = max(prompt_lens[row] for row in active_rows) + step
+                with PROFILER.phase("decode_step"):
+                    logits = self.model.forward(
+                        tokens[active, positions][:, None], positions, slots=active, kv_len=kv_len
+                    )[:, -1]
+            with PROFILER.phase("sample"):
+                if greedy:
+                    next_token = torch.argmax(logits, dim=-1)
+                else:
+                    next_token = sample(
+                        logits,
+                        temperature[active],
+                        top_p[active],
+                        None if generators is None else [generators[row] for row in active_rows],
+                        top_k=None if top_k is None else top_k[active],
+                        min_p=None if min_p is None else min_p[active],
+                    )
+
+            next_token = next_token.reshape(-1)
+            cur_pos[active] += 1
+            tokens[active, cur_pos[active]] = next_token
+            if logprobs:
+                token_logprobs[active, cur_pos[active]] = -F.cross_entropy(
+                    logits, next_token, reduction="none"
+                )
+            is_stop = next_token == self.tokenizer.eos_id
+            if stop_ids is not None:
+                is_stop |= (next_token[:, None] == stop_ids[active]).any(dim=-1)
+            done = eos_reached[active] | is_stop
+            eos_reached[active] = done
+
+            if pending_tokens is not None:
+                stopped = []
+                rows, pos, pending = pending_tokens
+                for row, token in zip(rows, pending.tolist()):
+                    if stop_end[row] is not None:
+                        continue
+                    if token == self.tokenizer.eos_id or criteria[row].is_stop_token(token):
+                        stop_end[row] = prompt_lens[row] + pos
+                    elif criteria[row].push(token):
+                        stop_end[row] = prompt_lens[row] + pos + 1
+                        stopped.append(row)
+                if stopped:
+                    eos_reached[torch.tensor(stopped, device=device)] = True
+                    done = eos_reached[active]
+            if check_stop_strings:
+                pending_tokens = (active_rows, step, HostCopy(next_token))
+
+            # rows at their end position are known on the host, EOS and stop tokens a step later
+            finished = [prompt_lens[row] + step + 1 >= end_pos[row] for row in active_rows]
+            if pending_done is not None:
+                finished = [f or d for f, d in zip(finished, pending_done.tolist())]
+            if any(finished):
+                for row, row_done in zip(active_rows, finished):
+                    if row_done and block_manager is not None:
+                        block_manager.free(row)
+                active_rows = [row for row, d in zip(active_rows, finished) if not d]
+                active = torch.tensor(active_rows, dtype=torch.long, device=device)
+                done = eos_reached[active]
+            pending_done = HostCopy(done)
+            step += 1
+
+        if block_manager is not None:
+            for row in active_rows:
+                block_manager.free(row)
         if logprobs:
             token_logprobs = token_logprobs.tolist()
         out_tokens, out_logprobs = [], []
         for i, toks in enumerate(tokens.tolist()):
             # cut to max gen len
             start = 0 if echo else len(prompt_tokens[i])
-            toks = toks[start : len(prompt_tokens[i]) + max_gen_len]
+            toks = toks[start : end_pos[i]]
             probs = None
             if logprobs:
-                probs = token_logprobs[i][start : len(prompt_tokens[i]) + max_gen_len]
+                probs = token_logprobs[i][start : end_pos[i]]
+            # cut to the first stop token or after the first stop string if any
+            if criteria is not None:
+                end = len(toks) if stop_end[i] is None else stop_end[i] - start
+                for j in range(len(prompt_tokens[i]) - start, end):
+                    if criteria[i].is_stop_token(toks[j]):
+                        end = j
+                        break
+                toks = toks[:end]
+                probs = probs[:end] if logprobs else None
             # cut to eos tok if any
             if self.tokenizer.eos_id in toks:
                 eos_idx = toks.index(self.tokenizer.eos_id)
@@ -257,7 +586,7 @@ class Llama:
         """
         if max_gen_len is None:
             max_gen_len = self.model.params.max_seq_len - 1
-        prompt_tokens = [self.tokenizer.encode(x, bos=True, eos=False) for x in prompts]
+        prompt_tokens = self.tokenizer.encode_batch(prompts, bos=True, eos=False)
         generation_tokens, generation_logprobs = self.generate(
             prompt_tokens=prompt_tokens,
             max_gen_len=max_gen_len,
@@ -266,16 +595,70 @@ class Llama:
             logprobs=logprobs,
             echo=echo,
         )
+        generations = self.tokenizer.decode_batch(generation_tokens)
         if logprobs:
             return [
                 {
-                    "generation": self.tokenizer.decode(t),
-                    "tokens": [self.tokenizer.decode(x) for x in t],
+                    "generation": generation,
+                    "tokens": self.tokenizer.token_texts(t),
                     "logprobs": logprobs_i,
                 }
-                for t, logprobs_i in zip(generation_tokens, generation_logprobs)
+                for generation, t, logprobs_i in zip(
+                    generations, generation_tokens, generation_logprobs
+                )
             ]
-        return [{"generation": self.tokenizer.decode(t)} for t in generation_tokens]
+        return [{"generation": generation} for generation in generations]
+
+    def encode_dialog(self, dialog: Dialog) -> List[int]:
+        """
+        Encode a dialog into prompt tokens with the Llama 2 chat template.
+
+        Args:
+            dialog (Dialog): A conversational dialog, i.e. a list of messages.
+
+        Returns:
+            List[int]: Prompt tokens ready for generation.
+
+        Raises:
+            AssertionError: If the last message in the dialog is not from the user.
+            AssertionError: If the dialog roles are not in the required 'user', 'assistant', and optional 'system' order.
+
+        """
+        if dialog[0]["role"] == "system":
+            dialog = [
+                {
+                    "role": dialog[1]["role"],
+                    "content": B_SYS + dialog[0]["content"] + E_SYS + dialog[1]["content"],
+                }
+            ] + dialog[2:]
+        assert all([msg["role"] == "user" for msg in dialog[::2]]) and all(
+            [msg["role"] == "assistant" for msg in dialog[1::2]]
+        ), (
+            "model only supports 'system', 'user' and 'assistant' roles, "
+            "starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
+        )
+        assert (
+            dialog[-1]["role"] == "user"
+        ), f"Last message must be from user, got {dialog[-1]['role']}"
+        # every turn is encoded on its own, so earlier turns hit the tokenizer cache when a
+        # conversation comes back with one more turn
+        turns = self.tokenizer.encode_batch(
+            [
+                f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} "
+                for prompt, answer in zip(dialog[::2], dialog[1::2])
+            ],
+            bos=True,
+            eos=True,
+        )
+        dialog_tokens: List[int] = []
+        for turn in turns:
+            dialog_tokens.extend(turn)
+        dialog_tokens += self.tokenizer.encode(
+            f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST}",
+            bos=True,
+            eos=False,
+        )
+        return dialog_tokens
 
     def chat_completion(
         self,
@@ -311,48 +694,8 @@ class Llama:
         """
         if max_gen_len is None:
             max_gen_len = self.model.params.max_seq_len - 1
-        prompt_tokens = []
-        unsafe_requests = []
-        for dialog in dialogs:
-            unsafe_requests.append(
-                any([tag in msg["content"] for tag in SPECIAL_TAGS for msg in dialog])
-            )
-            if dialog[0]["role"] == "system":
-                dialog = [
-                    {
-                        "role": dialog[1]["role"],
-                        "content": B_SYS + dialog[0]["content"] + E_SYS + dialog[1]["content"],
-                    }
-                ] + dialog[2:]
-            assert all([msg["role"] == "user" for msg in dialog[::2]]) and all(
-                [msg["role"] == "assistant" for msg in dialog[1::2]]
-            ), (
-                "model only supports 'system', 'user' and 'assistant' roles, "
-                "starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
-            )
-            dialog_tokens: List[int] = sum(
-                [
-                    self.tokenizer.encode(
-                        f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} ",
-                        bos=True,
-                        eos=True,
-                    )
-                    for prompt, answer in zip(
-                        dialog[::2],
-                        dialog[1::2],
-                    )
-                ],
-                [],
-            )
-            assert (
-                dialog[-1]["role"] == "user"
-            ), f"Last message must be from user, got {dialog[-1]['role']}"
-            dialog_tokens += self.tokenizer.encode(
-                f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST}",
-                bos=True,
-                eos=False,
-            )
-            prompt_tokens.append(dialog_tokens)
+        prompt_tokens = [self.encode_dialog(dialog) for dialog in dialogs]
+        unsafe_requests = [is_unsafe_dialog(dialog) for dialog in dialogs]
 
         generation_tokens, generation_logprobs = self.generate(
             prompt_tokens=prompt_tokens,
@@ -361,38 +704,61 @@ class Llama:
             top_p=top_p,
             logprobs=logprobs,
         )
+        contents = [
+            UNSAFE_ERROR if unsafe else generation
+            for generation, unsafe in zip(
+                self.tokenizer.decode_batch(generation_tokens), unsafe_requests
+            )
+        ]
         if logprobs:
             return [
                 {
-                    "generation": {
-                        "role": "assistant",
-                        "content": self.tokenizer.decode(t) if not unsafe else UNSAFE_ERROR,
-                    },
-                    "tokens": [self.tokenizer.decode(x) for x in t],
+                    "generation": {"role": "assistant", "content": content},
+                    "tokens": self.tokenizer.token_texts(t),
                     "logprobs": logprobs_i,
                 }
-                for t, logprobs_i, unsafe in zip(
-                    generation_tokens, generation_logprobs, unsafe_requests
-                )
+                for content, t, logprobs_i in zip(contents, generation_tokens, generation_logprobs)
             ]
-        return [
-            {
-                "generation": {
-                    "role": "assistant",
-                    "content": self.tokenizer.decode(t) if not unsafe else UNSAFE_ERROR,
-                }
-            }
-            for t, unsafe in zip(generation_tokens, unsafe_requests)
-        ]
+        return [{"generation": {"role": "assistant", "content": content}} for content in contents]
+
+
+def is_unsafe_dialog(dialog: Dialog) -> bool:
+    """Whether any message of the dialog smuggles in the special tags of the chat template."""
+    return any([tag in msg["content"] for tag in SPECIAL_TAGS for msg in dialog])
+
 
+class HostCopy:
+    """A device to host copy that only blocks when its value is read."""
 
-def sample_top_p(probs, p):
+    def __init__(self, tensor: torch.Tensor):
+        self.event = None
+        if tensor.is_cuda:
+            self.value = tensor.to("cpu", non_blocking=True)
+            self.event = torch.cuda.Event()
+            self.event.record()
+        else:
+            self.value = tensor
+
+    def tolist(self) -> list:
+        if self.event is not None:
+            self.event.synchronize()
+        return self.value.tolist()
+
+
+def sample_top_p(
+    probs: torch.Tensor,
+    p: Union[float, torch.Tensor],
+    generators: Optional[Sequence[Optional[torch.Generator]]] = None,
+) -> torch.Tensor:
     """
     Perform top-p (nucleus) sampling on a probability distribution.
 
     Args:
-        probs (torch.Tensor): Probability distribution tensor.
-        p (float): Probability threshold for top-p sampling.
+        probs (torch.Tensor): Probability distribution tensor of shape (bsz, vocab_size).
+        p (Union[float, torch.Tensor]): Probability threshold for top-p sampling, shared or one per
+            row of shape (bsz,).
+        generators (Sequence[Optional[torch.Generator]], optional): One random generator per row,
+            see multinomial. Defaults to None.
 
     Returns:
         torch.Tensor: Sampled token indices.
@@ -404,9 +770,21 @@ def sample_top_p(probs, p):
     """
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
+    if isinstance(p, torch.Tensor):
+        p = p.to(probs_sum).reshape(-1, 1)
     mask = probs_sum - probs_sort > p
     probs_sort[mask] = 0.0
     probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    next_token = torch.multinomial(probs_sort, num_samples=1)
+    next_token = multinomial(probs_sort, generators)
     next_token = torch.gather(probs_idx, -1, next_token)
     return next_token
+
+
+def row_params(value: Union[float, Sequence[float]], bsz: int) -> List[float]:
+    """Broadcast a scalar sampling parameter to a list with one value per row."""
+    if isinstance(value, (int, float)):
+        return [value] * bsz
+    value = list(value)
+    if len(value) != bsz:
+        raise ValueError(f"Expected {bsz} per-row values, got {len(value)}")
+    return value
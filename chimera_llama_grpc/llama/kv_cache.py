@@ -0,0 +1,582 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import torch
+from torch import nn
+
+Rows = Union[slice, torch.Tensor]
+
+# storage dtype of a quantized KV cache and the largest magnitude it represents, torch<2.1 has no
+# float8 dtypes
+KV_CACHE_DTYPES = {
+    "int8": (torch.int8, 127.0),
+    "fp8": (getattr(torch, "float8_e4m3fn", None), 448.0),
+}
+
+
+def check_kv_cache_dtype(kv_cache_dtype: Optional[str]) -> None:
+    if kv_cache_dtype is None:
+        return
+    if kv_cache_dtype not in KV_CACHE_DTYPES:
+        raise ValueError(
+            f"kv_cache_dtype must be one of {tuple(KV_CACHE_DTYPES)} or None, got {kv_cache_dtype}"
+        )
+    if KV_CACHE_DTYPES[kv_cache_dtype][0] is None:
+        raise ValueError(
+            f"kv_cache_dtype={kv_cache_dtype!r} needs torch>=2.1, found torch {torch.__version__}"
+        )
+
+
+def quantize_kv(x: torch.Tensor, kv_cache_dtype: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantize keys or values with one absmax scale per position and head.
+
+    Args:
+        x (torch.Tensor): Keys or values of shape (..., n_kv_heads, head_dim).
+        kv_cache_dtype (str): "int8" or "fp8" (float8_e4m3fn).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Quantized tensor of the shape of x and scales of shape
+            (..., n_kv_heads, 1) in the dtype of x.
+    """
+    dtype, max_value = KV_CACHE_DTYPES[kv_cache_dtype]
+    # round the scales to their storage dtype first so dequantization uses exactly them
+    scales = (x.abs().amax(dim=-1, keepdim=True).float() / max_value).clamp(min=1e-6).to(x.dtype)
+    q = x.float() / scales.float()
+    if dtype == torch.int8:
+        q = q.round()
+    # float8_e4m3fn has no infinity, out of range values would turn into NaN
+    return q.clamp(-max_value, max_value).to(dtype), scales
+
+
+def dequantize_kv(q: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Inverse of quantize_kv in dtype."""
+    return q.to(dtype) * scales.to(dtype)
+
+
+def _register_kv_buffers(cache: nn.Module, names: Tuple[str, str], shape: Tuple[int, ...]) -> None:
+    """Allocate the key and value buffers of cache, with their scales when it is quantized."""
+    dtype = None
+    if cache.kv_cache_dtype is not None:
+        dtype = KV_CACHE_DTYPES[cache.kv_cache_dtype][0]
+    for name, scale_name in zip(names, ("scale_k", "scale_v")):
+        cache.register_buffer(name, torch.zeros(shape, dtype=dtype), persistent=False)
+        scales = None if dtype is None else torch.zeros(shape[:-1] + (1,))
+        cache.register_buffer(scale_name, scales, persistent=False)
+
+
+def _kv_writes(
+    cache: nn.Module, names: Tuple[str, str], xk: torch.Tensor, xv: torch.Tensor
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Pairs of (buffer, new entries) to write for new keys and values."""
+    keys, values = getattr(cache, names[0]), getattr(cache, names[1])
+    if cache.kv_cache_dtype is None:
+        return [(keys, xk), (values, xv)]
+    qk, sk = quantize_kv(xk, cache.kv_cache_dtype)
+    qv, sv = quantize_kv(xv, cache.kv_cache_dtype)
+    return [(keys, qk), (values, qv), (cache.scale_k, sk), (cache.scale_v, sv)]
+
+
+def cache_positions(
+    bsz: int, seqlen: int, start_pos: Union[int, torch.Tensor], device: torch.device
+) -> torch.Tensor:
+    """
+    Positions written by a forward pass, of shape (bsz, seqlen).
+
+    Args:
+        bsz (int): Batch size.
+        seqlen (int): Number of new tokens per row.
+        start_pos (Union[int, torch.Tensor]): Shared starting position or one per row.
+        device (torch.device): Device of the returned tensor.
+
+    Returns:
+        torch.Tensor: Position of every new token.
+    """
+    offsets = torch.arange(seqlen, device=device)
+    if isinstance(start_pos, int):
+        return (start_pos + offsets).expand(bsz, seqlen)
+    return start_pos.to(device)[:, None] + offsets
+
+
+class DenseKVCache(nn.Module):
+    """
+    Preallocated (max_batch_size, max_seq_len) key/value cache of one attention layer.
+
+    The cache is allocated once with the default dtype and device and kept as non-persistent
+    buffers, so it follows ``model.to()`` and is never cast again while decoding. A quantized cache
+    stores int8 or fp8 entries with one scale per position and head in the default dtype, and
+    dequantizes what it reads back.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        n_kv_heads: int,
+        head_dim: int,
+        kv_cache_dtype: Optional[str] = None,
+    ):
+        """
+        Initialize the DenseKVCache.
+
+        Args:
+            max_batch_size (int): Number of cache rows.
+            max_seq_len (int): Number of positions per row.
+            n_kv_heads (int): Number of local key and value heads.
+            head_dim (int): Dimension size of each attention head.
+            kv_cache_dtype (str, optional): "int8" or "fp8" to quantize the cache. Defaults to None
+                (the default dtype).
+
+        Attributes:
+            cache_k (torch.Tensor): Cached keys.
+            cache_v (torch.Tensor): Cached values.
+            scale_k (Optional[torch.Tensor]): Scales of the quantized keys.
+            scale_v (Optional[torch.Tensor]): Scales of the quantized values.
+
+        """
+        super().__init__()
+        check_kv_cache_dtype(kv_cache_dtype)
+        self.kv_cache_dtype = kv_cache_dtype
+        _register_kv_buffers(
+            self, ("cache_k", "cache_v"), (max_batch_size, max_seq_len, n_kv_heads, head_dim)
+        )
+
+    def update(
+        self,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        rows: Rows,
+        start_pos: Union[int, torch.Tensor],
+        kv_len: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write new keys and values and read back the first kv_len positions of every row.
+
+        Args:
+            xk (torch.Tensor): New keys of shape (bsz, seqlen, n_kv_heads, head_dim).
+            xv (torch.Tensor): New values of shape (bsz, seqlen, n_kv_heads, head_dim).
+            rows (Union[slice, torch.Tensor]): Cache rows of the batch.
+            start_pos (Union[int, torch.Tensor]): Shared starting position or one per row.
+            kv_len (int): Number of positions to read.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Keys and values of shape (bsz, kv_len, n_kv_heads, head_dim).
+
+        """
+        bsz, seqlen = xk.shape[:2]
+        writes = _kv_writes(self, ("cache_k", "cache_v"), xk, xv)
+        if isinstance(start_pos, int):
+            for buffer, value in writes:
+                buffer[rows, start_pos : start_pos + seqlen] = value
+        else:
+            index = torch.arange(bsz, device=xk.device) if isinstance(rows, slice) else rows
+            positions = cache_positions(bsz, seqlen, start_pos, xk.device)
+            for buffer, value in writes:
+                buffer[index[:, None], positions] = value
+
+        keys, values = self.cache_k[rows, :kv_len], self.cache_v[rows, :kv_len]
+        if self.kv_cache_dtype is not None:
+            keys = dequantize_kv(keys, self.scale_k[rows, :kv_len], xk.dtype)
+            values = dequantize_kv(values, self.scale_v[rows, :kv_len], xv.dtype)
+        return keys, values
+
+
+class OutOfBlocks(RuntimeError):
+    pass
+
+
+class BlockManager:
+    """
+    Free-list allocator and per-row block tables shared by the PagedKVCache of every layer.
+
+    The KV cache is split into blocks of block_size positions. A cache row (a batch row or a
+    scheduler slot) only holds blocks for the positions it actually uses, listed in its block table,
+    so short sequences no longer reserve max_seq_len positions each.
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        block_size: int,
+        max_batch_size: int,
+        max_seq_len: int,
+        n_layers: int,
+        n_kv_heads: int,
+        head_dim: int,
+        element_size: int = 2,
+        scale_size: int = 0,
+    ):
+        """
+        Initialize the BlockManager.
+
+        Args:
+            num_blocks (int): Number of blocks in the pool.
+            block_size (int): Number of positions per block.
+            max_batch_size (int): Number of block tables, i.e. cache rows.
+            max_seq_len (int): Maximum number of positions per row.
+            n_layers (int): Number of layers sharing the block tables, for memory accounting.
+            n_kv_heads (int): Number of local key and value heads, for memory accounting.
+            head_dim (int): Dimension size of each attention head, for memory accounting.
+            element_size (int): Bytes per cached element, for memory accounting. Defaults to 2 (fp16).
+            scale_size (int): Bytes of the scale of every position and head of a quantized cache,
+                for memory accounting. Defaults to 0.
+
+        Attributes:
+            block_tables (torch.Tensor): Block IDs of every row, of shape (max_batch_size, max_blocks_per_row).
+
+        """
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.n_layers = n_layers
+        self.n_kv_heads = n_kv_heads
+        self.head_dim = head_dim
+        self.element_size = element_size
+        self.scale_size = scale_size
+
+        self.max_blocks_per_row = self.blocks_for(max_seq_len)
+        self.free_blocks: Deque[int] = deque(range(num_blocks))
+        self.ref_counts: List[int] = [0] * num_blocks
+        self.row_blocks: Dict[int, List[int]] = {}
+        self.prefix_cache: Optional["PrefixCache"] = None
+        # unused entries point at block 0, whatever is read from there is masked out
+        self.block_tables = torch.zeros((max_batch_size, self.max_blocks_per_row), dtype=torch.long)
+        # copy of block_tables on the device of the pages, dropped whenever the tables change
+        self._device_block_tables: Optional[torch.Tensor] = None
+
+    def device_block_tables(self, device: torch.device) -> torch.Tensor:
+        """block_tables on device, copied again only after allocate, share or free changed them."""
+        tables = self._device_block_tables
+        if tables is None or tables.device != torch.device(device):
+            tables = self._device_block_tables = self.block_tables.to(device)
+        return tables
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    def blocks_for(self, num_tokens: int) -> int:
+        """Number of blocks holding num_tokens positions."""
+        return -(-num_tokens // self.block_size)
+
+    def blocks_needed(self, row: int, num_tokens: int) -> int:
+        """Number of extra blocks row needs to hold num_tokens positions."""
+        return max(0, self.blocks_for(num_tokens) - len(self.row_blocks.get(row, [])))
+
+    def num_available_blocks(self, needed: int = 0) -> int:
+        """Free blocks, plus the idle prefix cache blocks that could be evicted if needed exceeds them."""
+        available = self.num_free_blocks
+        if needed > available and self.prefix_cache is not None:
+            available += self.prefix_cache.num_evictable()
+        return available
+
+    def can_allocate(self, row: int, num_tokens: int) -> bool:
+        needed = self.blocks_needed(row, num_tokens)
+        return needed <= self.num_available_blocks(needed)
+
+    def allocate(self, row: int, num_tokens: int) -> None:
+        """
+        Make sure row has blocks for its first num_tokens positions.
+
+        Raises:
+            OutOfBlocks: If the pool does not have enough free blocks, nothing is allocated then.
+        """
+        if num_tokens > self.max_seq_len:
+            raise ValueError(f"Cannot hold {num_tokens} positions, max_seq_len={self.max_seq_len}")
+        needed = self.blocks_needed(row, num_tokens)
+        if needed > self.num_available_blocks(needed):
+            raise OutOfBlocks(f"Need {needed} blocks, {self.num_free_blocks} free")
+        if needed > self.num_free_blocks:
+            self.prefix_cache.evict(needed - self.num_free_blocks)
+        blocks = self.row_blocks.setdefault(row, [])
+        if needed:
+            self._device_block_tables = None
+        for _ in range(needed):
+            block = self.free_blocks.popleft()
+            self.ref_counts[block] = 1
+            self.block_tables[row, len(blocks)] = block
+            blocks.append(block)
+
+    def share(self, row: int, blocks: Sequence[int]) -> None:
+        """
+        Start an empty row with blocks already filled by another row, e.g. a cached prompt prefix.
+
+        Shared blocks are reference counted and must never be written to, only full blocks qualify.
+        """
+        assert not self.row_blocks.get(row), f"row {row} already holds blocks"
+        self.row_blocks[row] = list(blocks)
+        self._device_block_tables = None
+        for i, block in enumerate(blocks):
+            self.ref(block)
+            self.block_tables[row, i] = block
+
+    def ref(self, block: int) -> None:
+        self.ref_counts[block] += 1
+
+    def unref(self, block: int) -> None:
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def free(self, row: int) -> None:
+        """Release all blocks of row, blocks nobody else references return to the pool."""
+        for block in self.row_blocks.pop(row, []):
+            self.unref(block)
+        self.block_tables[row].zero_()
+        self._device_block_tables = None
+
+    @property
+    def bytes_per_block(self) -> int:
+        """Bytes of one block over all layers, keys and values."""
+        return (
+            2
+            * self.n_layers
+            * self.block_size
+            * self.n_kv_heads
+            * (self.head_dim * self.element_size + self.scale_size)
+        )
+
+    def memory_report(self) -> Dict[str, float]:
+        """
+        Memory accounting of the paged KV cache over all layers.
+
+        Returns:
+            Dict[str, float]: Pool size, usage and what a dense cache of the same shape would take.
+        """
+        bytes_per_block = self.bytes_per_block
+        used_blocks = self.num_blocks - self.num_free_blocks
+        return {
+            "block_size": self.block_size,
+            "num_blocks": self.num_blocks,
+            "used_blocks": used_blocks,
+            "free_blocks": self.num_free_blocks,
+            "cached_blocks": len(self.prefix_cache) if self.prefix_cache is not None else 0,
+            "active_rows": len(self.row_blocks),
+            "bytes_per_block": bytes_per_block,
+            "reserved_bytes": bytes_per_block * self.num_blocks,
+            "used_bytes": bytes_per_block * used_blocks,
+            "utilization": used_blocks / self.num_blocks if self.num_blocks else 0.0,
+            "dense_equivalent_bytes": bytes_per_block
+            * self.max_blocks_per_row
+            * self.max_batch_size,
+        }
+
+
+class PrefixCache:
+    """
+    Keeps the KV blocks of finished prefills around so later prompts sharing a token prefix, e.g. the
+    same system prompt or an earlier chat turn, only prefill their new suffix.
+
+    Full blocks form a radix tree keyed by (parent block, tokens of the block). The cache holds one
+    reference on every block it indexes; blocks no running row uses are evicted least recently used
+    first, when the budget is exceeded or the BlockManager needs free blocks.
+    """
+
+    def __init__(self, block_manager: BlockManager, max_blocks: int):
+        """
+        Initialize the PrefixCache.
+
+        Args:
+            block_manager (BlockManager): Allocator of the blocks to cache.
+            max_blocks (int): Maximum number of blocks the cache may hold on to.
+
+        """
+        self.block_manager = block_manager
+        self.max_blocks = max_blocks
+        block_manager.prefix_cache = self
+
+        self.nodes: Dict[Tuple[Optional[int], Tuple[int, ...]], int] = {}
+        self.keys: Dict[int, Tuple[Optional[int], Tuple[int, ...]]] = {}
+        self.children: Dict[Optional[int], Set[int]] = {}
+        # every cached block, least recently used first
+        self.lru: "OrderedDict[int, None]" = OrderedDict()
+
+        self.queries = 0
+        self.hits = 0
+        self.query_tokens = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.lru)
+
+    def _blocks_of(self, tokens: Sequence[int], num_blocks: int):
+        block_size = self.block_manager.block_size
+        for i in range(num_blocks):
+            yield tuple(tokens[i * block_size : (i + 1) * block_size])
+
+    def match(self, tokens: Sequence[int]) -> List[int]:
+        """
+        Longest cached prefix of tokens, at least one token is always left to prefill.
+
+        Args:
+            tokens (Sequence[int]): Prompt tokens.
+
+        Returns:
+            List[int]: Cached blocks covering the first len(blocks) * block_size tokens.
+        """
+        blocks: List[int] = []
+        parent = None
+        for block_tokens in self._blocks_of(
+            tokens, (len(tokens) - 1) // self.block_manager.block_size
+        ):
+            block = self.nodes.get((parent, block_tokens))
+            if block is None:
+                break
+            blocks.append(block)
+            parent = block
+        # children become more recent than their parents, so leaves are evicted first
+        for block in blocks:
+            self.lru.move_to_end(block)
+
+        self.queries += 1
+        self.query_tokens += len(tokens)
+        if blocks:
+            self.hits += 1
+            self.hit_tokens += len(blocks) * self.block_manager.block_size
+        return blocks
+
+    def insert(self, tokens: Sequence[int], blocks: Sequence[int]) -> None:
+        """
+        Index the full blocks of a row whose first len(tokens) positions are in the KV cache.
+
+        Args:
+            tokens (Sequence[int]): Tokens whose keys and values have been written.
+            blocks (Sequence[int]): Blocks of the row, in order.
+        """
+        parent = None
+        for block, block_tokens in zip(
+            blocks, self._blocks_of(tokens, len(tokens) // self.block_manager.block_size)
+        ):
+            key = (parent, block_tokens)
+            cached = self.nodes.get(key)
+            if cached is None:
+                if len(self.lru) >= self.max_blocks and not self.evict(1):
+                    return
+                self.nodes[key] = block
+                self.keys[block] = key
+                self.children.setdefault(parent, set()).add(block)
+                self.lru[block] = None
+                self.block_manager.ref(block)
+                cached = block
+            self.lru.move_to_end(cached)
+            parent = cached
+
+    def num_evictable(self) -> int:
+        return sum(1 for block in self.lru if self.block_manager.ref_counts[block] == 1)
+
+    def evict(self, num_blocks: int) -> int:
+        """
+        Drop up to num_blocks least recently used blocks that no row is using.
+
+        Returns:
+            int: Number of blocks returned to the BlockManager.
+        """
+        evicted = 0
+        for block in list(self.lru):
+            if evicted >= num_blocks:
+                break
+            if block in self.lru and self.block_manager.ref_counts[block] == 1:
+                self._remove(block)
+                evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def _remove(self, block: int) -> None:
+        # descendants are keyed by this block id, which is about to be reused
+        for child in list(self.children.pop(block, ())):
+            self._remove(child)
+        key = self.keys.pop(block)
+        del self.nodes[key]
+        self.children.get(key[0], set()).discard(block)
+        del self.lru[block]
+        self.block_manager.unref(block)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Prefix cache metrics.
+
+        Returns:
+            Dict[str, float]: Query and hit counts, hit rate, prefill tokens saved and cache size.
+        """
+        return {
+            "queries": self.queries,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.queries if self.queries else 0.0,
+            "query_tokens": self.query_tokens,
+            "saved_prefill_tokens": self.hit_tokens,
+            "token_hit_rate": self.hit_tokens / self.query_tokens if self.query_tokens else 0.0,
+            "cached_blocks": len(self.lru),
+            "max_blocks": self.max_blocks,
+            "evictions": self.evictions,
+        }
+
+
+class PagedKVCache(nn.Module):
+    """
+    Block-paged key/value cache of one attention layer, addressed through a BlockManager.
+
+    Quantized like DenseKVCache when kv_cache_dtype is set.
+    """
+
+    def __init__(
+        self,
+        block_manager: BlockManager,
+        n_kv_heads: int,
+        head_dim: int,
+        kv_cache_dtype: Optional[str] = None,
+    ):
+        """
+        Initialize the PagedKVCache.
+
+        Args:
+            block_manager (BlockManager): Allocator and block tables shared by all layers.
+            n_kv_heads (int): Number of local key and value heads.
+            head_dim (int): Dimension size of each attention head.
+            kv_cache_dtype (str, optional): "int8" or "fp8" to quantize the cache. Defaults to None.
+
+        Attributes:
+            pages_k (torch.Tensor): Key pages of shape (num_blocks, block_size, n_kv_heads, head_dim).
+            pages_v (torch.Tensor): Value pages of shape (num_blocks, block_size, n_kv_heads, head_dim).
+            scale_k (Optional[torch.Tensor]): Scales of the quantized key pages.
+            scale_v (Optional[torch.Tensor]): Scales of the quantized value pages.
+
+        """
+        super().__init__()
+        check_kv_cache_dtype(kv_cache_dtype)
+        self.block_manager = block_manager
+        self.kv_cache_dtype = kv_cache_dtype
+        shape = (block_manager.num_blocks, block_manager.block_size, n_kv_heads, head_dim)
+        _register_kv_buffers(self, ("pages_k", "pages_v"), shape)
+
+    def update(
+        self,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        rows: Rows,
+        start_pos: Union[int, torch.Tensor],
+        kv_len: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write new keys and values into the pages of their rows and gather the first kv_len positions.
+
+        Same contract as DenseKVCache.update, the rows must have their blocks allocated.
+        """
+        bsz, seqlen = xk.shape[:2]
+        block_size = self.block_manager.block_size
+        block_tables = self.block_manager.device_block_tables(xk.device)[rows]
+
+        positions = cache_positions(bsz, seqlen, start_pos, xk.device)
+        blocks = torch.gather(block_tables, 1, positions // block_size)
+        offsets = positions % block_size
+        for buffer, value in _kv_writes(self, ("pages_k", "pages_v"), xk, xv):
+            buffer[blocks, offsets] = value
+
+        blocks = block_tables[:, : self.block_manager.blocks_for(kv_len)]
+        keys = self.pages_k[blocks].flatten(1, 2)[:, :kv_len]
+        values = self.pages_v[blocks].flatten(1, 2)[:, :kv_len]
+        if self.kv_cache_dtype is not None:
+            keys = dequantize_kv(keys, self.scale_k[blocks].flatten(1, 2)[:, :kv_len], xk.dtype)
+            values = dequantize_kv(values, self.scale_v[blocks].flatten(1, 2)[:, :kv_len], xv.dtype)
+        return keys, values
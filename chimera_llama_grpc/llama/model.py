@@ -1,9 +1,10 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import functools
 import math
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import fairscale.nn.model_parallel.initialize as fs_init
 import torch
@@ -15,6 +16,9 @@ from fairscale.nn.model_parallel.layers import (
 )
 from torch import nn
 
+from chimera_llama_grpc.llama.kv_cache import BlockManager, DenseKVCache, PagedKVCache
+from chimera_llama_grpc.llama.quantization import QuantizedLinear
+
 
 @dataclass
 class ModelArgs:
@@ -30,6 +34,62 @@ class ModelArgs:
     max_batch_size: int = 32
     max_seq_len: int = 2048
 
+    # paged KV cache: positions per block (0 keeps the dense cache) and blocks in the pool,
+    # the pool defaults to as many positions as the dense cache would hold
+    kv_block_size: int = 0
+    kv_num_blocks: Optional[int] = None
+    # paged KV cache memory the scheduler may keep for reusing prompt prefixes, 0 disables it
+    prefix_cache_bytes: int = 0
+    # prompt tokens prefilled per forward pass, the scheduler interleaves the chunks of a long
+    # prompt with decode steps of the running sequences; 0 prefills a prompt in one pass
+    prefill_chunk_size: int = 0
+    # "int8" or "fp8" stores keys and values with one scale per position and head, about halving
+    # the KV cache of a float16 model; None keeps the model dtype
+    kv_cache_dtype: Optional[str] = None
+
+    rope_theta: float = 10000.0
+    # "linear" divides positions by rope_scaling_factor, "ntk" raises rope_theta instead, both
+    # stretch the context the model was trained on by about that factor
+    rope_scaling: Optional[str] = None
+    rope_scaling_factor: float = 1.0
+
+    # "sdpa" uses torch.nn.functional.scaled_dot_product_attention, "eager" the reference
+    # matmul + softmax implementation
+    attention_impl: str = "sdpa"
+
+    # weight-only quantization of the attention and feed-forward projections, "int8" or "int4",
+    # set in params.json by quantize_checkpoint; 0 uses the default group size of the mode
+    quantize: Optional[str] = None
+    quantize_group_size: int = 0
+
+
+def column_parallel_linear(
+    in_features: int,
+    out_features: int,
+    quantize: Optional[str] = None,
+    quantize_group_size: int = 0,
+) -> Union[ColumnParallelLinear, QuantizedLinear]:
+    """A ColumnParallelLinear without bias and gathered output, or its quantized counterpart."""
+    if quantize:
+        return QuantizedLinear(in_features, out_features, quantize, quantize_group_size, "column")
+    return ColumnParallelLinear(
+        in_features, out_features, bias=False, gather_output=False, init_method=lambda x: x
+    )
+
+
+def row_parallel_linear(
+    in_features: int,
+    out_features: int,
+    quantize: Optional[str] = None,
+    quantize_group_size: int = 0,
+) -> Union[RowParallelLinear, QuantizedLinear]:
+    """A RowParallelLinear without bias taking parallel input, or its quantized counterpart."""
+    if quantize:
+        return QuantizedLinear(in_features, out_features, quantize, quantize_group_size, "row")
+    return RowParallelLinear(
+        in_features, out_features, bias=False, input_is_parallel=True, init_method=lambda x: x
+    )
+
 
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim: int, eps: float = 1e-6):
@@ -77,7 +137,17 @@ class RMSNorm(torch.nn.Module):
         return output * self.weight
 
 
-def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
+ROPE_SCALINGS = ("linear", "ntk")
+
+
+def precompute_freqs_cis(
+    dim: int,
+    end: int,
+    theta: float = 10000.0,
+    scaling: Optional[str] = None,
+    scaling_factor: float = 1.0,
+    device: Optional[torch.device] = None,
+):
     """
     Precompute the frequency tensor for complex exponentials (cis) with given dimensions.
 
@@ -89,21 +159,47 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
         dim (int): Dimension of the frequency tensor.
         end (int): End index for precomputing frequencies.
         theta (float, optional): Scaling factor for frequency computation. Defaults to 10000.0.
+        scaling (str, optional): RoPE scaling for contexts longer than the training one, "linear"
+            (position interpolation) or "ntk" (NTK-aware base change). Defaults to None.
+        scaling_factor (float, optional): Context extension factor of the scaling. Defaults to 1.0.
+        device (torch.device, optional): Device of the tensor. Defaults to the default device.
 
     Returns:
         torch.Tensor: Precomputed frequency tensor with complex exponentials.
 
-
-
+    Raises:
+        ValueError: If scaling is not one of ROPE_SCALINGS.
 
     """
-    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
+    if scaling is not None and scaling not in ROPE_SCALINGS:
+        raise ValueError(f"rope_scaling must be one of {ROPE_SCALINGS} or None, got {scaling}")
+    if scaling == "ntk":
+        theta = theta * scaling_factor ** (dim / (dim - 2))
+    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2, device=device)[: (dim // 2)].float() / dim))
     t = torch.arange(end, device=freqs.device)  # type: ignore
+    if scaling == "linear":
+        t = t / scaling_factor
     freqs = torch.outer(t, freqs).float()  # type: ignore
     freqs_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
     return freqs_cis
 
 
+@functools.lru_cache(maxsize=16)
+def cached_freqs_cis(
+    dim: int,
+    end: int,
+    theta: float,
+    device: torch.device,
+    scaling: Optional[str] = None,
+    scaling_factor: float = 1.0,
+) -> torch.Tensor:
+    """
+    precompute_freqs_cis computed once per set of arguments, every layer and every model with the
+    same head dimension, context and RoPE settings shares the tensor. It must not be modified.
+    """
+    return precompute_freqs_cis(dim, end, theta, scaling, scaling_factor, device)
+
+
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     """
     Reshape frequency tensor for broadcasting it with another tensor.
@@ -112,7 +208,8 @@ def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     for the purpose of broadcasting the frequency tensor during element-wise operations.
 
     Args:
-        freqs_cis (torch.Tensor): Frequency tensor to be reshaped.
+        freqs_cis (torch.Tensor): Frequency tensor to be reshaped. Either shared by all rows with shape
+            (seqlen, dim) or gathered per row with shape (bsz, seqlen, dim).
         x (torch.Tensor): Target tensor for broadcasting compatibility.
 
     Returns:
@@ -124,6 +221,10 @@ def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     """
     ndim = x.ndim
     assert 0 <= 1 < ndim
+    if freqs_cis.ndim == 3:
+        # per-row positions: (bsz, seqlen, head_dim // 2)
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis.view(x.shape[0], x.shape[1], *([1] * (ndim - 3)), x.shape[-1])
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
     return freqs_cis.view(*shape)
@@ -173,15 +274,88 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+def _sdpa_supports_gqa() -> bool:
+    """Whether scaled_dot_product_attention broadcasts key/value heads itself (torch >= 2.5)."""
+    try:
+        q, kv = torch.zeros(1, 2, 1, 8), torch.zeros(1, 1, 1, 8)
+        F.scaled_dot_product_attention(q, kv, kv, enable_gqa=True)
+    except (AttributeError, TypeError, RuntimeError):
+        return False
+    return True
+
+
+HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+SDPA_GQA = HAS_SDPA and _sdpa_supports_gqa()
+
+
+def attention(
+    xq: torch.Tensor,
+    keys: torch.Tensor,
+    values: torch.Tensor,
+    mask: Optional[torch.Tensor],
+    impl: str = "sdpa",
+) -> torch.Tensor:
+    """
+    Scaled dot-product attention over the cached keys and values.
+
+    Args:
+        xq (torch.Tensor): Queries of shape (bsz, seqlen, n_heads, head_dim).
+        keys (torch.Tensor): Keys of shape (bsz, kv_len, n_kv_heads, head_dim).
+        values (torch.Tensor): Values of shape (bsz, kv_len, n_kv_heads, head_dim).
+        mask (torch.Tensor, optional): Boolean mask broadcastable to (bsz, 1, seqlen, kv_len), True
+            where a query may attend to a key. None means causal when kv_len == seqlen and no
+            masking at all for a single query.
+        impl (str): "sdpa" or "eager". Defaults to "sdpa".
+
+    Returns:
+        torch.Tensor: Attention output of shape (bsz, seqlen, n_heads * head_dim).
+    """
+    bsz, seqlen, n_heads, head_dim = xq.shape
+    n_rep = n_heads // keys.shape[2]
+    is_causal = mask is None and seqlen > 1
+
+    if impl == "sdpa" and HAS_SDPA:
+        kwargs = {}
+        if n_rep > 1 and SDPA_GQA:
+            kwargs["enable_gqa"] = True
+        else:
+            keys, values = repeat_kv(keys, n_rep), repeat_kv(values, n_rep)
+        output = F.scaled_dot_product_attention(
+            xq.transpose(1, 2),
+            keys.transpose(1, 2),
+            values.transpose(1, 2),
+            attn_mask=mask,
+            is_causal=is_causal,
+            **kwargs,
+        )
+    else:
+        # repeat k/v heads if n_kv_heads < n_heads
+        keys = repeat_kv(keys, n_rep)  # (bs, kv_len, n_heads, head_dim)
+        values = repeat_kv(values, n_rep)  # (bs, kv_len, n_heads, head_dim)
+
+        xq = xq.transpose(1, 2)  # (bs, n_heads, seqlen, head_dim)
+        keys = keys.transpose(1, 2)
+        values = values.transpose(1, 2)
+        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(head_dim)
+        if is_causal:
+            mask = torch.ones(seqlen, seqlen, dtype=torch.bool, device=xq.device).tril()
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float("-inf"))  # (bs, n_heads, seqlen, kv_len)
+        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
+        output = torch.matmul(scores, values)  # (bs, n_heads, seqlen, head_dim)
+    return output.transpose(1, 2).reshape(bsz, seqlen, -1)
+
+
 class Attention(nn.Module):
     """Multi-head attention module."""
 
-    def __init__(self, args: ModelArgs):
+    def __init__(self, args: ModelArgs, block_manager: Optional[BlockManager] = None):
         """
         Initialize the Attention module.
 
         Args:
             args (ModelArgs): Model configuration parameters.
+            block_manager (BlockManager, optional): Shared block tables, switches to a paged KV cache.
 
         Attributes:
             n_kv_heads (int): Number of key and value heads.
@@ -189,12 +363,13 @@ class Attention(nn.Module):
             n_local_kv_heads (int): Number of local key and value heads.
             n_rep (int): Number of repetitions for local heads.
             head_dim (int): Dimension size of each attention head.
-            wq (ColumnParallelLinear): Linear transformation for queries.
+            attention_impl (str): Attention kernel, see ModelArgs.
+            wq (ColumnParallelLinear): Linear transformation for queries, a QuantizedLinear when
+                args.quantize is set, like wk, wv and wo.
             wk (ColumnParallelLinear): Linear transformation for keys.
             wv (ColumnParallelLinear): Linear transformation for values.
             wo (RowParallelLinear): Linear transformation for output.
-            cache_k (torch.Tensor): Cached keys for attention.
-            cache_v (torch.Tensor): Cached values for attention.
+            cache (Union[DenseKVCache, PagedKVCache]): Cached keys and values for attention.
 
         """
         super().__init__()
@@ -204,68 +379,46 @@ class Attention(nn.Module):
         self.n_local_kv_heads = self.n_kv_heads // model_parallel_size
         self.n_rep = self.n_local_heads // self.n_local_kv_heads
         self.head_dim = args.dim // args.n_heads
+        self.attention_impl = args.attention_impl
 
-        self.wq = ColumnParallelLinear(
-            args.dim,
-            args.n_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
-        )
-        self.wk = ColumnParallelLinear(
-            args.dim,
-            self.n_kv_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
-        )
-        self.wv = ColumnParallelLinear(
-            args.dim,
-            self.n_kv_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=lambda x: x,
-        )
-        self.wo = RowParallelLinear(
-            args.n_heads * self.head_dim,
-            args.dim,
-            bias=False,
-            input_is_parallel=True,
-            init_method=lambda x: x,
-        )
+        quantize = (args.quantize, args.quantize_group_size)
+        self.wq = column_parallel_linear(args.dim, args.n_heads * self.head_dim, *quantize)
+        self.wk = column_parallel_linear(args.dim, self.n_kv_heads * self.head_dim, *quantize)
+        self.wv = column_parallel_linear(args.dim, self.n_kv_heads * self.head_dim, *quantize)
+        self.wo = row_parallel_linear(args.n_heads * self.head_dim, args.dim, *quantize)
 
-        self.cache_k = torch.zeros(
-            (
+        if block_manager is None:
+            self.cache = DenseKVCache(
                 args.max_batch_size,
                 args.max_seq_len,
                 self.n_local_kv_heads,
                 self.head_dim,
+                args.kv_cache_dtype,
             )
-        ).cuda()
-        self.cache_v = torch.zeros(
-            (
-                args.max_batch_size,
-                args.max_seq_len,
-                self.n_local_kv_heads,
-                self.head_dim,
+        else:
+            self.cache = PagedKVCache(
+                block_manager, self.n_local_kv_heads, self.head_dim, args.kv_cache_dtype
             )
-        ).cuda()
 
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        slots: Optional[torch.Tensor] = None,
     ):
         """
         Forward pass of the attention module.
 
         Args:
             x (torch.Tensor): Input tensor.
-            start_pos (int): Starting position for caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for caching, either shared by
+                the whole batch or one position per row.
             freqs_cis (torch.Tensor): Precomputed frequency tensor.
-            mask (torch.Tensor, optional): Attention mask tensor.
+            mask (torch.Tensor, optional): Boolean attention mask, see attention().
+            slots (torch.Tensor, optional): Cache rows used by each batch row. Defaults to the
+                first ``bsz`` rows.
 
         Returns:
             torch.Tensor: Output tensor after attention.
@@ -280,28 +433,11 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        self.cache_k = self.cache_k.to(xq)
-        self.cache_v = self.cache_v.to(xq)
-
-        self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
-        self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
-
-        keys = self.cache_k[:bsz, : start_pos + seqlen]
-        values = self.cache_v[:bsz, : start_pos + seqlen]
+        rows = slice(None, bsz) if slots is None else slots
+        kv_len = start_pos + seqlen if isinstance(start_pos, int) else mask.shape[-1]
+        keys, values = self.cache.update(xk, xv, rows, start_pos, kv_len)
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        keys = repeat_kv(keys, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
-        values = repeat_kv(values, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
-
-        xq = xq.transpose(1, 2)  # (bs, n_local_heads, seqlen, head_dim)
-        keys = keys.transpose(1, 2)
-        values = values.transpose(1, 2)
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        if mask is not None:
-            scores = scores + mask  # (bs, n_local_heads, seqlen, cache_len + seqlen)
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, seqlen, head_dim)
-        output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
+        output = attention(xq, keys, values, mask, self.attention_impl)
         return self.wo(output)
 
 
@@ -312,6 +448,8 @@ class FeedForward(nn.Module):
         hidden_dim: int,
         multiple_of: int,
         ffn_dim_multiplier: Optional[float],
+        quantize: Optional[str] = None,
+        quantize_group_size: int = 0,
     ):
         """
         Initialize the FeedForward module.
@@ -321,6 +459,10 @@ class FeedForward(nn.Module):
             hidden_dim (int): Hidden dimension of the feedforward layer.
             multiple_of (int): Value to ensure hidden dimension is a multiple of this value.
             ffn_dim_multiplier (float, optional): Custom multiplier for hidden dimension. Defaults to None.
+            quantize (str, optional): Weight-only quantization of the layers, see ModelArgs.
+                Defaults to None.
+            quantize_group_size (int, optional): Quantization group size, see ModelArgs.
+                Defaults to 0.
 
         Attributes:
             w1 (ColumnParallelLinear): Linear transformation for the first layer.
@@ -335,28 +477,25 @@ class FeedForward(nn.Module):
             hidden_dim = int(ffn_dim_multiplier * hidden_dim)
         hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
 
-        self.w1 = ColumnParallelLinear(
-            dim, hidden_dim, bias=False, gather_output=False, init_method=lambda x: x
-        )
-        self.w2 = RowParallelLinear(
-            hidden_dim, dim, bias=False, input_is_parallel=True, init_method=lambda x: x
-        )
-        self.w3 = ColumnParallelLinear(
-            dim, hidden_dim, bias=False, gather_output=False, init_method=lambda x: x
-        )
+        self.w1 = column_parallel_linear(dim, hidden_dim, quantize, quantize_group_size)
+        self.w2 = row_parallel_linear(hidden_dim, dim, quantize, quantize_group_size)
+        self.w3 = column_parallel_linear(dim, hidden_dim, quantize, quantize_group_size)
 
     def forward(self, x):
         return self.w2(F.silu(self.w1(x)) * self.w3(x))
 
 
 class TransformerBlock(nn.Module):
-    def __init__(self, layer_id: int, args: ModelArgs):
+    def __init__(
+        self, layer_id: int, args: ModelArgs, block_manager: Optional[BlockManager] = None
+    ):
         """
         Initialize a TransformerBlock.
 
         Args:
             layer_id (int): Identifier for the layer.
             args (ModelArgs): Model configuration parameters.
+            block_manager (BlockManager, optional): Shared block tables of the paged KV cache.
 
         Attributes:
             n_heads (int): Number of attention heads.
@@ -373,12 +512,14 @@ class TransformerBlock(nn.Module):
         self.n_heads = args.n_heads
         self.dim = args.dim
         self.head_dim = args.dim // args.n_heads
-        self.attention = Attention(args)
+        self.attention = Attention(args, block_manager)
         self.feed_forward = FeedForward(
             dim=args.dim,
             hidden_dim=4 * args.dim,
             multiple_of=args.multiple_of,
             ffn_dim_multiplier=args.ffn_dim_multiplier,
+            quantize=args.quantize,
+            quantize_group_size=args.quantize_group_size,
         )
         self.layer_id = layer_id
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
@@ -387,24 +528,26 @@ class TransformerBlock(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
+        start_pos: Union[int, torch.Tensor],
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        slots: Optional[torch.Tensor] = None,
     ):
         """
         Perform a forward pass through the TransformerBlock.
 
         Args:
             x (torch.Tensor): Input tensor.
-            start_pos (int): Starting position for attention caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for attention caching.
             freqs_cis (torch.Tensor): Precomputed cosine and sine frequencies.
             mask (torch.Tensor, optional): Masking tensor for attention. Defaults to None.
+            slots (torch.Tensor, optional): Cache rows used by each batch row. Defaults to None.
 
         Returns:
             torch.Tensor: Output tensor after applying attention and feedforward layers.
 
         """
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask)
+        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, slots)
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
 
@@ -425,7 +568,10 @@ class Transformer(nn.Module):
             layers (torch.nn.ModuleList): List of Transformer blocks.
             norm (RMSNorm): Layer normalization for the model output.
             output (ColumnParallelLinear): Linear layer for final output.
-            freqs_cis (torch.Tensor): Precomputed cosine and sine frequencies.
+            freqs_cis (torch.Tensor): Precomputed cosine and sine frequencies, shared with the other
+                models of the same shape, see cached_freqs_cis.
+            block_manager (Optional[BlockManager]): Block tables of the paged KV cache, None for
+                the dense cache.
 
         """
         super().__init__()
@@ -437,30 +583,75 @@ class Transformer(nn.Module):
             params.vocab_size, params.dim, init_method=lambda x: x
         )
 
+        self.block_manager: Optional[BlockManager] = None
+        if params.kv_block_size > 0:
+            head_dim = params.dim // params.n_heads
+            n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+            max_blocks_per_row = -(-params.max_seq_len // params.kv_block_size)
+            num_blocks = params.kv_num_blocks or params.max_batch_size * max_blocks_per_row
+            element_size, scale_size = torch.empty(0).element_size(), 0
+            if params.kv_cache_dtype is not None:
+                # one byte per entry and a scale in the default dtype per position and head
+                element_size, scale_size = 1, element_size
+            self.block_manager = BlockManager(
+                num_blocks,
+                params.kv_block_size,
+                params.max_batch_size,
+                params.max_seq_len,
+                params.n_layers,
+                n_kv_heads // fs_init.get_model_parallel_world_size(),
+                head_dim,
+                element_size=element_size,
+                scale_size=scale_size,
+            )
+
         self.layers = torch.nn.ModuleList()
         for layer_id in range(params.n_layers):
-            self.layers.append(TransformerBlock(layer_id, params))
+            self.layers.append(TransformerBlock(layer_id, params, self.block_manager))
 
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
         self.output = ColumnParallelLinear(
             params.dim, params.vocab_size, bias=False, init_method=lambda x: x
         )
 
-        self.freqs_cis = precompute_freqs_cis(
+        self.freqs_cis = self.rotary_frequencies(torch.empty(0).device)
+        # reused to build masks without allocating a new arange every step
+        self.register_buffer("positions", torch.arange(params.max_seq_len), persistent=False)
+
+    def rotary_frequencies(self, device: torch.device) -> torch.Tensor:
+        """The shared freqs_cis of this model on device, see cached_freqs_cis."""
+        return cached_freqs_cis(
+            self.params.dim // self.params.n_heads,
             # Note that self.params.max_seq_len is multiplied by 2 because the token limit for the Llama 2 generation of models is 4096.
             # Adding this multiplier instead of using 4096 directly allows for dynamism of token lengths while training or fine-tuning.
-            self.params.dim // self.params.n_heads,
             self.params.max_seq_len * 2,
+            self.params.rope_theta,
+            device,
+            self.params.rope_scaling,
+            self.params.rope_scaling_factor,
         )
 
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        start_pos: Union[int, torch.Tensor],
+        slots: Optional[torch.Tensor] = None,
+        kv_len: Optional[int] = None,
+    ):
         """
         Perform a forward pass through the Transformer model.
 
         Args:
             tokens (torch.Tensor): Input token indices.
-            start_pos (int): Starting position for attention caching.
+            start_pos (Union[int, torch.Tensor]): Starting position for attention caching. A tensor
+                of shape (bsz,) gives every row its own position, which lets sequences of different
+                lengths share one decode step.
+            slots (torch.Tensor, optional): Cache rows used by each batch row, of shape (bsz,).
+                Defaults to the first ``bsz`` rows of the cache.
+            kv_len (int, optional): Number of cached positions attended to with a tensor start_pos,
+                one past the last new position of the longest row. Callers know it on the host,
+                without it the positions are read back from the device. Defaults to None.
 
         Returns:
             torch.Tensor: Output logits after applying the Transformer model.
@@ -468,16 +659,29 @@ class Transformer(nn.Module):
         """
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
-        self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+        if self.freqs_cis.device != h.device:
+            self.freqs_cis = self.rotary_frequencies(h.device)
 
+        # a single new token or a prefill from position 0 needs no mask (plain causal attention),
+        # otherwise every new token may attend to the cached prefix and itself
         mask = None
-        if seqlen > 1:
-            mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=tokens.device)
-            mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
+        if isinstance(start_pos, int):
+            freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+            if seqlen > 1 and start_pos > 0:
+                positions = self.positions[start_pos : start_pos + seqlen]
+                mask = self.positions[: start_pos + seqlen] <= positions[:, None]
+                mask = mask[None, None]  # (1, 1, seqlen, kv_len)
+        else:
+            start_pos = start_pos.to(tokens.device)
+            positions = start_pos[:, None] + self.positions[:seqlen]
+            freqs_cis = self.freqs_cis[positions]
+            if kv_len is None:
+                kv_len = int(positions.max()) + 1
+            mask = self.positions[:kv_len] <= positions[:, :, None]
+            mask = mask[:, None]  # (bsz, 1, seqlen, kv_len)
 
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, freqs_cis, mask, slots)
         h = self.norm(h)
         output = self.output(h).float()
         return output
@@ -0,0 +1,174 @@
+"""
+Per-phase timings and on-demand torch profiler traces of generation.
+
+Tokenizer.encode, prefill forwards, decode steps, sampling and Tokenizer.decode run inside
+PROFILER.phase(name). While profiling is off that is a shared no-op context manager, one attribute
+check per call. With CHIMERA_PROFILE=1 (or PROFILER.enabled = True) the time spent in every phase is
+summed up and handed out by PROFILER.drain(), which the metrics layer exports.
+
+Traces of the torch profiler are written to CHIMERA_PROFILE_DIR (default ./profiles) for requests
+that ask for one (the x-chimera-profile gRPC metadata), or for every generation with
+CHIMERA_PROFILE_TRACE=1. The torch profiler only records the thread it runs in, so traces are
+started by whatever thread runs the model, see PROFILER.trace.
+"""
+
+import contextlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, ContextManager, Dict, Tuple, TypeVar
+
+import torch
+
+from chimera_llama_grpc.log import logger
+
+PHASES = ("encode", "prefill", "decode_step", "sample", "detokenize")
+
+PROFILE_ENV = "CHIMERA_PROFILE"
+PROFILE_TRACE_ENV = "CHIMERA_PROFILE_TRACE"
+PROFILE_DIR_ENV = "CHIMERA_PROFILE_DIR"
+
+T = TypeVar("T")
+
+_NULL = contextlib.nullcontext()
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").lower() in ("1", "true", "yes", "on")
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "start", "record")
+
+    def __init__(self, profiler: "PhaseProfiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.record = torch.profiler.record_function(f"chimera::{self.name}")
+        self.record.__enter__()
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        self.record.__exit__(*exc)
+
+
+class PhaseProfiler:
+    """
+    Aggregates the time spent in each generation phase and captures torch profiler traces.
+
+    Attributes:
+        trace_all (bool): Trace every generation, not only the requested ones.
+        trace_dir (Path): Where traces are written.
+        active (bool): Whether phase() measures anything, i.e. timings are enabled or a trace is
+            being captured.
+        synchronize (bool): Wait for CUDA around every phase while timings are enabled, otherwise
+            only kernel launches would be timed.
+    """
+
+    def __init__(self, enabled: bool = False, trace_all: bool = False, trace_dir: str = "profiles"):
+        """
+        Initialize the PhaseProfiler.
+
+        Args:
+            enabled (bool, optional): Aggregate phase timings. Defaults to False.
+            trace_all (bool, optional): Trace every generation. Defaults to False.
+            trace_dir (str, optional): Where traces are written. Defaults to "profiles".
+        """
+        self.trace_all = trace_all
+        self.trace_dir = Path(trace_dir)
+        self.active = False
+        self.synchronize = False
+        self._enabled = False
+        self._tracing = 0
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Tuple[int, float]] = {}
+        self.enabled = enabled
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled: bool) -> None:
+        self._enabled = enabled
+        self.synchronize = enabled and torch.cuda.is_available()
+        self.active = enabled or self._tracing > 0
+
+    def phase(self, name: str) -> ContextManager:
+        """Measure the enclosed code as phase name, see PHASES."""
+        if not self.active:
+            return _NULL
+        return _Phase(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        """Add seconds spent in phase name, only while timings are enabled."""
+        if not self._enabled:
+            return
+        with self._lock:
+            count, total = self._totals.get(name, (0, 0.0))
+            self._totals[name] = (count + 1, total + seconds)
+
+    def drain(self) -> Dict[str, Tuple[int, float]]:
+        """
+        Take the timings aggregated since the last drain.
+
+        Returns:
+            Dict[str, Tuple[int, float]]: Calls and seconds of every phase that ran.
+        """
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return totals
+
+    @contextlib.contextmanager
+    def trace(self, name: str, requested: bool = True):
+        """
+        Capture a torch profiler trace of the enclosed code in the current thread.
+
+        Args:
+            name (str): Prefix of the trace file name.
+            requested (bool, optional): Whether a trace was asked for, the enclosed code runs
+                untraced unless it was or trace_all is set. Defaults to True.
+        """
+        if not (requested or self.trace_all):
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with self._lock:
+            self._tracing += 1
+            self.active = True
+        try:
+            with torch.profiler.profile(activities=activities) as profile:
+                yield
+        finally:
+            with self._lock:
+                self._tracing -= 1
+                self.active = self._enabled or self._tracing > 0
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        path = self.trace_dir / f"{name}-{time.time_ns()}.json"
+        profile.export_chrome_trace(str(path))
+        logger.info(f"Wrote profiler trace {path}")
+
+    def traced(self, f: Callable[..., T], name: str, requested: bool = True) -> Callable[..., T]:
+        """f running inside trace(name, requested), e.g. to trace a call in a worker thread."""
+
+        def wrapper(*args, **kwargs) -> T:
+            with self.trace(name, requested):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+
+PROFILER = PhaseProfiler(
+    enabled=_env_flag(PROFILE_ENV),
+    trace_all=_env_flag(PROFILE_TRACE_ENV),
+    trace_dir=os.environ.get(PROFILE_DIR_ENV, "profiles"),
+)
@@ -0,0 +1,260 @@
+"""
+Weight-only int8 and int4 quantization of the attention and feed-forward projections.
+
+int8 weights are quantized symmetrically with one scale per group of input channels (a single group
+per output channel by default). int4 weights are quantized asymmetrically, with a scale and a zero
+point per group, and packed two per byte. Embeddings, norms and the output projection keep the model
+dtype, activations are never quantized.
+
+On CPU, decode steps in bfloat16 or float16 run PyTorch's int8 and int4 matmul kernels on the
+quantized weights. Prefills, and every matmul on other devices, dequantize the weight to the
+activation dtype first, which saves memory but not time.
+"""
+
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import torch
+import torch.nn.functional as F
+from fairscale.nn.model_parallel.initialize import get_model_parallel_world_size
+from fairscale.nn.model_parallel.mappings import (
+    copy_to_model_parallel_region,
+    reduce_from_model_parallel_region,
+)
+from fairscale.nn.model_parallel.utils import divide_and_check_no_remainder
+from torch import nn
+
+from chimera_llama_grpc.llama.checkpoint import open_checkpoint
+from chimera_llama_grpc.log import logger
+
+QUANTIZATION_MODES = ("int8", "int4")
+# linear layers of a TransformerBlock that are quantized
+QUANTIZED_LINEARS = (
+    "attention.wq",
+    "attention.wk",
+    "attention.wv",
+    "attention.wo",
+    "feed_forward.w1",
+    "feed_forward.w2",
+    "feed_forward.w3",
+)
+DEFAULT_GROUP_SIZE = {"int8": 0, "int4": 128}
+# the int8 and int4 kernels beat dequantizing the weight up to about this many tokens per matmul,
+# i.e. for decode steps but not for prefills
+KERNEL_MAX_TOKENS = 32
+INT4_KERNEL_GROUP_SIZES = (32, 64, 128, 256)
+
+
+def _group_size(mode: str, group_size: int, in_features: int) -> int:
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"quantization mode must be one of {QUANTIZATION_MODES}, got {mode}")
+    group_size = group_size or DEFAULT_GROUP_SIZE[mode] or in_features
+    if in_features % group_size:
+        raise ValueError(f"in_features {in_features} is not a multiple of group_size {group_size}")
+    return group_size
+
+
+def quantize_weight(
+    weight: torch.Tensor, mode: str, group_size: int = 0
+) -> Dict[str, torch.Tensor]:
+    """
+    Quantize the weight of a linear layer.
+
+    Args:
+        weight (torch.Tensor): Weight of shape (out_features, in_features).
+        mode (str): "int8" or "int4".
+        group_size (int, optional): Input channels sharing a scale, 0 for the mode's default: a
+            single group per output channel for int8, 128 for int4.
+
+    Returns:
+        Dict[str, torch.Tensor]: The state of a QuantizedLinear: "weight" (int8, or two int4 per
+            uint8), "scales" and for int4 "zeros", of shape (out_features, in_features / group_size).
+    """
+    out_features, in_features = weight.shape
+    group_size = _group_size(mode, group_size, in_features)
+    groups = weight.float().reshape(out_features, in_features // group_size, group_size)
+    if mode == "int8":
+        scales = groups.abs().amax(dim=-1).clamp(min=1e-8) / 127
+        q = torch.round(groups / scales[..., None]).clamp(-127, 127).to(torch.int8)
+        return {"weight": q.reshape(out_features, in_features), "scales": scales}
+
+    low, high = groups.amin(dim=-1), groups.amax(dim=-1)
+    scales = ((high - low) / 15).clamp(min=1e-8)
+    q = torch.round((groups - low[..., None]) / scales[..., None]).clamp(0, 15).to(torch.uint8)
+    q = q.reshape(out_features, in_features)
+    # w = (q - 8) * scale + zero, the convention of the CPU int4 kernel
+    zeros = low + 8 * scales
+    return {"weight": q[:, ::2] | (q[:, 1::2] << 4), "scales": scales, "zeros": zeros}
+
+
+def dequantize_weight(
+    weight: torch.Tensor,
+    scales: torch.Tensor,
+    zeros: Optional[torch.Tensor] = None,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor:
+    """Inverse of quantize_weight, int4 when zeros are given."""
+    if zeros is not None:
+        weight = torch.stack([weight & 15, weight >> 4], dim=-1).flatten(1)
+    out_features, in_features = weight.shape
+    groups = weight.reshape(out_features, scales.shape[1], -1).to(dtype)
+    if zeros is None:
+        groups = groups * scales[..., None].to(dtype)
+    else:
+        groups = (groups - 8) * scales[..., None].to(dtype) + zeros[..., None].to(dtype)
+    return groups.reshape(out_features, in_features)
+
+
+class QuantizedLinear(nn.Module):
+    """
+    Weight-only quantized drop-in for the fairscale ColumnParallelLinear (gather_output=False) and
+    RowParallelLinear (input_is_parallel=True) layers of the model.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        mode: str,
+        group_size: int = 0,
+        parallel: str = "column",
+    ):
+        """
+        Args:
+            in_features (int): Input features of the full layer.
+            out_features (int): Output features of the full layer.
+            mode (str): "int8" or "int4".
+            group_size (int, optional): See quantize_weight. Defaults to 0.
+            parallel (str, optional): "column" splits the output features across model parallel
+                ranks, "row" the input features. Defaults to "column".
+
+        Attributes:
+            weight (torch.Tensor): Quantized weight of the local shard, see quantize_weight.
+            scales (torch.Tensor): Scale of every group.
+            zeros (Optional[torch.Tensor]): Zero point of every group, int4 only.
+        """
+        super().__init__()
+        world_size = get_model_parallel_world_size()
+        if parallel == "column":
+            out_features = divide_and_check_no_remainder(out_features, world_size)
+        else:
+            in_features = divide_and_check_no_remainder(in_features, world_size)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.parallel = parallel
+        self.group_size = _group_size(mode, group_size, in_features)
+        groups = in_features // self.group_size
+
+        if mode == "int8":
+            weight = torch.empty(out_features, in_features, dtype=torch.int8)
+        else:
+            weight = torch.empty(out_features, in_features // 2, dtype=torch.uint8)
+        self.register_buffer("weight", weight)
+        self.register_buffer("scales", torch.empty(out_features, groups))
+        self.register_buffer("zeros", torch.empty(out_features, groups) if mode == "int4" else None)
+        # weight and scales rearranged for the CPU int4 kernel, built on first use
+        self._int4_kernel_args = None
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}, "
+            f"group_size={self.group_size}, parallel={self.parallel}"
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.parallel == "column":
+            x = copy_to_model_parallel_region(x)
+        output = self._matmul(x.reshape(-1, self.in_features)).view(*x.shape[:-1], -1)
+        if self.parallel == "row":
+            output = reduce_from_model_parallel_region(output)
+        return output
+
+    def _matmul(self, x: torch.Tensor) -> torch.Tensor:
+        if (
+            x.device.type == "cpu"
+            and x.dtype in (torch.bfloat16, torch.float16)
+            and x.shape[0] <= KERNEL_MAX_TOKENS
+        ):
+            if (
+                self.mode == "int8"
+                and self.scales.shape[1] == 1
+                and hasattr(torch, "_weight_int8pack_mm")
+            ):
+                return torch._weight_int8pack_mm(x, self.weight, self.scales[:, 0].to(x.dtype))
+            if (
+                self.mode == "int4"
+                and self.group_size in INT4_KERNEL_GROUP_SIZES
+                and hasattr(torch, "_weight_int4pack_mm_for_cpu")
+            ):
+                return torch._weight_int4pack_mm_for_cpu(x, *self._int4_kernel(x.dtype))
+        weight = dequantize_weight(self.weight, self.scales, self.zeros, dtype=x.dtype)
+        return F.linear(x, weight)
+
+    def _int4_kernel(self, dtype: torch.dtype):
+        if self._int4_kernel_args is None or self._int4_kernel_args[2].dtype != dtype:
+            q = torch.stack([self.weight & 15, self.weight >> 4], dim=-1).flatten(1)
+            packed = torch._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 2)
+            scales_and_zeros = torch.stack([self.scales.t(), self.zeros.t()], dim=-1).to(dtype)
+            self._int4_kernel_args = (packed, self.group_size, scales_and_zeros.contiguous())
+        return self._int4_kernel_args
+
+
+def is_quantized_linear(key: str) -> bool:
+    """Whether key is the weight of one of the QUANTIZED_LINEARS of a layer."""
+    return key.startswith("layers.") and any(
+        key.endswith(f".{name}.weight") for name in QUANTIZED_LINEARS
+    )
+
+
+def quantize_checkpoint(
+    model_dir: Union[Path, str],
+    output_dir: Union[Path, str],
+    mode: str,
+    group_size: int = 0,
+) -> Path:
+    """
+    Quantize every consolidated.*.pth of model_dir into output_dir, in the layout ModelManager
+    lists and Llama.build loads. params.json records the quantization, the model is built with
+    QuantizedLinear layers from it.
+
+    Args:
+        model_dir (Union[Path, str]): Directory of the model, e.g. ckpt/llama-2-7b-chat.
+        output_dir (Union[Path, str]): Directory to write, e.g. ckpt/llama-2-7b-chat-int4.
+        mode (str): "int8" or "int4".
+        group_size (int, optional): See quantize_weight. Defaults to 0.
+
+    Returns:
+        Path: output_dir.
+    """
+    model_dir, output_dir = Path(model_dir), Path(output_dir)
+    checkpoints = sorted(model_dir.glob("consolidated.*.pth"))
+    if not checkpoints:
+        raise FileNotFoundError(f"No consolidated.*.pth found in {model_dir}")
+    params = json.loads((model_dir / "params.json").read_text())
+    if params.get("quantize"):
+        raise ValueError(f"{model_dir} is already quantized to {params['quantize']}")
+    group_size = group_size or DEFAULT_GROUP_SIZE[mode]
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for ckpt_path in checkpoints:
+        checkpoint = open_checkpoint(ckpt_path)
+        quantized = {}
+        for key, tensor in checkpoint.items():
+            if not is_quantized_linear(key):
+                quantized[key] = tensor
+                continue
+            prefix = key[: -len("weight")]
+            for name, value in quantize_weight(tensor, mode, group_size).items():
+                quantized[prefix + name] = value
+        torch.save(quantized, output_dir / ckpt_path.name)
+        logger.info(f"Quantized {ckpt_path} to {mode}")
+        del checkpoint, quantized
+
+    params.update(quantize=mode, quantize_group_size=group_size)
+    (output_dir / "params.json").write_text(json.dumps(params))
+    if (model_dir / "tokenizer.model").exists():
+        shutil.copy(model_dir / "tokenizer.model", output_dir / "tokenizer.model")
+    return output_dir
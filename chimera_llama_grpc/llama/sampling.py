@@ -0,0 +1,124 @@
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+# candidates kept by the top-k prefilter, rows whose nucleus is wider fall back to a full sort
+PREFILTER_TOP_K = 256
+
+Generators = Optional[Sequence[Optional[torch.Generator]]]
+
+
+def multinomial(probs: torch.Tensor, generators: Generators = None) -> torch.Tensor:
+    """
+    Draw one index per row of a (possibly unnormalized) probability tensor.
+
+    Args:
+        probs (torch.Tensor): Non-negative weights of shape (bsz, n).
+        generators (Sequence[Optional[torch.Generator]], optional): One random generator per row, so
+            a row samples the same tokens whatever else is in the batch. Rows without a generator
+            use the global one. Defaults to None (torch.multinomial on the global generator).
+
+    Returns:
+        torch.Tensor: Sampled indices of shape (bsz, 1).
+    """
+    if generators is None:
+        return torch.multinomial(probs, num_samples=1)
+    # inverse transform sampling with one uniform draw per row from the row's own generator
+    uniform = torch.cat([torch.rand(1, generator=g, device=probs.device) for g in generators])
+    cdf = torch.cumsum(probs, dim=-1)
+    index = torch.searchsorted(cdf, uniform.to(cdf)[:, None] * cdf[:, -1:], right=True)
+    return index.clamp_(max=probs.shape[-1] - 1)
+
+
+def _filter_sorted(
+    probs: torch.Tensor,
+    top_p: torch.Tensor,
+    top_k: Optional[torch.Tensor],
+    min_p: Optional[torch.Tensor],
+) -> torch.Tensor:
+    """Zero out the tokens of descending sorted probs that top_p, top_k and min_p exclude."""
+    mask = torch.cumsum(probs, dim=-1) - probs > top_p
+    if top_k is not None:
+        rank = torch.arange(probs.shape[-1], device=probs.device)
+        mask |= (top_k > 0) & (rank >= top_k)
+    if min_p is not None:
+        mask |= probs < min_p * probs[:, :1]
+    return probs.masked_fill(mask, 0.0)
+
+
+def _sort_rows(
+    logits: torch.Tensor, probs: torch.Tensor, indices: torch.Tensor, truncated: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The fully sorted rows where truncated, the prefiltered ones padded with zeros elsewhere."""
+    sorted_probs, sorted_indices = torch.sort(
+        torch.softmax(logits, dim=-1), dim=-1, descending=True
+    )
+    padding = (0, logits.shape[-1] - probs.shape[-1])
+    return (
+        torch.where(truncated, sorted_probs, F.pad(probs, padding)),
+        torch.where(truncated, sorted_indices, F.pad(indices, padding)),
+    )
+
+
+def sample(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    generators: Generators = None,
+    top_k: Optional[torch.Tensor] = None,
+    min_p: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Sample the next token of every row with its own temperature, top_p, top_k and min_p.
+
+    Instead of sorting the whole vocabulary, the PREFILTER_TOP_K most likely tokens are taken with
+    torch.topk and normalized by a logsumexp over the full row. Top-p only ever keeps a prefix of the
+    sorted tokens, so the result is exact whenever the nucleus fits in the prefilter; the rare rows
+    where it does not (flat distributions, top_p close to 1) are sampled after a full sort. On CPU
+    the sort only runs when such a row exists, on accelerators it always runs so that choosing
+    between the two never waits for the device.
+
+    Args:
+        logits (torch.Tensor): Logits of the last position, of shape (bsz, vocab_size).
+        temperature (torch.Tensor): Temperature of every row, of shape (bsz,). Rows with temperature 0
+            decode greedily.
+        top_p (torch.Tensor): Top-p threshold of every row, of shape (bsz,).
+        generators (Sequence[Optional[torch.Generator]], optional): Per-row random generators, see
+            multinomial.
+        top_k (torch.Tensor, optional): Number of most likely tokens each row samples from, 0 keeps
+            all of them. Defaults to None (disabled).
+        min_p (torch.Tensor, optional): Tokens less likely than min_p times the most likely token
+            are dropped, 0 disables it for a row. Defaults to None (disabled).
+
+    Returns:
+        torch.Tensor: Next tokens of shape (bsz,).
+    """
+    vocab_size = logits.shape[-1]
+    greedy = torch.argmax(logits, dim=-1)
+    temperature = temperature.to(logits)
+    # greedy rows get a dummy temperature and are replaced by argmax below
+    logits = logits / temperature.clamp(min=1e-5)[:, None]
+    top_p = top_p.to(logits)[:, None]
+    if top_k is not None:
+        top_k = top_k.to(logits.device, torch.long)[:, None]
+    if min_p is not None:
+        min_p = min_p.to(logits)[:, None]
+
+    k = min(PREFILTER_TOP_K, vocab_size)
+    values, indices = torch.topk(logits, k, dim=-1)
+    probs = torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True))
+    if k < vocab_size:
+        # the nucleus reaches past the prefilter when the kept mass is still within top_p
+        truncated = probs.sum(dim=-1, keepdim=True) <= top_p
+        if top_k is not None:
+            truncated &= (top_k == 0) | (top_k > k)
+        if logits.device.type != "cpu":
+            # reading truncated back would wait for the step on the device
+            probs, indices = _sort_rows(logits, probs, indices, truncated)
+        elif truncated.any():
+            probs, indices = torch.sort(torch.softmax(logits, dim=-1), dim=-1, descending=True)
+
+    probs = _filter_sorted(probs, top_p, top_k, min_p)
+    sampled = torch.gather(indices, -1, multinomial(probs, generators)).reshape(-1)
+    return torch.where(temperature > 0, sampled, greedy)
@@ -0,0 +1,509 @@
+import contextlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, InvalidStateError
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+import torch
+
+from chimera_llama_grpc.llama.generation import Llama
+from chimera_llama_grpc.llama.kv_cache import PrefixCache
+from chimera_llama_grpc.llama.profiling import PROFILER
+from chimera_llama_grpc.llama.sampling import sample
+from chimera_llama_grpc.llama.stopping import Stop, StopCriteria
+from chimera_llama_grpc.log import logger
+
+
+class Sequence:
+    """A single generation request tracked by the Scheduler."""
+
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        max_gen_len: int,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        on_token: Optional[Callable[[int], None]] = None,
+        top_k: int = 0,
+        min_p: float = 0.0,
+        generator: Optional[torch.Generator] = None,
+        trace: bool = False,
+        stop: Optional[StopCriteria] = None,
+    ):
+        """
+        Initialize a Sequence.
+
+        Args:
+            prompt_tokens (List[int]): Tokenized prompt.
+            max_gen_len (int): Maximum number of tokens to generate.
+            temperature (float, optional): Temperature value for sampling. Defaults to 0.6.
+            top_p (float, optional): Top-p probability threshold for nucleus sampling. Defaults to 0.9.
+            on_token (Callable[[int], None], optional): Called from the scheduler thread with every
+                generated token as soon as it is sampled. Defaults to None.
+            top_k (int, optional): Sample from the top_k most likely tokens, 0 disables it.
+                Defaults to 0.
+            min_p (float, optional): Minimum probability relative to the most likely token,
+                0 disables it. Defaults to 0.0.
+            generator (torch.Generator, optional): Random generator of this sequence only, makes
+                sampling reproducible whatever else is batched with it. Defaults to None.
+            trace (bool, optional): Capture a torch profiler trace of the scheduler steps while the
+                sequence runs, see profiling.PROFILER. Defaults to False.
+            stop (StopCriteria, optional): Stop token IDs and stop strings of the sequence, checked
+                with every generated token. Defaults to None.
+
+        Attributes:
+            output_tokens (List[int]): Generated tokens so far, without EOS.
+            slot (Optional[int]): KV cache row owned by the sequence while it is running.
+            prefilled (int): Positions of the prompt already written to the KV cache.
+            finished (bool): Whether the sequence has retired.
+            future (Future): Resolved with output_tokens once the sequence retires. Cancelling it
+                retires the sequence at the start of the next step, see Scheduler.cancel.
+            submitted_at (float): time.perf_counter() when the sequence was created.
+            first_token_at (Optional[float]): time.perf_counter() when the first token was sampled.
+            finished_at (Optional[float]): time.perf_counter() when the sequence retired.
+
+        """
+        self.prompt_tokens = prompt_tokens
+        self.max_gen_len = max_gen_len
+        self.temperature = temperature
+        self.top_p = top_p
+        self.on_token = on_token
+        self.top_k = top_k
+        self.min_p = min_p
+        self.generator = generator
+        self.trace = trace
+        self.stop = stop
+
+        self.output_tokens: List[int] = []
+        self.slot: Optional[int] = None
+        self.prefilled = 0
+        self.finished = False
+        self.future: Future = Future()
+        self.submitted_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.prompt_tokens) + len(self.output_tokens)
+
+
+class Scheduler:
+    """
+    Continuous (in-flight) batching on top of a Llama model.
+
+    Each step admits waiting sequences into free KV cache rows and prefills them, then runs a single
+    decode step for every running sequence at its own position. Sequences retire independently on EOS,
+    their stop token IDs or stop strings, max_gen_len or max_seq_len and hand their cache row to the
+    next waiting sequence, so the batch stays full under concurrency instead of serializing requests.
+
+    With a prefill_chunk_size, at most that many prompt tokens are prefilled per step and long prompts
+    take several steps, so they delay the decode steps of the running sequences by a chunk at a time
+    instead of by their whole prefill.
+    """
+
+    def __init__(self, llama: Llama, prefill_chunk_size: Optional[int] = None):
+        """
+        Initialize the Scheduler.
+
+        Args:
+            llama (Llama): The model to generate with.
+            prefill_chunk_size (Optional[int], optional): Prompt tokens prefilled per step, 0 prefills
+                every admitted prompt at once. Defaults to the prefill_chunk_size of the model.
+        """
+        self.llama = llama
+        self.params = llama.model.params
+        if prefill_chunk_size is None:
+            prefill_chunk_size = self.params.prefill_chunk_size
+        self.prefill_chunk_size = prefill_chunk_size
+        self.device = llama.model.tok_embeddings.weight.device
+        self.eos_id = llama.tokenizer.eos_id
+        self.block_manager = llama.model.block_manager
+        self.prefix_cache: Optional[PrefixCache] = None
+        if self.block_manager is not None and self.params.prefix_cache_bytes > 0:
+            self.prefix_cache = PrefixCache(
+                self.block_manager,
+                max_blocks=self.params.prefix_cache_bytes // self.block_manager.bytes_per_block,
+            )
+
+        self.free_slots: Deque[int] = deque(range(self.params.max_batch_size))
+        self.waiting: Deque[Sequence] = deque()
+        # admitted sequences with part of their prompt still to prefill, in admission order
+        self.prefilling: List[Sequence] = []
+        self.running: List[Sequence] = []
+
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._drain = False
+        # traced sequences not retired yet, the trace spans the steps between
+        self._traced = 0
+        self._trace: Optional[contextlib.ExitStack] = None
+
+    def submit(
+        self,
+        prompt_tokens: List[int],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        on_token: Optional[Callable[[int], None]] = None,
+        top_k: int = 0,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        trace: bool = False,
+        stop: Stop = None,
+        stop_token_ids: Optional[List[int]] = None,
+    ) -> Sequence:
+        """
+        Queue a prompt for generation, thread-safe.
+
+        Args:
+            prompt_tokens (List[int]): Tokenized prompt.
+            temperature (float, optional): Temperature value for sampling. Defaults to 0.6.
+            top_p (float, optional): Top-p probability threshold for nucleus sampling. Defaults to 0.9.
+            max_gen_len (Optional[int], optional): Maximum length of the generated sequence.
+                If not provided, it's set to the model's maximum sequence length minus 1.
+            on_token (Callable[[int], None], optional): Streaming callback, see Sequence.
+            top_k (int, optional): Top-k filter, see Sequence. Defaults to 0.
+            min_p (float, optional): Min-p filter, see Sequence. Defaults to 0.0.
+            seed (Optional[int], optional): Seed of the sequence's own random generator.
+                Defaults to None (global generator).
+            trace (bool, optional): Trace the steps while the sequence runs, see Sequence.
+                Defaults to False.
+            stop (Stop, optional): Stop string or strings, the sequence retires on the token that
+                completes one and keeps it, cut the text with stopping.truncate_at_stop.
+                Defaults to None.
+            stop_token_ids (Optional[List[int]], optional): Tokens retiring the sequence like EOS.
+                Defaults to None.
+
+        Returns:
+            Sequence: The queued sequence, await ``sequence.future`` for the generated tokens.
+
+        Raises:
+            ValueError: If the prompt is empty or leaves no room to generate within max_seq_len.
+
+        """
+        if not 0 < len(prompt_tokens) < self.params.max_seq_len:
+            raise ValueError(
+                f"Prompt length must be in [1, {self.params.max_seq_len - 1}], "
+                f"got {len(prompt_tokens)}"
+            )
+        if max_gen_len is None:
+            max_gen_len = self.params.max_seq_len - 1
+        if self.block_manager is not None:
+            max_tokens = min(self.params.max_seq_len, len(prompt_tokens) + max_gen_len)
+            if self.block_manager.blocks_for(max_tokens) > self.block_manager.num_blocks:
+                raise ValueError(
+                    f"A sequence of {max_tokens} tokens does not fit in the paged KV cache of "
+                    f"{self.block_manager.num_blocks} blocks"
+                )
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(device=self.device).manual_seed(seed)
+        sequence = Sequence(
+            prompt_tokens,
+            max_gen_len,
+            temperature=temperature,
+            top_p=top_p,
+            on_token=on_token,
+            top_k=top_k,
+            min_p=min_p,
+            generator=generator,
+            trace=trace or PROFILER.trace_all,
+            stop=StopCriteria(self.llama.tokenizer, stop, stop_token_ids) or None,
+        )
+        with self._cond:
+            self._traced += sequence.trace
+            self.waiting.append(sequence)
+            self._cond.notify()
+        return sequence
+
+    def cancel(self, sequence: Sequence) -> None:
+        """
+        Cancel a sequence, thread-safe. It stops generating and releases its cache row at the start
+        of the next step, e.g. when the client went away.
+        """
+        if sequence.future.cancel():
+            with self._cond:
+                self._cond.notify()
+
+    def has_unfinished(self) -> bool:
+        return bool(self.waiting or self.prefilling or self.running)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Queue, KV cache and prefix cache metrics.
+
+        Returns:
+            Dict[str, Any]: Number of waiting, prefilling and running sequences, the fraction of
+                max_batch_size and of the KV cache positions they hold, plus the paged KV cache
+                memory report and prefix cache hit statistics when those are enabled.
+        """
+        prefilling = list(self.prefilling)
+        running = prefilling + list(self.running)
+        stats: Dict[str, Any] = {
+            "waiting": len(self.waiting),
+            "prefilling": len(prefilling),
+            "running": len(running) - len(prefilling),
+        }
+        stats["batch_occupancy"] = len(running) / self.params.max_batch_size
+        if self.block_manager is not None:
+            stats["kv_cache"] = self.block_manager.memory_report()
+            stats["kv_cache_utilization"] = stats["kv_cache"]["utilization"]
+        else:
+            positions = self.params.max_batch_size * self.params.max_seq_len
+            stats["kv_cache_utilization"] = sum(s.num_tokens for s in running) / positions
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
+
+    @torch.inference_mode()
+    def step(self) -> List[Sequence]:
+        """
+        Run one scheduling step: admit waiting sequences and prefill them, up to prefill_chunk_size
+        prompt tokens, then decode one token for all running sequences.
+
+        Returns:
+            List[Sequence]: Sequences that retired during this step.
+
+        """
+        if self._traced and self._trace is None:
+            self._trace = contextlib.ExitStack()
+            self._trace.enter_context(PROFILER.trace("scheduler"))
+        try:
+            self._drop_cancelled()
+            self._admit()
+            finished = self._prefill()
+            if self.running:
+                finished += self._decode()
+        finally:
+            if self._trace is not None and not self._traced:
+                self._stop_trace()
+        return finished
+
+    def _stop_trace(self) -> None:
+        trace, self._trace = self._trace, None
+        if trace is not None:
+            trace.close()
+
+    def _drop_cancelled(self) -> None:
+        with self._cond:
+            cancelled = [s for s in self.waiting if s.future.cancelled()]
+            for sequence in cancelled:
+                self.waiting.remove(sequence)
+        cancelled += [s for s in self.prefilling + self.running if s.future.cancelled()]
+        for sequence in cancelled:
+            self._retire(sequence, CancelledError())
+
+    def _admit(self) -> None:
+        while True:
+            with self._cond:
+                if not self.waiting or not self.free_slots:
+                    break
+                sequence = self.waiting[0]
+                if self.block_manager is not None and not self.block_manager.can_allocate(
+                    self.free_slots[0], sequence.num_tokens
+                ):
+                    break
+                self.waiting.popleft()
+                sequence.slot = self.free_slots.popleft()
+            self.prefilling.append(sequence)
+
+            # preempted sequences resume by prefilling what they generated so far
+            prompt_tokens = sequence.prompt_tokens + sequence.output_tokens
+            sequence.prefilled = 0
+            if self.prefix_cache is not None:
+                cached_blocks = self.prefix_cache.match(prompt_tokens)
+                self.block_manager.share(sequence.slot, cached_blocks)
+                sequence.prefilled = len(cached_blocks) * self.block_manager.block_size
+            if self.block_manager is not None:
+                self.block_manager.allocate(sequence.slot, sequence.num_tokens)
+
+    def _prefill(self) -> List[Sequence]:
+        finished = []
+        budget = self.prefill_chunk_size or None
+        for sequence in list(self.prefilling):
+            if budget == 0:
+                break
+            prompt_tokens = sequence.prompt_tokens + sequence.output_tokens
+            end = len(prompt_tokens)
+            if budget is not None:
+                end = min(end, sequence.prefilled + budget)
+                budget -= end - sequence.prefilled
+
+            tokens = torch.tensor(
+                [prompt_tokens[sequence.prefilled : end]], dtype=torch.long, device=self.device
+            )
+            slots = torch.tensor([sequence.slot], dtype=torch.long, device=self.device)
+            with PROFILER.phase("prefill"):
+                logits = self.llama.model.forward(tokens, sequence.prefilled, slots=slots)
+            sequence.prefilled = end
+            if end < len(prompt_tokens):
+                continue
+
+            self.prefilling.remove(sequence)
+            self.running.append(sequence)
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(
+                    prompt_tokens, self.block_manager.row_blocks[sequence.slot]
+                )
+            next_token = self._sample(logits[:, -1], [sequence])
+            finished += self._append(next_token, [sequence])
+        return finished
+
+    def _reserve(self) -> None:
+        """
+        Make sure every running sequence has KV cache blocks for its next token. When the pool runs
+        dry the sequences still prefilling and then the most recently admitted running ones are
+        preempted and recomputed once blocks free up.
+        """
+        for sequence in list(self.running):
+            while sequence.slot is not None and not self.block_manager.can_allocate(
+                sequence.slot, sequence.num_tokens
+            ):
+                self._preempt(self.prefilling[-1] if self.prefilling else self.running[-1])
+            if sequence.slot is not None:
+                self.block_manager.allocate(sequence.slot, sequence.num_tokens)
+
+    def _preempt(self, sequence: Sequence) -> None:
+        if sequence in self.prefilling:
+            self.prefilling.remove(sequence)
+        else:
+            self.running.remove(sequence)
+        with self._cond:
+            self.block_manager.free(sequence.slot)
+            self.free_slots.append(sequence.slot)
+            sequence.slot = None
+            self.waiting.appendleft(sequence)
+
+    def _decode(self) -> List[Sequence]:
+        if self.block_manager is not None:
+            self._reserve()
+        if not self.running:
+            return []
+        batch = list(self.running)
+        tokens = torch.tensor(
+            [[s.output_tokens[-1]] for s in batch], dtype=torch.long, device=self.device
+        )
+        start_pos = torch.tensor([s.num_tokens - 1 for s in batch], device=self.device)
+        slots = torch.tensor([s.slot for s in batch], dtype=torch.long, device=self.device)
+        with PROFILER.phase("decode_step"):
+            logits = self.llama.model.forward(
+                tokens, start_pos, slots=slots, kv_len=max(s.num_tokens for s in batch)
+            )
+        return self._append(self._sample(logits[:, -1], batch), batch)
+
+    def _sample(self, logits: torch.Tensor, batch: List[Sequence]) -> List[int]:
+        with PROFILER.phase("sample"):
+            return self._sample_tokens(logits, batch)
+
+    def _sample_tokens(self, logits: torch.Tensor, batch: List[Sequence]) -> List[int]:
+        if all(s.temperature == 0 for s in batch):
+            return torch.argmax(logits, dim=-1).tolist()
+        temperature = torch.tensor([s.temperature for s in batch], device=self.device)
+        top_p = torch.tensor([s.top_p for s in batch], device=self.device)
+        generators = None
+        if any(s.generator is not None for s in batch):
+            generators = [s.generator for s in batch]
+        top_k = min_p = None
+        if any(s.top_k for s in batch):
+            top_k = torch.tensor([s.top_k for s in batch], device=self.device)
+        if any(s.min_p for s in batch):
+            min_p = torch.tensor([s.min_p for s in batch], device=self.device)
+        return sample(logits, temperature, top_p, generators, top_k=top_k, min_p=min_p).tolist()
+
+    def _append(self, next_tokens: List[int], batch: List[Sequence]) -> List[Sequence]:
+        finished = []
+        for sequence, token in zip(batch, next_tokens):
+            if token == self.eos_id or (sequence.stop and sequence.stop.is_stop_token(token)):
+                finished.append(sequence)
+                continue
+            sequence.output_tokens.append(token)
+            if sequence.first_token_at is None:
+                sequence.first_token_at = time.perf_counter()
+            if sequence.on_token:
+                sequence.on_token(token)
+            if (
+                len(sequence.output_tokens) >= sequence.max_gen_len
+                or sequence.num_tokens >= self.params.max_seq_len
+                or (sequence.stop and sequence.stop.push(token))
+            ):
+                finished.append(sequence)
+        for sequence in finished:
+            self._retire(sequence)
+        return finished
+
+    def _retire(self, sequence: Sequence, exc: Optional[BaseException] = None) -> None:
+        if sequence in self.running:
+            self.running.remove(sequence)
+        if sequence in self.prefilling:
+            self.prefilling.remove(sequence)
+        with self._cond:
+            if sequence.slot is not None:
+                if self.prefix_cache is not None and exc is None:
+                    # the last generated token was never fed to the model
+                    written = sequence.prompt_tokens + sequence.output_tokens[:-1]
+                    self.prefix_cache.insert(written, self.block_manager.row_blocks[sequence.slot])
+                if self.block_manager is not None:
+                    self.block_manager.free(sequence.slot)
+                self.free_slots.append(sequence.slot)
+                sequence.slot = None
+        if sequence.trace and not sequence.finished:
+            with self._cond:
+                self._traced -= 1
+        sequence.finished = True
+        sequence.finished_at = time.perf_counter()
+        try:
+            if exc is not None:
+                sequence.future.set_exception(exc)
+            else:
+                sequence.future.set_result(sequence.output_tokens)
+        except InvalidStateError:
+            # cancelled by the client meanwhile, nobody waits for the result
+            pass
+
+    def start(self) -> None:
+        """Run the scheduling loop in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="llama-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain: bool = False) -> None:
+        """
+        Stop the background loop, pending sequences fail with RuntimeError.
+
+        Args:
+            drain (bool, optional): Finish the sequences submitted so far first. Defaults to False.
+        """
+        with self._cond:
+            self._stopped = True
+            self._drain = drain
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        exc = RuntimeError("Scheduler stopped")
+        for sequence in self.prefilling + self.running + list(self.waiting):
+            self._retire(sequence, exc)
+        self.waiting.clear()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self.has_unfinished() and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not (self._drain and self.has_unfinished()):
+                    break
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception(e)
+                for sequence in self.prefilling + self.running:
+                    self._retire(sequence, e)
+                if not self._traced:
+                    self._stop_trace()
+        # the trace has to stop in the thread that started it
+        self._stop_trace()
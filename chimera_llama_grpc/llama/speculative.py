@@ -0,0 +1,213 @@
+"""
+Speculative decoding: a small draft model proposes tokens that the target model verifies in a single
+forward pass.
+
+Proposals are accepted with probability min(1, p / q) and the first rejected one is resampled from
+the residual max(0, p - q), so the output follows exactly the target distribution (Leviathan et al.,
+"Fast Inference from Transformers via Speculative Decoding"). Greedy rows use one-hot distributions,
+which makes the output identical to greedy decoding of the target alone.
+"""
+
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
+
+import torch
+
+from chimera_llama_grpc.llama.sampling import multinomial
+
+if TYPE_CHECKING:
+    from chimera_llama_grpc.llama.generation import Llama
+
+
+class SpeculativeStats:
+    """Counters of speculative decoding, cumulative over generate calls."""
+
+    def __init__(self):
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+        self.seconds = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_round(self) -> float:
+        return self.generated / self.rounds if self.rounds else 0.0
+
+    @property
+    def tokens_per_s(self) -> float:
+        return self.generated / self.seconds if self.seconds else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "rounds": self.rounds,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "generated": self.generated,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_round": self.tokens_per_round,
+            "tokens_per_s": self.tokens_per_s,
+        }
+
+
+def warped_probs(
+    logits: torch.Tensor, temperature: torch.Tensor, top_p: torch.Tensor
+) -> torch.Tensor:
+    """
+    The distribution sampling draws from: softmax(logits / temperature) restricted to the top_p
+    nucleus, or one-hot on the argmax for rows with temperature 0.
+
+    Args:
+        logits (torch.Tensor): Logits of shape (bsz, n, vocab_size).
+        temperature (torch.Tensor): Temperature of every row, of shape (bsz,).
+        top_p (torch.Tensor): Top-p threshold of every row, of shape (bsz,).
+
+    Returns:
+        torch.Tensor: Probabilities of shape (bsz, n, vocab_size).
+    """
+    logits = logits.float()
+    temperature = temperature.to(logits)[:, None, None]
+    probs = torch.softmax(logits / temperature.clamp(min=1e-5), dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    probs_sort[torch.cumsum(probs_sort, dim=-1) - probs_sort > top_p.to(logits)[:, None, None]] = (
+        0.0
+    )
+    probs = torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
+    probs.div_(probs.sum(dim=-1, keepdim=True))
+    greedy = torch.nn.functional.one_hot(logits.argmax(dim=-1), logits.shape[-1]).to(probs)
+    return torch.where(temperature > 0, probs, greedy)
+
+
+@torch.inference_mode()
+def speculative_generate(
+    llama: "Llama",
+    prompt_tokens: List[List[int]],
+    max_gen_lens: Sequence[int],
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    num_speculative_tokens: int,
+    stats: Optional[SpeculativeStats] = None,
+) -> List[List[int]]:
+    """
+    Generate with llama.draft proposing num_speculative_tokens tokens per round.
+
+    Every round feeds the last token and the proposals to the target in one forward pass with
+    per-row positions, so rows accept different numbers of tokens without padding. Both KV caches
+    stay valid up to the last accepted token; entries of rejected proposals are masked out and
+    overwritten by the next round.
+
+    Args:
+        llama (Llama): Target model with a draft attached.
+        prompt_tokens (List[List[int]]): Tokenized prompts.
+        max_gen_lens (Sequence[int]): Maximum number of generated tokens of every prompt.
+        temperature (torch.Tensor): Temperature of every prompt, of shape (bsz,).
+        top_p (torch.Tensor): Top-p threshold of every prompt, of shape (bsz,).
+        num_speculative_tokens (int): Draft proposals per round.
+        stats (SpeculativeStats, optional): Updated with acceptance and throughput counters.
+
+    Returns:
+        List[List[int]]: Generated tokens of every prompt, without the prompt and EOS.
+    """
+    target, draft = llama.model, llama.draft.model
+    device = llama.device
+    max_seq_len = min(target.params.max_seq_len, draft.params.max_seq_len)
+    eos_id = llama.tokenizer.eos_id
+    bsz = len(prompt_tokens)
+
+    sequences = [list(t) for t in prompt_tokens]
+    limits = [min(max_seq_len, len(t) + n) for t, n in zip(prompt_tokens, max_gen_lens)]
+    for model in (target, draft):
+        if model.block_manager is not None:
+            for row in range(bsz):
+                model.block_manager.allocate(
+                    row, min(max_seq_len, limits[row] + num_speculative_tokens)
+                )
+
+    # the caches hold every token but the last one, which the next round feeds
+    for row, tokens in enumerate(sequences):
+        if len(tokens) > 1:
+            slots = torch.tensor([row], device=device)
+            prefix = torch.tensor([tokens[:-1]], dtype=torch.long, device=device)
+            target.forward(prefix, 0, slots=slots)
+            draft.forward(prefix, 0, slots=slots)
+
+    active = [row for row in range(bsz) if len(sequences[row]) < limits[row]]
+    while active:
+        start = time.perf_counter()
+        lengths = [len(sequences[row]) for row in active]
+        # the last proposal is written at position length - 1 + k
+        k = min([num_speculative_tokens] + [max_seq_len - n for n in lengths])
+        slots = torch.tensor(active, device=device)
+        start_pos = torch.tensor(lengths, device=device) - 1
+        row_temperature, row_top_p = temperature[slots], top_p[slots]
+        last = torch.tensor([[sequences[row][-1]] for row in active], device=device)
+
+        proposals, proposal_probs = [], []
+        tokens = last
+        for i in range(k + 1):
+            logits = draft.forward(tokens, start_pos + i, slots=slots, kv_len=max(lengths) + i)
+            # the last proposal is only fed to keep the draft cache in step with the target
+            if i == k:
+                break
+            q = warped_probs(logits[:, -1:], row_temperature, row_top_p)[:, 0]
+            tokens = multinomial(q)
+            proposals.append(tokens)
+            proposal_probs.append(q)
+
+        logits = target.forward(
+            torch.cat([last] + proposals, dim=1), start_pos, slots=slots, kv_len=max(lengths) + k
+        )
+        p = warped_probs(logits, row_temperature, row_top_p)
+        rows = torch.arange(len(active), device=device)
+        if k:
+            proposed = torch.cat(proposals, dim=1)
+            q = torch.stack(proposal_probs, dim=1)
+            p_proposed = p[:, :k].gather(-1, proposed[..., None])[..., 0]
+            q_proposed = q.gather(-1, proposed[..., None])[..., 0]
+            accepted = torch.rand(p_proposed.shape, device=device) < p_proposed / q_proposed
+            num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+            # resample the first rejected position from max(0, p - q), or take a bonus token from
+            # the target when every proposal was accepted
+            q = torch.cat([q, torch.zeros_like(q[:, :1])], dim=1)
+            residual = (p[rows, num_accepted] - q[rows, num_accepted]).clamp_(min=0)
+            residual_sum = residual.sum(dim=-1, keepdim=True)
+            next_probs = torch.where(
+                residual_sum > 0, residual / residual_sum.clamp(min=1e-12), p[rows, num_accepted]
+            )
+        else:
+            proposed = torch.zeros((len(active), 0), dtype=torch.long, device=device)
+            num_accepted = torch.zeros(len(active), dtype=torch.long, device=device)
+            next_probs = p[:, 0]
+        next_tokens = multinomial(next_probs)[:, 0]
+
+        finished = []
+        for row, row_proposed, n, next_token in zip(
+            active, proposed.tolist(), num_accepted.tolist(), next_tokens.tolist()
+        ):
+            new_tokens = row_proposed[:n] + [next_token]
+            if stats is not None:
+                stats.proposed += k
+                stats.accepted += n
+            for token in new_tokens:
+                if token == eos_id:
+                    finished.append(row)
+                    break
+                sequences[row].append(token)
+                if stats is not None:
+                    stats.generated += 1
+                if len(sequences[row]) >= limits[row]:
+                    finished.append(row)
+                    break
+        active = [row for row in active if row not in finished]
+        if stats is not None:
+            stats.rounds += 1
+            stats.seconds += time.perf_counter() - start
+
+    for model in (target, draft):
+        if model.block_manager is not None:
+            for row in range(bsz):
+                model.block_manager.free(row)
+    return [tokens[len(prompt) :] for tokens, prompt in zip(sequences, prompt_tokens)]
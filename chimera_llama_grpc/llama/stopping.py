@@ -0,0 +1,176 @@
+"""
+Per-request stop token IDs and stop strings.
+
+Generation of a row ends on one of its stop token IDs (which, like EOS, is not part of the output) or
+on the token that completes one of its stop strings. Tokens only approximate text, so the generated
+tokens still contain the stop string and the text is cut right before it with truncate_at_stop, or
+StopStringFilter while streaming.
+"""
+
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+from chimera_llama_grpc.llama.tokenizer import IncrementalDetokenizer, Tokenizer
+
+Stop = Union[str, Sequence[str], None]
+
+
+def stop_strings(stop: Stop) -> List[str]:
+    """The non-empty stop strings of a request, which may give one string or a list."""
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    return [s for s in stop if s]
+
+
+def _first_stop(text: str, stop: Sequence[str], start: int = 0) -> Optional[Tuple[int, int]]:
+    # the stop string that is completed first, the earliest one if several end at the same place
+    found = None
+    for s in stop:
+        i = text.find(s, start)
+        if i >= 0 and (found is None or (i + len(s), i) < found):
+            found = (i + len(s), i)
+    return found
+
+
+def truncate_at_stop(text: str, stop: Stop, start: int = 0) -> str:
+    """
+    Cut text right before the first stop string it contains.
+
+    Args:
+        text (str): Generated text.
+        stop (Stop): A stop string or a list of them.
+        start (int, optional): Where the generation starts in text, e.g. after an echoed prompt.
+            Defaults to 0.
+
+    Returns:
+        str: text up to the stop string, or all of it.
+    """
+    found = _first_stop(text, stop_strings(stop), start)
+    return text if found is None else text[: found[1]]
+
+
+class StopCriteria:
+    """
+    Decides when a single row stops, fed with its generated tokens one at a time.
+
+    Stop strings are looked for in the text of the new token plus just enough of the text before it,
+    so checking a token costs the same however long the generation is.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        stop: Stop = None,
+        stop_token_ids: Optional[Iterable[int]] = None,
+    ):
+        """
+        Initialize the StopCriteria.
+
+        Args:
+            tokenizer (Tokenizer): The tokenizer of the model.
+            stop (Stop, optional): A stop string or a list of them. Defaults to None.
+            stop_token_ids (Optional[Iterable[int]], optional): Tokens ending the generation.
+                Defaults to None.
+        """
+        self.stop = stop_strings(stop)
+        self.stop_token_ids = frozenset(stop_token_ids or ())
+        self.detokenizer = IncrementalDetokenizer(tokenizer) if self.stop else None
+        self.keep = max((len(s) for s in self.stop), default=1) - 1
+        self.tail = ""
+
+    def __bool__(self) -> bool:
+        return bool(self.stop or self.stop_token_ids)
+
+    def is_stop_token(self, token: int) -> bool:
+        """Whether token is a stop token ID, it ends the row without being part of the output."""
+        return token in self.stop_token_ids
+
+    def push(self, token: int) -> bool:
+        """
+        Append a generated token.
+
+        Args:
+            token (int): The next generated token, not a stop token ID.
+
+        Returns:
+            bool: Whether the token completed a stop string.
+        """
+        if self.detokenizer is None:
+            return False
+        delta = self.detokenizer.push_row(0, token)
+        if not delta:
+            return False
+        window = self.tail + delta
+        if any(s in window for s in self.stop):
+            return True
+        self.tail = window[len(window) - self.keep :] if self.keep else ""
+        return False
+
+    def truncate(self, tokens: Sequence[int]) -> List[int]:
+        """
+        Cut generated tokens after the first stop, for generations that did not stop by themselves.
+
+        Args:
+            tokens (Sequence[int]): Generated tokens.
+
+        Returns:
+            List[int]: The tokens before the first stop token ID, or up to the token completing the
+                first stop string.
+        """
+        for i, token in enumerate(tokens):
+            if self.is_stop_token(token):
+                return list(tokens[:i])
+            if self.push(token):
+                return list(tokens[: i + 1])
+        return list(tokens)
+
+
+class StopStringFilter:
+    """
+    Streams text while hiding stop strings: text that may be the start of a stop string is held back
+    until it is known not to be, and nothing is emitted from the first stop string on.
+    """
+
+    def __init__(self, stop: Stop):
+        """
+        Initialize the StopStringFilter.
+
+        Args:
+            stop (Stop): A stop string or a list of them.
+        """
+        self.stop = stop_strings(stop)
+        self.held = ""
+        self.stopped = False
+
+    def push(self, text: str) -> str:
+        """
+        Append streamed text and return the part that can be emitted.
+
+        Args:
+            text (str): New text.
+
+        Returns:
+            str: The text to emit, possibly empty.
+        """
+        if self.stopped:
+            return ""
+        text = self.held + text
+        found = _first_stop(text, self.stop)
+        if found is not None:
+            self.stopped = True
+            self.held = ""
+            return text[: found[1]]
+        held = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(text)), held, -1):
+                if text.endswith(s[:n]):
+                    held = n
+                    break
+        self.held = text[len(text) - held :] if held else ""
+        return text[: len(text) - held]
+
+    def flush(self) -> str:
+        """Return the held back text at the end of the stream."""
+        text, self.held = self.held, ""
+        return "" if self.stopped else text
@@ -0,0 +1,113 @@
+"""
+Tiny randomly initialised Llama models for tests and CPU benchmarks.
+
+Nothing here loads real weights, the outputs are meaningless text, but every code path
+(tokenizer, KV cache, sampling, scheduling) runs exactly as it does for a real checkpoint.
+"""
+
+import io
+import random
+from pathlib import Path
+from typing import Union
+
+import torch
+from fairscale.nn.model_parallel.initialize import (
+    initialize_model_parallel,
+    model_parallel_is_initialized,
+)
+
+from chimera_llama_grpc.llama.generation import Llama
+from chimera_llama_grpc.llama.model import ModelArgs, Transformer
+from chimera_llama_grpc.llama.tokenizer import Tokenizer
+
+TINY_MODEL_PARAMS = {
+    "dim": 64,
+    "n_layers": 2,
+    "n_heads": 4,
+    "n_kv_heads": 2,
+    "multiple_of": 32,
+    "norm_eps": 1e-5,
+}
+
+_WORDS = (
+    "the quick brown fox jumps over lazy dog llama model server request token cache batch "
+    "stream user assistant system hello world what is your name please answer question"
+).split()
+
+
+def build_tiny_tokenizer(tokenizer_path: Union[Path, str], vocab_size: int = 300) -> Path:
+    """
+    Train a small SentencePiece BPE model with byte fallback and write it to tokenizer_path.
+
+    Byte fallback makes every unicode string encodable, so multi-token characters can be tested.
+    """
+    import sentencepiece as spm
+
+    rng = random.Random(0)
+    sentences = [" ".join(rng.choice(_WORDS) for _ in range(12)) for _ in range(2000)]
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(sentences),
+        model_writer=model,
+        vocab_size=vocab_size,
+        model_type="bpe",
+        byte_fallback=True,
+        character_coverage=1.0,
+        unk_id=0,
+        bos_id=1,
+        eos_id=2,
+        pad_id=-1,
+        minloglevel=2,
+    )
+    tokenizer_path = Path(tokenizer_path)
+    tokenizer_path.write_bytes(model.getvalue())
+    return tokenizer_path
+
+
+def init_model_parallel() -> None:
+    """Initialize a single process gloo group so fairscale layers can be built on CPU."""
+    if not torch.distributed.is_initialized():
+        torch.distributed.init_process_group(
+            "gloo", store=torch.distributed.HashStore(), rank=0, world_size=1
+        )
+    if not model_parallel_is_initialized():
+        initialize_model_parallel(1)
+
+
+def build_tiny_llama(
+    tokenizer_path: Union[Path, str],
+    max_seq_len: int = 128,
+    max_batch_size: int = 8,
+    seed: int = 1,
+    **params,
+) -> Llama:
+    """
+    Build a Llama with random weights on CPU.
+
+    Args:
+        tokenizer_path (Union[Path, str]): Path to a SentencePiece model, see build_tiny_tokenizer.
+        max_seq_len (int): Maximum sequence length. Defaults to 128.
+        max_batch_size (int): Maximum batch size. Defaults to 8.
+        seed (int): Seed for the random weights. Defaults to 1.
+        **params: Overrides for TINY_MODEL_PARAMS.
+
+    Returns:
+        Llama: A Llama instance with a randomly initialised Transformer.
+    """
+    init_model_parallel()
+    torch.manual_seed(seed)
+
+    tokenizer = Tokenizer(model_path=str(tokenizer_path))
+    model_args = ModelArgs(
+        max_seq_len=max_seq_len,
+        max_batch_size=max_batch_size,
+        **{**TINY_MODEL_PARAMS, **params},
+    )
+    model_args.vocab_size = tokenizer.n_words
+    model = Transformer(model_args)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            # fairscale layers are created with an identity init_method, i.e. uninitialised memory
+            if not name.endswith("norm.weight"):
+                param.normal_(mean=0.0, std=0.2)
+    return Llama(model, tokenizer)
@@ -2,23 +2,36 @@
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
 import os
+import threading
+from collections import OrderedDict
 from logging import getLogger
-from typing import List
+from typing import List, Optional, Sequence, Tuple, Union
 
 from sentencepiece import SentencePieceProcessor
 
+from chimera_llama_grpc.llama.profiling import PROFILER
+
 logger = getLogger()
 
+# SentencePiece marks the spaces of the input with U+2581 in its pieces
+SPACE_MARKER = "\u2581"
+
 
 class Tokenizer:
     """tokenizing and encoding/decoding text using SentencePiece."""
 
-    def __init__(self, model_path: str):
+    # longer strings are not cached, they are rarely repeated verbatim and would bloat the cache
+    cache_max_chars = 16384
+
+    def __init__(self, model_path: str, cache_size: int = 4096):
         """
         Initializes the Tokenizer with a SentencePiece model.
 
         Args:
             model_path (str): The path to the SentencePiece model file.
+            cache_size (int, optional): Encoded strings kept in an LRU cache, system prompts and
+                the history of a chat are sent again with every turn. 0 disables it.
+                Defaults to 4096.
         """
         # reload tokenizer
         assert os.path.isfile(model_path), model_path
@@ -33,6 +46,14 @@ class Tokenizer:
         logger.info(f"#words: {self.n_words} - BOS ID: {self.bos_id} - EOS ID: {self.eos_id}")
         assert self.sp_model.vocab_size() == self.sp_model.get_piece_size()
 
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._token_texts: Optional[List[str]] = None
+        self._piece_table: Optional[List[Union[str, int, None]]] = None
+
     def encode(self, s: str, bos: bool, eos: bool) -> List[int]:
         """
         Encodes a string into a list of token IDs.
@@ -46,12 +67,57 @@ class Tokenizer:
             List[int]: A list of token IDs.
         """
         assert type(s) is str
-        t = self.sp_model.encode(s)
-        if bos:
-            t = [self.bos_id] + t
-        if eos:
-            t = t + [self.eos_id]
-        return t
+        return self.encode_batch([s], bos, eos)[0]
+
+    def encode_batch(self, texts: Sequence[str], bos: bool, eos: bool) -> List[List[int]]:
+        """
+        Encodes strings into lists of token IDs, the ones missing from the cache in a single
+        SentencePiece call.
+
+        Args:
+            texts (Sequence[str]): The input strings to be encoded.
+            bos (bool): Whether to prepend the beginning-of-sequence token to each.
+            eos (bool): Whether to append the end-of-sequence token to each.
+
+        Returns:
+            List[List[int]]: A list of token IDs per string.
+        """
+        with PROFILER.phase("encode"):
+            encoded = self._lookup(texts)
+            missing = [i for i, t in enumerate(encoded) if t is None]
+            if missing:
+                tokens = self.sp_model.encode([texts[i] for i in missing])
+                for i, t in zip(missing, tokens):
+                    encoded[i] = tuple(t)
+                self._store([texts[i] for i in missing], [encoded[i] for i in missing])
+        prefix = [self.bos_id] if bos else []
+        suffix = [self.eos_id] if eos else []
+        return [prefix + list(t) + suffix for t in encoded]
+
+    def _lookup(self, texts: Sequence[str]) -> List[Optional[Tuple[int, ...]]]:
+        if not self.cache_size:
+            return [None] * len(texts)
+        encoded = []
+        with self._cache_lock:
+            for text in texts:
+                tokens = self._cache.get(text)
+                if tokens is not None:
+                    self._cache.move_to_end(text)
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+                encoded.append(tokens)
+        return encoded
+
+    def _store(self, texts: List[str], encoded: List[Tuple[int, ...]]) -> None:
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            for text, tokens in zip(texts, encoded):
+                if len(text) <= self.cache_max_chars:
+                    self._cache[text] = tokens
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
     def decode(self, t: List[int]) -> str:
         """
@@ -63,4 +129,241 @@ class Tokenizer:
         Returns:
             str: The decoded string.
         """
-        return self.sp_model.decode(t)
+        with PROFILER.phase("detokenize"):
+            return self.sp_model.decode(t)
+
+    def decode_batch(self, token_lists: Sequence[List[int]]) -> List[str]:
+        """
+        Decodes lists of token IDs into strings in a single SentencePiece call.
+
+        Args:
+            token_lists (Sequence[List[int]]): The lists of token IDs to be decoded.
+
+        Returns:
+            List[str]: The decoded strings.
+        """
+        if not token_lists:
+            return []
+        with PROFILER.phase("detokenize"):
+            return self.sp_model.decode([list(t) for t in token_lists])
+
+    def token_texts(self, t: Sequence[int]) -> List[str]:
+        """
+        The text of every token on its own, as decode([token]) returns it, from a table built on
+        first use.
+
+        Args:
+            t (Sequence[int]): Token IDs.
+
+        Returns:
+            List[str]: One string per token.
+        """
+        if self._token_texts is None:
+            self._token_texts = self.sp_model.decode([[i] for i in range(self.n_words)])
+        return [self._token_texts[i] for i in t]
+
+    def piece_table(self) -> List[Union[str, int, None]]:
+        """
+        What every token contributes to decoded text, built on first use: the piece with its
+        leading-space markers turned into spaces, the byte of a byte-fallback piece, or None for
+        control tokens, see IncrementalDetokenizer.
+
+        Returns:
+            List[Union[str, int, None]]: One entry per token ID.
+        """
+        if self._piece_table is None:
+            sp = self.sp_model
+            table: List[Union[str, int, None]] = []
+            for i in range(self.n_words):
+                if sp.is_control(i):
+                    table.append(None)
+                elif sp.is_byte(i):
+                    table.append(int(sp.id_to_piece(i)[1:-1], 16))
+                elif sp.is_unknown(i):
+                    table.append(sp.decode([i]))
+                else:
+                    table.append(sp.id_to_piece(i).replace(SPACE_MARKER, " "))
+            self._piece_table = table
+        return self._piece_table
+
+
+def _utf8_length(lead: int) -> int:
+    if lead < 0x80:
+        return 1
+    if 0xC2 <= lead <= 0xDF:
+        return 2
+    if 0xE0 <= lead <= 0xEF:
+        return 3
+    if 0xF0 <= lead <= 0xF4:
+        return 4
+    return 0
+
+
+def decode_bytes(buffer: Union[bytes, bytearray], final: bool) -> Tuple[str, int]:
+    """
+    Decode byte-fallback bytes the way SentencePiece does, every byte of an invalid or incomplete
+    UTF-8 sequence becomes its own U+FFFD.
+
+    Args:
+        buffer (Union[bytes, bytearray]): Bytes of consecutive byte-fallback pieces.
+        final (bool): Whether more bytes may follow. If they may, an incomplete character at the end
+            is left undecoded.
+
+    Returns:
+        Tuple[str, int]: The decoded text and the number of bytes it consumed.
+    """
+    text = []
+    i, n = 0, len(buffer)
+    while i < n:
+        length = _utf8_length(buffer[i])
+        if length and i + length > n:
+            if not final and all(0x80 <= b <= 0xBF for b in buffer[i + 1 :]):
+                break
+            length = 0
+        if length:
+            try:
+                text.append(bytes(buffer[i : i + length]).decode("utf-8"))
+                i += length
+                continue
+            except UnicodeDecodeError:
+                pass
+        text.append("\ufffd")
+        i += 1
+    return "".join(text), i
+
+
+class IncrementalDetokenizer:
+    """
+    Decode token streams of several rows incrementally: every appended token costs a table lookup,
+    instead of decoding the whole generation again.
+
+    The text of a row after all its tokens were pushed and the row flushed is exactly
+    Tokenizer.decode of its tokens: leading-space markers become spaces, except at the start of the
+    text, and byte-fallback pieces are held back until they form complete characters.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, batch_size: int = 1):
+        """
+        Initializes the IncrementalDetokenizer.
+
+        Args:
+            tokenizer (Tokenizer): The tokenizer used to encode the tokens.
+            batch_size (int, optional): Number of rows. Defaults to 1.
+        """
+        self.table = tokenizer.piece_table()
+        self.unk_id = tokenizer.sp_model.unk_id()
+        # bytes of byte-fallback pieces not decoded yet, and whether a row has any text yet
+        self.pending = [bytearray() for _ in range(batch_size)]
+        self.started = [False] * batch_size
+
+    def push(self, tokens: Sequence[Optional[int]]) -> List[str]:
+        """
+        Appends one token to every row and returns the text each completes.
+
+        Args:
+            tokens (Sequence[Optional[int]]): The next token of every row, None leaves a row
+                unchanged. A tensor is accepted as well.
+
+        Returns:
+            List[str]: The new text of every row, possibly empty.
+        """
+        if hasattr(tokens, "tolist"):
+            tokens = tokens.tolist()
+        return [self.push_row(row, token) for row, token in enumerate(tokens)]
+
+    def push_row(self, row: int, token: Optional[int]) -> str:
+        """
+        Appends a token to a single row and returns the text it completes.
+
+        Args:
+            row (int): The row.
+            token (Optional[int]): The next token, None is a no-op.
+
+        Returns:
+            str: The new text, possibly empty.
+        """
+        if token is None:
+            return ""
+        piece = self.table[token]
+        pending = self.pending[row]
+        if type(piece) is str and not pending and self.started[row]:
+            return piece
+        if type(piece) is int:
+            self.started[row] = True
+            pending.append(piece)
+            text, consumed = decode_bytes(pending, final=False)
+            del pending[:consumed]
+            return text
+        text = ""
+        if pending:
+            text = decode_bytes(pending, final=True)[0]
+            pending.clear()
+        if piece is None:
+            return text
+        if not self.started[row]:
+            # SentencePiece drops the space it prepended to the input when encoding, from every
+            # piece until one leaves some text
+            if token != self.unk_id and piece.startswith(" "):
+                piece = piece[1:]
+            self.started[row] = bool(piece)
+        return text + piece
+
+    def flush(self) -> List[str]:
+        """
+        Returns whatever text every row still holds back, i.e. an incomplete character at the end.
+
+        Returns:
+            List[str]: The remaining text of every row, possibly empty.
+        """
+        return [self.flush_row(row) for row in range(len(self.pending))]
+
+    def flush_row(self, row: int) -> str:
+        """
+        Returns whatever text a row still holds back.
+
+        Args:
+            row (int): The row.
+
+        Returns:
+            str: The remaining text, possibly empty.
+        """
+        text = decode_bytes(self.pending[row], final=True)[0]
+        self.pending[row].clear()
+        return text
+
+
+class StreamDecoder:
+    """Turn a growing list of token IDs into text deltas for streaming."""
+
+    def __init__(self, tokenizer: Tokenizer):
+        """
+        Initializes the StreamDecoder.
+
+        Args:
+            tokenizer (Tokenizer): The tokenizer used to decode tokens.
+        """
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+
+    def push(self, token: int) -> str:
+        """
+        Appends a token and returns the text it completes.
+
+        A character split over several byte-fallback tokens is held back until all of its bytes
+        arrived.
+
+        Args:
+            token (int): The next generated token ID.
+
+        Returns:
+            str: The new text, possibly empty.
+        """
+        return self.detokenizer.push_row(0, token)
+
+    def flush(self) -> str:
+        """
+        Returns whatever text is still held back, e.g. an incomplete character at the end.
+
+        Returns:
+            str: The remaining text, possibly empty.
+        """
+        return self.detokenizer.flush_row(0)
@@ -0,0 +1,354 @@
+"""
+Counters, gauges and histograms exported in the Prometheus text format.
+
+Metrics live in a process wide REGISTRY and are updated from the gRPC handlers, the scheduler thread
+and model loading. Gauges describing current state (queue depth, batch occupancy, KV cache use) are
+set right before every scrape by the collectors added to the registry. start_metrics_server serves
+them on ``http://<host>:<port>/metrics``.
+"""
+
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from chimera_llama_grpc.log import logger
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+LOAD_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """A named metric with one value per combination of label values."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def value(self, **labels: str):
+        """Current value of a label combination, None if it was never set."""
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of every sample."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", _format_labels(self.labelnames, key), value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count of the observed values."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # counts per bucket (the last one is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        with self._lock:
+            items = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                yield "_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """The metrics of a process and the collectors refreshing gauges before a scrape."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Call collector before every render, e.g. to set gauges from the scheduler state."""
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]) -> None:
+        self.collectors.remove(collector)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.exception(e)
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+RPC_DURATION = REGISTRY.register(
+    Histogram("chimera_rpc_duration_seconds", "Latency of gRPC calls.", ("method", "status"))
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.register(
+    Histogram(
+        "chimera_time_to_first_token_seconds",
+        "Time from queuing a generation to its first generated token.",
+        ("model",),
+    )
+)
+GENERATION_DURATION = REGISTRY.register(
+    Histogram(
+        "chimera_generation_duration_seconds",
+        "Time from queuing a generation to its last token.",
+        ("model",),
+    )
+)
+GENERATION_TOKENS_PER_SECOND = REGISTRY.register(
+    Histogram(
+        "chimera_generation_tokens_per_second",
+        "Generated tokens per second of every request.",
+        ("model",),
+        buckets=THROUGHPUT_BUCKETS,
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Counter("chimera_prompt_tokens_total", "Prompt tokens of finished generations.", ("model",))
+)
+GENERATED_TOKENS = REGISTRY.register(
+    Counter("chimera_generated_tokens_total", "Tokens generated.", ("model",))
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("chimera_queue_depth", "Generations waiting for a batch slot.", ("model",))
+)
+RUNNING_SEQUENCES = REGISTRY.register(
+    Gauge("chimera_running_sequences", "Generations in the running batch.", ("model",))
+)
+BATCH_OCCUPANCY = REGISTRY.register(
+    Gauge("chimera_batch_occupancy", "Running generations / max_batch_size.", ("model",))
+)
+KV_CACHE_UTILIZATION = REGISTRY.register(
+    Gauge(
+        "chimera_kv_cache_utilization",
+        "Fraction of the KV cache positions held by running generations.",
+        ("model",),
+    )
+)
+MODEL_LOAD_DURATION = REGISTRY.register(
+    Histogram(
+        "chimera_model_load_duration_seconds",
+        "Model load time by phase (init, open, copy, warmup).",
+        ("model", "phase"),
+        buckets=LOAD_BUCKETS,
+    )
+)
+PHASE_SECONDS = REGISTRY.register(
+    Counter(
+        "chimera_phase_seconds_total",
+        "Time spent per generation phase while profiling is enabled (CHIMERA_PROFILE=1).",
+        ("phase",),
+    )
+)
+PHASE_CALLS = REGISTRY.register(
+    Counter("chimera_phase_calls_total", "Calls per generation phase while profiling.", ("phase",))
+)
+RESIDENT_MODEL_BYTES = REGISTRY.register(
+    Gauge("chimera_resident_model_bytes", "Memory of the resident models.", ("model",))
+)
+PREFIX_CACHE_HIT_RATE = REGISTRY.register(
+    Gauge(
+        "chimera_prefix_cache_hit_rate",
+        "Fraction of the admitted prompts that reused cached KV blocks.",
+        ("model",),
+    )
+)
+PREFIX_CACHE_TOKEN_HIT_RATE = REGISTRY.register(
+    Gauge(
+        "chimera_prefix_cache_token_hit_rate",
+        "Fraction of the admitted prompt tokens found in the prefix cache.",
+        ("model",),
+    )
+)
+PREFIX_CACHE_SAVED_PREFILL_TOKENS = REGISTRY.register(
+    Gauge(
+        "chimera_prefix_cache_saved_prefill_tokens",
+        "Prompt tokens not prefilled thanks to the prefix cache since the model was loaded.",
+        ("model",),
+    )
+)
+PREFIX_CACHE_BLOCKS = REGISTRY.register(
+    Gauge("chimera_prefix_cache_blocks", "KV cache blocks held by the prefix cache.", ("model",))
+)
+SPECULATIVE_ACCEPTANCE_RATE = REGISTRY.register(
+    Gauge(
+        "chimera_speculative_acceptance_rate",
+        "Fraction of the draft model proposals the target model accepted.",
+        ("model",),
+    )
+)
+SPECULATIVE_TOKENS_PER_ROUND = REGISTRY.register(
+    Gauge(
+        "chimera_speculative_tokens_per_round",
+        "Tokens generated per speculative decoding round.",
+        ("model",),
+    )
+)
+SPECULATIVE_TOKENS_PER_SECOND = REGISTRY.register(
+    Gauge(
+        "chimera_speculative_tokens_per_second",
+        "Tokens generated per second by speculative decoding.",
+        ("model",),
+    )
+)
+
+
+def observe_generation(
+    model: str,
+    prompt_len: int,
+    generated: int,
+    submitted_at: float,
+    first_token_at: Optional[float],
+    finished_at: float,
+) -> None:
+    """
+    Record a finished generation, times are time.perf_counter() values.
+
+    Args:
+        model (str): Name of the model.
+        prompt_len (int): Prompt tokens.
+        generated (int): Generated tokens.
+        submitted_at (float): When the generation was queued.
+        first_token_at (Optional[float]): When the first token was sampled, None if none was.
+        finished_at (float): When the last token was sampled.
+    """
+    PROMPT_TOKENS.inc(prompt_len, model=model)
+    GENERATED_TOKENS.inc(generated, model=model)
+    duration = finished_at - submitted_at
+    GENERATION_DURATION.observe(duration, model=model)
+    if first_token_at is not None:
+        TIME_TO_FIRST_TOKEN.observe(first_token_at - submitted_at, model=model)
+    if generated and duration > 0:
+        GENERATION_TOKENS_PER_SECOND.observe(generated / duration, model=model)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.trace(f"Metrics request from {self.address_string()}: {format % args}")
+
+
+def start_metrics_server(
+    port: int, addr: str = "0.0.0.0", registry: Optional[MetricsRegistry] = None
+) -> ThreadingHTTPServer:
+    """
+    Serve registry (REGISTRY by default) over HTTP from a daemon thread.
+
+    Args:
+        port (int): Port to listen on, 0 picks a free one (see server.server_address).
+        addr (str, optional): Address to bind. Defaults to all interfaces.
+        registry (MetricsRegistry, optional): Metrics to serve. Defaults to REGISTRY.
+
+    Returns:
+        ThreadingHTTPServer: The running server, call shutdown() to stop it.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry or REGISTRY})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on http://{addr}:{server.server_address[1]}/metrics")
+    return server
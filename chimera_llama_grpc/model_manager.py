@@ -1,14 +1,19 @@
+import itertools
 import os
 import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from chimera_llm_proto.chimera_llm_pb2 import AvaliableModel, ModelTag
 
 from chimera_llama_grpc.exceptions import NoSuchModel
 from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.scheduler import Scheduler
 from chimera_llama_grpc.log import logger
+from chimera_llama_grpc.metrics import MODEL_LOAD_DURATION
 
 STATUS_NOT_READY = 0
 STATUS_INITLIZING = 1
@@ -28,7 +33,26 @@ class StatusfulModel:
     def __init__(self):
         self.status = STATUS_NOT_READY
         self.model: Optional[Llama] = None
+        self.scheduler: Optional[Scheduler] = None
         self.current_model: Optional[AvaliableModel] = None
+        self.nbytes = 0
+        # load phase ("init", "open", "copy", "warmup") and the fraction of it done
+        self.phase = ""
+        self.progress = 0.0
+
+    @property
+    def progress_description(self) -> str:
+        return f"{self.phase} {self.progress:.0%}" if self.phase else "pending"
+
+
+def model_nbytes(llama: Llama) -> int:
+    """Memory of the parameters and buffers (KV cache included) of llama and its draft model."""
+    models = [llama.model] if llama.draft is None else [llama.model, llama.draft.model]
+    return sum(
+        t.numel() * t.element_size()
+        for model in models
+        for t in itertools.chain(model.parameters(), model.buffers())
+    )
 
 
 class ModelManager:
@@ -41,7 +65,24 @@ class ModelManager:
         model_params: Dict[str, Any],
         *,
         prefer_model_tag: int = ModelTag.CHAT,
+        memory_budget: int = 0,
+        double_buffer: bool = True,
     ) -> None:
+        """
+        Args:
+            ckpt_dir (Union[Path, str]): Directory with one sub directory per model.
+            tokenizer_path (Union[Path, str]): Tokenizer shared by all models.
+            model_params (Dict[str, Any]): Keyword arguments of Llama.build.
+            prefer_model_tag (int, optional): Tag of the model loaded by default.
+                Defaults to ModelTag.CHAT.
+            memory_budget (int, optional): Bytes the resident models may use together. Least
+                recently used models are evicted to stay within it, the model just loaded is always
+                kept.
+                Defaults to 0 (a single resident model).
+            double_buffer (bool, optional): Keep serving the current model while change_model loads
+                the next one, which needs memory for both for the time of the switch. Defaults to
+                True.
+        """
         if not isinstance(ckpt_dir, Path):
             ckpt_dir = Path(ckpt_dir).resolve()
         self.ckpt_dir = ckpt_dir
@@ -59,17 +100,32 @@ class ModelManager:
         if not self.available_models:
             raise FileNotFoundError(f"No available models found in ckpt_dir: {self.ckpt_dir}")
         self.model_host = StatusfulModel()
+        # model_id: loaded model, least recently used first
+        self.resident: "OrderedDict[int, StatusfulModel]" = OrderedDict()
+        # models being loaded, to report their progress
+        self.loading: Dict[int, StatusfulModel] = {}
+        self.memory_budget = memory_budget
+        self.double_buffer = double_buffer
         self.prefer_model_tag = prefer_model_tag
         self.mutex = threading.Lock()
 
     @property
     def model(self):
         if not self.model_host.model:
-            self.change_model()
+            self._load_current()
         return self.model_host.model
 
+    @property
+    def scheduler(self) -> Scheduler:
+        if not self.model_host.model:
+            self._load_current()
+        return self.model_host.scheduler
+
     @property
     def status(self):
+        """Status of the model serving requests, or of the model being loaded if none does yet."""
+        if self.model_host.model is None and self.loading:
+            return next(iter(self.loading.values())).status
         return self.model_host.status
 
     @property
@@ -83,51 +139,280 @@ class ModelManager:
     def refresh_avaliable_models(self) -> None:
         self.available_models = self.retrieve_available_models()
 
-    def _initialize_model(self, model_id: str) -> Llama:
+    def _initialize_model(
+        self, model_id: str, on_progress: Optional[Callable[[str, float], None]] = None
+    ) -> Llama:
         path = self._get_path_from_model_id(model_id)
         if not path:
             raise ValueError(f"Cannot find model path for model_id: {model_id}")
         logger.info(f"Initializing model from path: {path}, params: {self.model_params}")
+        params = dict(self.model_params)
+        draft_model = params.pop("draft_model", None)
+        if draft_model:
+            params["draft_ckpt_dir"] = self._get_draft_path(draft_model).as_posix()
         m = Llama.build(
             path.as_posix(),
             self.tokenizer_path.as_posix(),
-            **self.model_params,
+            on_progress=on_progress,
+            **params,
         )
         logger.info(f"Model initialized: {m}")
         return m
 
+    def _load_current(self) -> None:
+        """Load the current model again if it was evicted, the preferred one if there is none."""
+        current_model = self.model_host.current_model
+        self.change_model(current_model.model_id if current_model else None)
+
     @lock_acquire
     def change_model(
         self,
         model_id: Optional[str] = None,
+        reload: bool = False,
     ) -> None:
-        self.model_host.status = STATUS_INITLIZING
+        """
+        Serve requests without a model with model_id, loaded first if it is not resident.
+
+        Args:
+            model_id (Optional[str], optional): Defaults to None (the preferred model).
+            reload (bool, optional): Build the model with the current model_params even if it is
+                resident, e.g. after they changed. The resident models, built with the previous
+                params, are evicted once the new model serves requests and finish the requests they
+                already run. Defaults to False.
+        """
         if not model_id:
             prefer_models = self.filter_models_by_tag(self.prefer_model_tag)
             if prefer_models:
                 model_id = prefer_models[0].model_id
             else:
                 model_id = self.avaliable_model_list[0].model_id
+        host = None if reload else self.resident.get(model_id)
+        if host is not None:
+            logger.info(f"Changing model to resident {host.current_model.model_name}")
+            self.resident.move_to_end(model_id)
+            self.model_host = host
+            return
+
+        current_model = self.get_model_by_id(model_id)
+        if not current_model:
+            raise NoSuchModel(f"Model not found via model_id: {model_id}")
+        logger.info(f"Changing model to {current_model.model_name}")
+        # requests keep running on the current model until the new one is ready
+        pinned = (self.model_host,) if self.double_buffer else ()
+        stale = list(self.resident.values()) if reload else []
+        host = self._load(current_model, StatusfulModel(), pinned=pinned)
+        self.model_host = host
+        for model_id, resident in list(self.resident.items()):
+            if resident in stale:
+                self._evict_one(model_id, drain=True)
+        # the previous model may not fit in memory_budget anymore, it finishes its requests first
+        self._evict(pinned=(host,), drain=True)
+
+    def prewarm(self) -> None:
+        """
+        Load the preferred model ahead of the first request, see change_model. The model is warmed
+        up by a short generation before it is ready.
+        """
+        if not self.model_host.model:
+            self._load_current()
+
+    def get_model_host(self, model: Union[int, str, None] = None) -> StatusfulModel:
+        """
+        The resident model to serve a request with, loaded first if it is not resident.
+
+        Loading a model that is not the current one leaves the current model unchanged, but may
+        evict other least recently used models to stay within memory_budget, the current model
+        included. With the default budget of 0 only the routed model stays resident: requests
+        already running on the evicted models finish first, and the next request without a model
+        loads the current model again.
+
+        Args:
+            model (Union[int, str, None], optional): model_id or model_name. Defaults to None (the
+                current model).
+
+        Returns:
+            StatusfulModel: A ready model.
+
+        Raises:
+            NoSuchModel: If no available model matches.
+        """
+        if model is None:
+            if not self.model_host.model:
+                self._load_current()
+            return self.model_host
+
+        target = self.find_model(model)
+        if not target:
+            raise NoSuchModel(f"Model not found: {model}")
+        host = self.resident.get(target.model_id)
+        if host is None:
+            with self.mutex:
+                host = self.resident.get(target.model_id)
+                if host is None:
+                    logger.info(f"Loading {target.model_name} next to the current model")
+                    host = self._load(target, StatusfulModel(), drain=True)
         try:
-            current_model = self.get_model_by_id(model_id)
-            if not current_model:
-                raise NoSuchModel(f"Model not found via model_id: {model_id}")
-            logger.info(f"Changing model to {current_model.model_name}")
-            if self.model_host.model:
-                self.model_params["model_parallel_size"] = int(os.environ.get("WORLD_SIZE", 1))
-            del self.model_host.model
-            self.model_host.model = self._initialize_model(current_model.model_id)
-            self.model_host.current_model = current_model
+            self.resident.move_to_end(target.model_id)
+        except KeyError:
+            # evicted in the meantime, requests on it fail like the ones already queued
+            pass
+        return host
+
+    def unload_models(self) -> None:
+        """
+        Evict every resident model, e.g. at shutdown. The current model stays the current one and is
+        loaded again by the next request without a model.
+        """
+        with self.mutex:
+            while self.resident:
+                self._evict_one()
+
+    @property
+    def resident_nbytes(self) -> int:
+        return sum(host.nbytes for host in self.resident.values())
+
+    def _load(
+        self,
+        target: AvaliableModel,
+        host: StatusfulModel,
+        pinned: Tuple[StatusfulModel, ...] = (),
+        drain: bool = False,
+    ) -> StatusfulModel:
+        """
+        Build and warm up target into host and make it resident, the caller holds the mutex.
+        Models in pinned are kept even if memory_budget is exceeded, evicted ones finish their
+        requests first with drain.
+        """
+        if self.resident:
+            self.model_params["model_parallel_size"] = int(os.environ.get("WORLD_SIZE", 1))
+        # the checkpoint size is a good estimate of the weights, the KV cache is checked once built
+        self._evict(self._checkpoint_nbytes(target), pinned=pinned, drain=drain)
+        host.status = STATUS_INITLIZING
+        host.current_model = target
+        self.loading[target.model_id] = host
+
+        def on_progress(phase: str, progress: float) -> None:
+            host.phase, host.progress = phase, progress
+
+        try:
+            host.model = self._initialize_model(target.model_id, on_progress=on_progress)
+            self._warmup(host.model, on_progress)
+            host.scheduler = Scheduler(host.model)
+            host.scheduler.start()
+            host.nbytes = model_nbytes(host.model)
         except Exception as e:
             logger.exception(e)
 
-            self.model_host.status = STATUS_NOT_READY
-            self.model_host.model = None
-            self.model_current_model = None
+            host.status = STATUS_NOT_READY
+            host.model = None
+            host.scheduler = None
+            host.current_model = None
 
             raise
-        else:
-            self.model_host.status = STATUS_READY
+        finally:
+            del self.loading[target.model_id]
+        for phase, seconds in host.model.load_timings.items():
+            MODEL_LOAD_DURATION.observe(seconds, model=target.model_name, phase=phase)
+        host.status = STATUS_READY
+        if target.model_id in self.resident:
+            # reloaded with other model_params, the previous build finishes its requests
+            self._evict_one(target.model_id, drain=True)
+        self.resident[target.model_id] = host
+        self._evict(pinned=pinned + (host,), drain=drain)
+        logger.info(
+            f"Resident models: {[h.current_model.model_name for h in self.resident.values()]}, "
+            f"{self.resident_nbytes / 2**30:.2f} GiB of {self.memory_budget / 2**30:.2f} GiB"
+        )
+        return host
+
+    def _warmup(self, llama: Llama, on_progress: Callable[[str, float], None]) -> None:
+        """A short generation, so kernels and lazily mapped weights are ready for the first request."""
+        on_progress("warmup", 0.0)
+        start = time.time()
+        llama.generate([[llama.tokenizer.bos_id]], max_gen_len=2, temperature=0)
+        llama.load_timings["warmup"] = time.time() - start
+        on_progress("warmup", 1.0)
+
+    def _evict(
+        self,
+        incoming_nbytes: int = 0,
+        pinned: Tuple[StatusfulModel, ...] = (),
+        drain: bool = False,
+    ) -> None:
+        """
+        Evict least recently used models, except pinned ones, until incoming_nbytes more fit in
+        memory_budget. See _evict_one for drain.
+        """
+        while self.resident_nbytes + incoming_nbytes > self.memory_budget:
+            evictable = [model_id for model_id, h in self.resident.items() if h not in pinned]
+            if not evictable:
+                return
+            self._evict_one(evictable[0], drain=drain)
+
+    def _evict_one(self, model_id: Optional[int] = None, drain: bool = False) -> None:
+        """
+        Evict model_id, or the least recently used model. Requests still queued on it fail, or with
+        drain finish in the background, the model is freed after them.
+
+        The evicted host keeps its current_model, when it is the current model_host the next request
+        without a model loads the same model again.
+        """
+        if model_id is None:
+            model_id = next(iter(self.resident))
+        host = self.resident.pop(model_id)
+        logger.info(f"Evicting model {host.current_model.model_name}")
+        if host.scheduler and drain:
+            threading.Thread(
+                target=host.scheduler.stop, kwargs={"drain": True}, name="llama-drain", daemon=True
+            ).start()
+        elif host.scheduler:
+            host.scheduler.stop()
+        host.status = STATUS_NOT_READY
+        host.model = None
+        host.scheduler = None
+        host.nbytes = 0
+
+    def _checkpoint_nbytes(self, target: AvaliableModel) -> int:
+        path = self._get_path_from_model_id(target.model_id)
+        return sum(f.stat().st_size for f in path.glob("consolidated.*.pth"))
+
+    def find_model(self, model: Union[int, str]) -> Optional[AvaliableModel]:
+        """Available model by model_id or model_name."""
+        for available in self.avaliable_model_list:
+            if model in (available.model_id, available.model_name, str(available.model_id)):
+                return available
+        return None
+
+    def resident_model_list(self) -> List[AvaliableModel]:
+        """
+        avaliable_model_list with the memory of resident models and the load progress of models
+        being loaded appended to their description.
+        """
+        models = []
+        for model in self.avaliable_model_list:
+            host = self.resident.get(model.model_id)
+            loading = self.loading.get(model.model_id)
+            if loading is not None:
+                suffix = f" [loading, {loading.progress_description}]"
+            elif host is not None and host.model is not None:
+                suffix = f" [resident, {host.nbytes / 2**30:.2f} GiB]"
+            else:
+                models.append(model)
+                continue
+            described = AvaliableModel()
+            described.CopyFrom(model)
+            described.model_description += suffix
+            models.append(described)
+        return models
+
+    def _get_draft_path(self, draft_model: Union[int, str]) -> Path:
+        """
+        Path of the draft model of speculative decoding, given as model_id or model_name.
+        """
+        model = self.find_model(draft_model)
+        if not model:
+            raise NoSuchModel(f"Draft model not found: {draft_model}")
+        return self._get_path_from_model_id(model.model_id)
 
     def _get_path_from_model_id(self, model_id: str) -> Path:
         for path, model in self.available_models.items():
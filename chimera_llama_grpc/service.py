@@ -1,7 +1,8 @@
 import asyncio
 import json
+import time
 from functools import wraps
-from typing import Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 
 import grpc
 from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
@@ -9,9 +10,35 @@ from chimera_llm_proto.tools import get_inference_args, get_uuid
 from watchfiles import awatch
 
 from chimera_llama_grpc.exceptions import NoSuchModel
-from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama import Dialog, Llama
+from chimera_llama_grpc.llama.generation import UNSAFE_ERROR, is_unsafe_dialog
+from chimera_llama_grpc.llama.profiling import PROFILER
+from chimera_llama_grpc.llama.stopping import (
+    StopStringFilter,
+    stop_strings,
+    truncate_at_stop,
+)
+from chimera_llama_grpc.llama.tokenizer import StreamDecoder
 from chimera_llama_grpc.log import logger
-from chimera_llama_grpc.model_manager import ModelManager
+from chimera_llama_grpc.metrics import (
+    BATCH_OCCUPANCY,
+    KV_CACHE_UTILIZATION,
+    PHASE_CALLS,
+    PHASE_SECONDS,
+    PREFIX_CACHE_BLOCKS,
+    PREFIX_CACHE_HIT_RATE,
+    PREFIX_CACHE_SAVED_PREFILL_TOKENS,
+    PREFIX_CACHE_TOKEN_HIT_RATE,
+    QUEUE_DEPTH,
+    RESIDENT_MODEL_BYTES,
+    RPC_DURATION,
+    RUNNING_SEQUENCES,
+    SPECULATIVE_ACCEPTANCE_RATE,
+    SPECULATIVE_TOKENS_PER_ROUND,
+    SPECULATIVE_TOKENS_PER_SECOND,
+    observe_generation,
+)
+from chimera_llama_grpc.model_manager import ModelManager, StatusfulModel
 from chimera_llama_grpc.tools import run_in_threadpool
 
 
@@ -40,6 +67,37 @@ def log_stream_exception(f):
     return wrapper
 
 
+def record_rpc(f):
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        start, status = time.perf_counter(), "error"
+        try:
+            result = await f(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            RPC_DURATION.observe(time.perf_counter() - start, method=f.__name__, status=status)
+
+    return wrapper
+
+
+def record_stream_rpc(f):
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        start, status = time.perf_counter(), "error"
+        try:
+            async for r in f(*args, **kwargs):
+                yield r
+            status = "ok"
+        finally:
+            RPC_DURATION.observe(time.perf_counter() - start, method=f.__name__, status=status)
+
+    return wrapper
+
+
+# requests carrying this metadata (value "1") get a torch profiler trace, see llama.profiling
+PROFILE_METADATA_KEY = "x-chimera-profile"
+
 pb_role_map = {
     chimera_llm_pb2.SYSTEM: "system",
     chimera_llm_pb2.USER: "user",
@@ -60,6 +118,187 @@ def role_to_pb(role: str) -> chimera_llm_pb2.Role:
     return role_pb_map[role]
 
 
+class _PendingGeneration:
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        temperature: float,
+        top_p: float,
+        max_gen_len: Optional[int],
+        top_k: int,
+        min_p: float,
+        seed: Optional[int],
+        trace: bool,
+        stop: List[str],
+        stop_token_ids: Optional[List[int]],
+        future: "asyncio.Future[List[int]]",
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_gen_len = max_gen_len
+        self.top_k = top_k
+        self.min_p = min_p
+        self.seed = seed
+        self.trace = trace
+        self.stop = stop
+        self.stop_token_ids = stop_token_ids
+        self.future = future
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching of concurrent requests into single Llama.generate calls.
+
+    Requests are collected for up to max_wait_ms after the first one arrives, or until
+    max_batch_size are pending, then run as one Llama.generate call in a worker thread with per-row
+    sampling parameters. The results are fanned back to the awaiting callers.
+    """
+
+    def __init__(
+        self,
+        get_model: Callable[[], Llama],
+        max_wait_ms: float = 5.0,
+        max_batch_size: int = 8,
+    ):
+        """
+        Initialize the MicroBatcher.
+
+        Args:
+            get_model (Callable[[], Llama]): Returns the model to run each batch on, called per batch
+                so model switches are picked up.
+            max_wait_ms (float, optional): How long to wait for more requests once one is pending.
+                Defaults to 5.0.
+            max_batch_size (int, optional): Maximum number of rows per generate call. Defaults to 8.
+        """
+        self.get_model = get_model
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self._queue: "Optional[asyncio.Queue[_PendingGeneration]]" = None
+        self._worker: "Optional[asyncio.Task[None]]" = None
+
+    async def submit(
+        self,
+        prompt_tokens: List[int],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        top_k: int = 0,
+        min_p: float = 0.0,
+        seed: Optional[int] = None,
+        trace: bool = False,
+        stop: Union[str, List[str], None] = None,
+        stop_token_ids: Optional[List[int]] = None,
+    ) -> List[int]:
+        """
+        Queue a prompt and wait for the batch it lands in, see Llama.generate for the parameters.
+        A trace of the whole batch is captured if any of its rows asks for one.
+
+        Returns:
+            List[int]: Generated tokens, without the prompt and EOS.
+        """
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(
+            _PendingGeneration(
+                prompt_tokens,
+                temperature,
+                top_p,
+                max_gen_len,
+                top_k,
+                min_p,
+                seed,
+                trace,
+                stop_strings(stop),
+                stop_token_ids,
+                future,
+            )
+        )
+        return await future
+
+    async def _collect(self) -> List[_PendingGeneration]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            await self._dispatch(await self._collect())
+
+    async def _dispatch(self, batch: List[_PendingGeneration]) -> None:
+        try:
+            model = self.get_model()
+        except Exception as e:
+            logger.exception(e)
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+        max_seq_len = model.model.params.max_seq_len
+        rows = []
+        for pending in batch:
+            if pending.future.done():
+                continue
+            if not 0 < len(pending.prompt_tokens) < max_seq_len:
+                pending.future.set_exception(
+                    ValueError(
+                        f"Prompt length must be in [1, {max_seq_len - 1}], "
+                        f"got {len(pending.prompt_tokens)}"
+                    )
+                )
+                continue
+            rows.append(pending)
+        if not rows:
+            return
+        # rows without stop criteria skip the stop checks entirely
+        stop = stop_token_ids = None
+        if any(pending.stop for pending in rows):
+            stop = [pending.stop for pending in rows]
+        if any(pending.stop_token_ids for pending in rows):
+            stop_token_ids = [pending.stop_token_ids for pending in rows]
+        try:
+            out_tokens, _ = await run_in_threadpool(
+                PROFILER.traced(model.generate, "generate", any(p.trace for p in rows)),
+                [pending.prompt_tokens for pending in rows],
+                max_gen_len=[pending.max_gen_len or max_seq_len - 1 for pending in rows],
+                temperature=[pending.temperature for pending in rows],
+                top_p=[pending.top_p for pending in rows],
+                top_k=[pending.top_k for pending in rows],
+                min_p=[pending.min_p for pending in rows],
+                seeds=[pending.seed for pending in rows],
+                stop=stop,
+                stop_token_ids=stop_token_ids,
+            )
+        except Exception as e:
+            logger.exception(e)
+            for pending in rows:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        if model.draft is not None:
+            stats = model.speculative_stats
+            logger.debug(
+                f"Speculative decoding: acceptance rate {stats.acceptance_rate:.2f}, "
+                f"{stats.tokens_per_round:.2f} tokens/round, {stats.tokens_per_s:.1f} tokens/s"
+            )
+        for pending, tokens in zip(rows, out_tokens):
+            if not pending.future.done():
+                pending.future.set_result(tokens)
+
+
+BATCHING_MODES = ("continuous", "micro")
+
+
 class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
     def __init__(
         self,
@@ -70,11 +309,19 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
         prefer_model_tag: chimera_llm_pb2.ModelTag = chimera_llm_pb2.CHAT,
         *,
         report_duration: int = 60,
+        device: Optional[str] = None,
+        dtype: Optional[str] = None,
+        batching: str = "continuous",
+        batch_wait_ms: float = 5.0,
+        memory_budget_gb: float = 0,
+        double_buffer: bool = True,
     ) -> None:
         if not max_seq_len:
             max_seq_len = 2048
         if not max_batch_size:
             max_batch_size = 8
+        if batching not in BATCHING_MODES:
+            raise ValueError(f"batching must be one of {BATCHING_MODES}, got {batching}")
 
         self.model_manager = ModelManager(
             ckpt_dir,
@@ -82,15 +329,175 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
             {
                 "max_seq_len": max_seq_len,
                 "max_batch_size": max_batch_size,
+                "device": device,
+                "dtype": dtype,
             },
             prefer_model_tag=prefer_model_tag,
+            memory_budget=int(memory_budget_gb * 2**30),
+            double_buffer=double_buffer,
         )
         self.report_duration = report_duration
+        self.batching = batching
+        self.batch_wait_ms = batch_wait_ms
+        self.max_batch_size = max_batch_size
+        self._micro_batchers: Dict[StatusfulModel, MicroBatcher] = {}
 
     @property
     def model(self) -> Llama:
         return self.model_manager.model
 
+    async def get_model_host(self, model: Union[int, str, None] = None) -> StatusfulModel:
+        """
+        The model a request runs on: the "model" (model_id or model_name) of its json_extra_args,
+        or the current model.
+        """
+        if model is None and self.model_manager.model_host.model is not None:
+            return self.model_manager.model_host
+        return await run_in_threadpool(self.model_manager.get_model_host, model)
+
+    def micro_batcher(self, host: StatusfulModel) -> Optional[MicroBatcher]:
+        """
+        Micro batcher of a model, if requests to it are micro batched. Models with a speculative
+        draft always are, the scheduler cannot step them.
+        """
+        if self.batching != "micro" and host.model.draft is None:
+            return None
+        if host not in self._micro_batchers:
+            # drop the batchers of evicted models
+            self._micro_batchers = {
+                h: batcher for h, batcher in self._micro_batchers.items() if h.model is not None
+            }
+            self._micro_batchers[host] = MicroBatcher(
+                lambda: host.model,
+                max_wait_ms=self.batch_wait_ms,
+                max_batch_size=self.max_batch_size,
+            )
+        return self._micro_batchers[host]
+
+    def collect_metrics(self) -> None:
+        """
+        Set the queue, batch, KV cache, prefix cache and speculative decoding gauges of every
+        resident model and add the generation phase timings of the profiler, see metrics.REGISTRY.
+        """
+        gauges = (QUEUE_DEPTH, RUNNING_SEQUENCES, BATCH_OCCUPANCY, KV_CACHE_UTILIZATION)
+        speculative_gauges = (
+            SPECULATIVE_ACCEPTANCE_RATE,
+            SPECULATIVE_TOKENS_PER_ROUND,
+            SPECULATIVE_TOKENS_PER_SECOND,
+        )
+        prefix_cache_gauges = (
+            PREFIX_CACHE_HIT_RATE,
+            PREFIX_CACHE_TOKEN_HIT_RATE,
+            PREFIX_CACHE_SAVED_PREFILL_TOKENS,
+            PREFIX_CACHE_BLOCKS,
+        )
+        for gauge in gauges + speculative_gauges + prefix_cache_gauges + (RESIDENT_MODEL_BYTES,):
+            gauge.clear()
+        hosts = list(self.model_manager.resident.values())
+        if self.model_manager.model_host not in hosts:
+            hosts.append(self.model_manager.model_host)
+        for host in hosts:
+            if host.model is None:
+                continue
+            model_name = _model_label(host)
+            RESIDENT_MODEL_BYTES.set(host.nbytes, model=model_name)
+            if host.model.draft is not None:
+                stats = host.model.speculative_stats
+                for gauge, value in zip(
+                    speculative_gauges,
+                    (stats.acceptance_rate, stats.tokens_per_round, stats.tokens_per_s),
+                ):
+                    gauge.set(value, model=model_name)
+            if host.scheduler is None:
+                continue
+            stats = host.scheduler.stats()
+            for gauge, key in zip(
+                gauges, ("waiting", "running", "batch_occupancy", "kv_cache_utilization")
+            ):
+                gauge.set(stats[key], model=model_name)
+            if "prefix_cache" in stats:
+                for gauge, key in zip(
+                    prefix_cache_gauges,
+                    ("hit_rate", "token_hit_rate", "saved_prefill_tokens", "cached_blocks"),
+                ):
+                    gauge.set(stats["prefix_cache"][key], model=model_name)
+        for phase, (calls, seconds) in PROFILER.drain().items():
+            PHASE_CALLS.inc(calls, phase=phase)
+            PHASE_SECONDS.inc(seconds, phase=phase)
+
+    async def generate(self, host: StatusfulModel, prompt_tokens: List[int], **kwargs) -> List[int]:
+        """
+        Generate through the continuous batching scheduler, concurrent requests share decode steps.
+        With micro batching or a speculative draft model, concurrent requests are grouped into
+        Llama.generate calls instead.
+
+        A generation ending on a stop string still contains it, cut the decoded text with
+        stopping.truncate_at_stop.
+        """
+        # logprobs are not part of the predictions, skip computing them
+        kwargs.pop("logprobs", None)
+        model_name = _model_label(host)
+        micro_batcher = self.micro_batcher(host)
+        if micro_batcher is not None:
+            submitted_at = time.perf_counter()
+            tokens = await micro_batcher.submit(prompt_tokens, **kwargs)
+            # a micro batch returns all tokens at once, the first one arrives with the last one
+            finished_at = time.perf_counter()
+            observe_generation(
+                model_name, len(prompt_tokens), len(tokens), submitted_at, finished_at, finished_at
+            )
+            return tokens
+        sequence = host.scheduler.submit(prompt_tokens, **kwargs)
+        tokens = await asyncio.wrap_future(sequence.future)
+        _observe_sequence(model_name, sequence)
+        return tokens
+
+    async def generate_stream(
+        self, host: StatusfulModel, prompt_tokens: List[int], **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Like generate, but yields decoded text as soon as the scheduler samples each token.
+        Micro batches have no per-token hook, the text is yielded once the batch finishes.
+        """
+        kwargs.pop("logprobs", None)
+        micro_batcher = self.micro_batcher(host)
+        if micro_batcher is not None:
+            tokens = await self.generate(host, prompt_tokens, **kwargs)
+            yield truncate_at_stop(host.model.tokenizer.decode(tokens), kwargs.get("stop"))
+            return
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Optional[int]]" = asyncio.Queue()
+
+        sequence = host.scheduler.submit(
+            prompt_tokens,
+            on_token=lambda token: loop.call_soon_threadsafe(queue.put_nowait, token),
+            **kwargs,
+        )
+        sequence.future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(queue.put_nowait, None)
+        )
+
+        decoder = StreamDecoder(host.model.tokenizer)
+        stop_filter = StopStringFilter(kwargs.get("stop"))
+        try:
+            while True:
+                token = await queue.get()
+                if token is None:
+                    break
+                text = stop_filter.push(decoder.push(token))
+                if text:
+                    yield text
+        finally:
+            # the RPC was cancelled or the consumer stopped iterating, stop generating for it
+            if not sequence.future.done():
+                host.scheduler.cancel(sequence)
+        # raise if generation failed
+        sequence.future.result()
+        _observe_sequence(_model_label(host), sequence)
+        text = stop_filter.push(decoder.flush()) + stop_filter.flush()
+        if text:
+            yield text
+
     @log_stream_exception
     async def Inspect(
         self,
@@ -98,7 +505,7 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
         context: grpc.aio.ServicerContext,
     ) -> chimera_llm_pb2.InspectResponse:
         yield chimera_llm_pb2.InspectResponse(
-            avaliable_models=self.model_manager.avaliable_model_list,
+            avaliable_models=self.model_manager.resident_model_list(),
             current_status=self.model_manager.status,
             current_model=self.model_manager.current_model,
         )
@@ -112,30 +519,41 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
             ):
                 self.model_manager.refresh_avaliable_models()
                 yield chimera_llm_pb2.InspectResponse(
-                    avaliable_models=self.model_manager.avaliable_model_list,
+                    avaliable_models=self.model_manager.resident_model_list(),
                     current_status=self.model_manager.status,
                     current_model=self.model_manager.current_model,
                 )
 
     @log_exception
+    @record_rpc
     async def LoadModel(
         self,
         request: chimera_llm_pb2.LoadModelRequest,
         context: grpc.aio.ServicerContext,
     ) -> chimera_llm_pb2.LoadModelResponse:
+        params_changed = False
         if request.json_model_param:
-            self.model_manager.model_params = json.loads(request.json_model_param)
-        if request.model_id and (
-            (
-                # if current model is not None and current model is not the target model
-                self.model_manager.current_model
-                and request.model_id != self.model_manager.current_model.model_id
-            )
-            # or current model is None
-            or not self.model_manager.current_model
+            model_params = {
+                **self.model_manager.model_params,
+                **json.loads(request.json_model_param),
+            }
+            params_changed = model_params != self.model_manager.model_params
+            self.model_manager.model_params = model_params
+        current_model = self.model_manager.current_model
+        model_id = request.model_id
+        if params_changed and not model_id and current_model:
+            model_id = current_model.model_id
+        if (
+            # resident models were built with the old params, e.g. without a draft_model for
+            # speculative decoding, they serve until model_id is rebuilt
+            params_changed
+            # or the current model is not the target model, or there is none
+            or (model_id and (not current_model or model_id != current_model.model_id))
         ):
             try:
-                await run_in_threadpool(self.model_manager.change_model, request.model_id)
+                await run_in_threadpool(
+                    self.model_manager.change_model, model_id, reload=params_changed
+                )
             except NoSuchModel as e:
                 context.set_code(grpc.StatusCode.NOT_FOUND)
                 context.set_details(str(e))
@@ -150,36 +568,37 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
             current_model=self.model_manager.current_model,
         )
 
-    @log_exception
-    async def Completion(
+    async def _model_host_args(
+        self, kwargs: Dict[str, Any], context: grpc.aio.ServicerContext
+    ) -> StatusfulModel:
+        try:
+            return await self.get_model_host(kwargs.pop("model", None))
+        except NoSuchModel as e:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(str(e))
+            raise
+
+    async def _completion_args(
         self,
         request: chimera_llm_pb2.CompletionRequest,
         context: grpc.aio.ServicerContext,
-    ) -> chimera_llm_pb2.CompletionPrediction:
-        kwargs = {}
+    ) -> Tuple[StatusfulModel, List[int], Dict[str, Any]]:
         if not request.prompt:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details("prompt must not be empty")
             raise ValueError("prompt must not be empty")
-        kwargs = {
-            "prompts": [request.prompt],
-        }
-        kwargs.update(get_inference_args(request.inference_args))
+        kwargs = _inference_args(request.inference_args, context)
 
-        logger.debug(f"Text completion request: {kwargs}")
-        predictions = await run_in_threadpool(self.model.text_completion, **kwargs)
-        return chimera_llm_pb2.CompletionPrediction(
-            request_id=request.request_id,
-            response_id=get_uuid(),
-            generation=predictions[0]["generation"],
-        )
+        logger.debug(f"Text completion request: {request.prompt}, {kwargs}")
+        host = await self._model_host_args(kwargs, context)
+        prompt_tokens = host.model.tokenizer.encode(request.prompt, bos=True, eos=False)
+        return host, prompt_tokens, kwargs
 
-    @log_exception
-    async def Chat(
+    async def _chat_args(
         self,
         request: chimera_llm_pb2.ChatRequest,
         context: grpc.aio.ServicerContext,
-    ) -> chimera_llm_pb2.ChatPrediction:
+    ) -> Tuple[StatusfulModel, Dialog, Dict[str, Any]]:
         if not request.messages:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details("messages must not be empty")
@@ -192,19 +611,181 @@ class LlamaServicer(chimera_llm_pb2_grpc.LLMServicer):
                     "content": messages.content,
                 }
             )
+        kwargs = _inference_args(request.inference_args, context)
+
+        logger.debug(f"Chat request: {dialog}, {kwargs}")
+        host = await self._model_host_args(kwargs, context)
+        return host, dialog, kwargs
 
-        kwargs = {
-            "dialogs": [dialog],
-        }
-        kwargs.update(get_inference_args(request.inference_args))
+    @log_exception
+    @record_rpc
+    async def Completion(
+        self,
+        request: chimera_llm_pb2.CompletionRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> chimera_llm_pb2.CompletionPrediction:
+        host, prompt_tokens, kwargs = await self._completion_args(request, context)
+        echo = kwargs.pop("echo", False)
+        generation_tokens = await self.generate(host, prompt_tokens, **kwargs)
+        tokenizer = host.model.tokenizer
+        if echo:
+            generation = tokenizer.decode(prompt_tokens + generation_tokens)
+            start = len(tokenizer.decode(prompt_tokens)) if kwargs.get("stop") else 0
+        else:
+            generation, start = tokenizer.decode(generation_tokens), 0
+        return chimera_llm_pb2.CompletionPrediction(
+            request_id=request.request_id,
+            response_id=get_uuid(),
+            generation=truncate_at_stop(generation, kwargs.get("stop"), start),
+        )
+
+    @log_stream_exception
+    @record_stream_rpc
+    async def CompletionStream(
+        self,
+        request: chimera_llm_pb2.CompletionRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[chimera_llm_pb2.CompletionPrediction]:
+        """
+        Server-streaming Completion, every response carries the text generated since the last one.
+        """
+        host, prompt_tokens, kwargs = await self._completion_args(request, context)
+        response_id = get_uuid()
+        if kwargs.pop("echo", False):
+            yield chimera_llm_pb2.CompletionPrediction(
+                request_id=request.request_id,
+                response_id=response_id,
+                generation=request.prompt,
+            )
+        async for text in self.generate_stream(host, prompt_tokens, **kwargs):
+            yield chimera_llm_pb2.CompletionPrediction(
+                request_id=request.request_id,
+                response_id=response_id,
+                generation=text,
+            )
 
-        logger.debug(f"Chat request: {kwargs}")
-        predictions = await run_in_threadpool(self.model.chat_completion, **kwargs)
+    @log_exception
+    @record_rpc
+    async def Chat(
+        self,
+        request: chimera_llm_pb2.ChatRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> chimera_llm_pb2.ChatPrediction:
+        host, dialog, kwargs = await self._chat_args(request, context)
+        prompt_tokens = host.model.encode_dialog(dialog)
+        generation_tokens = await self.generate(host, prompt_tokens, **kwargs)
+        content = truncate_at_stop(
+            host.model.tokenizer.decode(generation_tokens), kwargs.get("stop")
+        )
+        if is_unsafe_dialog(dialog):
+            content = UNSAFE_ERROR
         return chimera_llm_pb2.ChatPrediction(
             request_id=request.request_id,
             response_id=get_uuid(),
             message=chimera_llm_pb2.ChatMessage(
-                role=role_to_pb(predictions[0]["generation"]["role"]),
-                content=predictions[0]["generation"]["content"],
+                role=role_to_pb("assistant"),
+                content=content,
             ),
         )
+
+    @log_stream_exception
+    @record_stream_rpc
+    async def ChatStream(
+        self,
+        request: chimera_llm_pb2.ChatRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[chimera_llm_pb2.ChatPrediction]:
+        """
+        Server-streaming Chat, every response carries the content generated since the last one.
+        """
+        host, dialog, kwargs = await self._chat_args(request, context)
+        response_id = get_uuid()
+        if is_unsafe_dialog(dialog):
+            stream = _single(UNSAFE_ERROR)
+        else:
+            stream = self.generate_stream(host, host.model.encode_dialog(dialog), **kwargs)
+        async for text in stream:
+            yield chimera_llm_pb2.ChatPrediction(
+                request_id=request.request_id,
+                response_id=response_id,
+                message=chimera_llm_pb2.ChatMessage(
+                    role=role_to_pb("assistant"),
+                    content=text,
+                ),
+            )
+
+
+def _inference_args(
+    inference_args: chimera_llm_pb2.InferenceArgs, context: grpc.aio.ServicerContext
+) -> Dict[str, Any]:
+    kwargs = get_inference_args(inference_args)
+    # json_extra_args may give a single stop string or stop token ID
+    if "stop" in kwargs:
+        kwargs["stop"] = stop_strings(kwargs["stop"])
+    if isinstance(kwargs.get("stop_token_ids"), int):
+        kwargs["stop_token_ids"] = [kwargs["stop_token_ids"]]
+    metadata = dict(context.invocation_metadata() or ())
+    if metadata.get(PROFILE_METADATA_KEY, "").lower() in ("1", "true"):
+        kwargs["trace"] = True
+    return kwargs
+
+
+def _model_label(host: StatusfulModel) -> str:
+    return host.current_model.model_name if host.current_model is not None else ""
+
+
+def _observe_sequence(model_name: str, sequence) -> None:
+    observe_generation(
+        model_name,
+        len(sequence.prompt_tokens),
+        len(sequence.output_tokens),
+        sequence.submitted_at,
+        sequence.first_token_at,
+        sequence.finished_at,
+    )
+
+
+async def _single(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+STREAM_SERVICE_NAME = "LLM"
+
+
+def add_streaming_handlers_to_server(servicer: LlamaServicer, server: grpc.aio.Server) -> None:
+    """
+    Register CompletionStream and ChatStream next to the LLM service of chimera_llm_proto.
+
+    The proto package only defines unary Completion and Chat, so the streaming variants reuse its
+    request and prediction messages under the same service name, e.g. ``/LLM/CompletionStream``.
+    """
+    rpc_method_handlers = {
+        "CompletionStream": grpc.unary_stream_rpc_method_handler(
+            servicer.CompletionStream,
+            request_deserializer=chimera_llm_pb2.CompletionRequest.FromString,
+            response_serializer=chimera_llm_pb2.CompletionPrediction.SerializeToString,
+        ),
+        "ChatStream": grpc.unary_stream_rpc_method_handler(
+            servicer.ChatStream,
+            request_deserializer=chimera_llm_pb2.ChatRequest.FromString,
+            response_serializer=chimera_llm_pb2.ChatPrediction.SerializeToString,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(STREAM_SERVICE_NAME, rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+class LLMStreamStub:
+    """Client stub for the streaming RPCs, see add_streaming_handlers_to_server."""
+
+    def __init__(self, channel: grpc.aio.Channel):
+        self.CompletionStream = channel.unary_stream(
+            f"/{STREAM_SERVICE_NAME}/CompletionStream",
+            request_serializer=chimera_llm_pb2.CompletionRequest.SerializeToString,
+            response_deserializer=chimera_llm_pb2.CompletionPrediction.FromString,
+        )
+        self.ChatStream = channel.unary_stream(
+            f"/{STREAM_SERVICE_NAME}/ChatStream",
+            request_serializer=chimera_llm_pb2.ChatRequest.SerializeToString,
+            response_deserializer=chimera_llm_pb2.ChatPrediction.FromString,
+        )
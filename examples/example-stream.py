@@ -0,0 +1,26 @@
+import asyncio
+
+import grpc
+from chimera_llm_proto import chimera_llm_pb2
+
+from chimera_llama_grpc.service import LLMStreamStub
+
+
+async def run() -> None:
+    async with grpc.aio.insecure_channel("localhost:50051") as channel:
+        stub = LLMStreamStub(channel)
+        request = chimera_llm_pb2.ChatRequest(
+            messages=[
+                chimera_llm_pb2.ChatMessage(
+                    role=chimera_llm_pb2.USER,
+                    content="What is the recipe of mayonnaise?",
+                )
+            ],
+        )
+        async for r in stub.ChatStream(request):
+            print(r.message.content, end="", flush=True)
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,4 +1,7 @@
+import json
+
 import pytest
+import torch
 
 
 @pytest.fixture
@@ -52,3 +55,67 @@ def llama_tokenizer_path(tmp_path):
     tokenizer_path = tmp_path / "tokenizer.model"
     tokenizer_path.touch()
     return tokenizer_path
+
+
+@pytest.fixture(scope="session")
+def tiny_tokenizer_path(tmp_path_factory):
+    """
+    A real SentencePiece model small enough to train on the fly
+    """
+    from chimera_llama_grpc.llama.tiny import build_tiny_tokenizer
+
+    return build_tiny_tokenizer(tmp_path_factory.mktemp("tiny") / "tokenizer.model")
+
+
+@pytest.fixture(scope="session")
+def tiny_llama(tiny_tokenizer_path):
+    """
+    A randomly initialised Llama on CPU, see chimera_llama_grpc.llama.tiny
+    """
+    from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+    return build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=4)
+
+
+@pytest.fixture
+def tiny_models_dir(tmp_path, tiny_tokenizer_path):
+    """
+    A ckpt_dir with two different tiny models saved in the layout Llama.build loads
+
+    /tmpdir/
+    ├── llama-tiny
+    │   ├── consolidated.00.pth
+    │   └── params.json
+    ├── llama-tiny-chat
+    │   ├── consolidated.00.pth
+    │   └── params.json
+    """
+    from chimera_llama_grpc.llama.tiny import TINY_MODEL_PARAMS, build_tiny_llama
+
+    ckpt_dir = tmp_path / "tiny_models"
+    for seed, name in enumerate(["llama-tiny", "llama-tiny-chat"]):
+        model_dir = ckpt_dir / name
+        model_dir.mkdir(parents=True)
+        llama = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=2, seed=seed)
+        torch.save(llama.model.state_dict(), model_dir / "consolidated.00.pth")
+        (model_dir / "params.json").write_text(json.dumps(TINY_MODEL_PARAMS))
+    return ckpt_dir
+
+
+@pytest.fixture
+def tiny_servicer(llama_ckpt_dir, tiny_tokenizer_path, tiny_llama):
+    """
+    A LlamaServicer serving tiny_llama, without loading anything from llama_ckpt_dir
+    """
+    from chimera_llama_grpc.llama.scheduler import Scheduler
+    from chimera_llama_grpc.model_manager import STATUS_READY
+    from chimera_llama_grpc.service import LlamaServicer
+
+    servicer = LlamaServicer(llama_ckpt_dir, tiny_tokenizer_path)
+    model_host = servicer.model_manager.model_host
+    model_host.model = tiny_llama
+    model_host.scheduler = Scheduler(tiny_llama)
+    model_host.scheduler.start()
+    model_host.status = STATUS_READY
+    yield servicer
+    model_host.scheduler.stop()
@@ -0,0 +1,29 @@
+"""
+Helpers shared by the tests, next to the fixtures of conftest.py.
+"""
+
+from typing import List
+
+import torch
+
+from chimera_llama_grpc.llama import Llama
+
+PROMPTS = [
+    "hello world",
+    "the quick brown fox jumps",
+    "what is your name please",
+    "llama",
+    "cache batch stream user",
+    "answer the question",
+]
+
+
+def greedy_without_cache(llama: Llama, prompt_tokens: List[int], max_gen_len: int) -> List[int]:
+    tokens = list(prompt_tokens)
+    for _ in range(max_gen_len):
+        logits = llama.model.forward(torch.tensor([tokens]), 0)
+        next_token = int(torch.argmax(logits[0, -1]))
+        if next_token == llama.tokenizer.eos_id:
+            break
+        tokens.append(next_token)
+    return tokens[len(prompt_tokens) :]
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from chimera_llama_grpc.llama.model import attention
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+
+@pytest.mark.parametrize("seqlen, kv_len", [(1, 9), (7, 7), (5, 12)])
+def test_sdpa_matches_eager(seqlen, kv_len):
+    torch.manual_seed(0)
+    bsz, n_heads, n_kv_heads, head_dim = 3, 4, 2, 16
+    xq = torch.randn(bsz, seqlen, n_heads, head_dim)
+    keys = torch.randn(bsz, kv_len, n_kv_heads, head_dim)
+    values = torch.randn(bsz, kv_len, n_kv_heads, head_dim)
+    mask = None
+    if kv_len != seqlen and seqlen > 1:
+        positions = torch.arange(kv_len - seqlen, kv_len)
+        mask = (torch.arange(kv_len) <= positions[:, None])[None, None]
+
+    expected = attention(xq, keys, values, mask, impl="eager")
+    torch.testing.assert_close(attention(xq, keys, values, mask, impl="sdpa"), expected)
+
+
+def test_model_sdpa_matches_eager(tiny_tokenizer_path):
+    models = {
+        impl: build_tiny_llama(
+            tiny_tokenizer_path, max_seq_len=32, max_batch_size=2, attention_impl=impl
+        ).model
+        for impl in ("eager", "sdpa")
+    }
+    tokens = torch.randint(3, 300, (2, 12))
+    steps = [
+        # prefill from 0, prefill after a cached prefix, per-row decode
+        (tokens[:, :8], 0),
+        (tokens[:, 8:11], 8),
+        (tokens[:, 11:], torch.tensor([11, 11])),
+    ]
+    for step_tokens, start_pos in steps:
+        expected = models["eager"].forward(step_tokens, start_pos)
+        torch.testing.assert_close(models["sdpa"].forward(step_tokens, start_pos), expected)
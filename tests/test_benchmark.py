@@ -0,0 +1,49 @@
+import json
+import random
+
+import pytest
+from click.testing import CliRunner
+
+from chimera_llama_grpc.benchmark import length_distribution, summarize
+from chimera_llama_grpc.cli import cli
+
+
+def test_length_distribution():
+    rng = random.Random(0)
+    assert {length_distribution("32")(rng) for _ in range(10)} == {32}
+    assert {length_distribution("4-6")(rng) for _ in range(100)} == {4, 5, 6}
+    assert {length_distribution("1,8")(rng) for _ in range(100)} == {1, 8}
+    for spec in ("0", "6-4", "a", "1-2-3", "4,-1"):
+        with pytest.raises(ValueError):
+            length_distribution(spec)
+
+
+def test_summarize():
+    summary = summarize([float(i) for i in range(1, 101)])
+    assert summary["p50"] == 50 and summary["p95"] == 95 and summary["p99"] == 99
+    assert summary["max"] == 100 and summary["mean"] == 50.5
+    assert summarize([2.0])["p99"] == 2.0
+    assert summarize([]) is None
+
+
+@pytest.mark.parametrize("rpc,stream", [("completion", True), ("chat", False)])
+def test_benchmark_command(tmp_path, rpc, stream):
+    output = tmp_path / "report.json"
+    args = ["benchmark", "--rpc", rpc, "--requests", "6", "--concurrency", "3"]
+    args += ["--prompt-len", "4-12", "--gen-len", "5", "--output", str(output)]
+    args += ["--stream" if stream else "--no-stream"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+
+    report = json.loads(output.read_text())
+    assert report["config"]["rpc"] == rpc
+    assert report["errors"] == 0
+    # generation never stops at EOS, every request gets exactly gen_len tokens
+    assert report["generated_tokens"] == 6 * 5
+    assert report["tokens_per_s"] > 0
+    latency = report["latency_s"]
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]
+    if stream:
+        assert 0 < report["ttft_s"]["p50"] <= latency["max"]
+    else:
+        assert report["ttft_s"] is None
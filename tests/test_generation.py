@@ -0,0 +1,237 @@
+import json
+
+import pytest
+import torch
+from helpers import PROMPTS, greedy_without_cache
+
+from chimera_llama_grpc.llama import Llama, checkpoint
+from chimera_llama_grpc.llama.checkpoint import load_checkpoint
+from chimera_llama_grpc.llama.generation import resolve_dtype, sample_top_p
+from chimera_llama_grpc.llama.tiny import TINY_MODEL_PARAMS, build_tiny_llama
+
+
+@pytest.fixture
+def tiny_ckpt_dir(tmp_path, tiny_llama: Llama):
+    """
+    tiny_llama saved in the ckpt_dir layout Llama.build loads
+    """
+    ckpt_dir = tmp_path / "llama-tiny"
+    ckpt_dir.mkdir()
+    torch.save(tiny_llama.model.state_dict(), ckpt_dir / "consolidated.00.pth")
+    (ckpt_dir / "params.json").write_text(json.dumps(TINY_MODEL_PARAMS))
+    return ckpt_dir
+
+
+@pytest.fixture
+def restore_default_dtype():
+    default_dtype = torch.get_default_dtype()
+    yield
+    torch.set_default_dtype(default_dtype)
+
+
+def test_resolve_dtype():
+    assert resolve_dtype("cpu", None) == torch.bfloat16
+    assert resolve_dtype("cuda", None) == torch.float16
+    assert resolve_dtype("cpu", "float32") == torch.float32
+    with pytest.raises(ValueError):
+        resolve_dtype("cpu", "int8")
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_build_on_cpu(
+    tiny_ckpt_dir, tiny_tokenizer_path, tiny_llama: Llama, restore_default_dtype, dtype
+):
+    llama = Llama.build(
+        tiny_ckpt_dir.as_posix(),
+        tiny_tokenizer_path.as_posix(),
+        max_seq_len=64,
+        max_batch_size=4,
+        device="cpu",
+        dtype=dtype,
+    )
+    assert llama.device == torch.device("cpu")
+    assert all(p.dtype == dtype for p in llama.model.parameters())
+
+    tokens = torch.tensor([tiny_llama.tokenizer.encode(PROMPTS[0], bos=True, eos=False)])
+    logits = llama.model.forward(tokens, 0)
+    expected = tiny_llama.model.forward(tokens, 0)
+    if dtype == torch.float32:
+        torch.testing.assert_close(logits, expected)
+    else:
+        assert logits.isfinite().all()
+        out_tokens, _ = llama.generate([tokens[0].tolist()], max_gen_len=4)
+        assert len(out_tokens[0]) <= 4
+
+
+def test_generate_on_cpu(tiny_llama: Llama):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    out_tokens, _ = tiny_llama.generate(prompt_tokens, max_gen_len=8, temperature=0)
+    for t, out in zip(prompt_tokens, out_tokens):
+        assert out == greedy_without_cache(tiny_llama, t, 8)
+
+
+def test_mixed_batch_matches_individual_runs(tiny_llama: Llama):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    temperature = [0, 0.8, 1.0, 0.6]
+    top_p = [0.9, 0.5, 1.0, 0.95]
+    max_gen_len = [4, 10, 7, 5]
+    seeds = [1, 2, 3, 4]
+
+    out_tokens, _ = tiny_llama.generate(
+        prompt_tokens, max_gen_len, temperature=temperature, top_p=top_p, seeds=seeds
+    )
+    for i, tokens in enumerate(prompt_tokens):
+        expected, _ = tiny_llama.generate(
+            [tokens], max_gen_len[i], temperature=temperature[i], top_p=top_p[i], seeds=[seeds[i]]
+        )
+        assert out_tokens[i] == expected[0]
+        assert len(out_tokens[i]) <= max_gen_len[i]
+    # sampled rows really sample, with a different seed the tokens change
+    other, _ = tiny_llama.generate(
+        prompt_tokens, max_gen_len, temperature=temperature, top_p=top_p, seeds=[5, 6, 7, 8]
+    )
+    assert other[0] == out_tokens[0]
+    assert other[1:] != out_tokens[1:]
+
+
+def test_chunked_prefill_matches_single_pass(tiny_llama: Llama, monkeypatch):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[1:3]]
+    expected, expected_logprobs = tiny_llama.generate(
+        prompt_tokens, 6, temperature=0, logprobs=True, echo=True
+    )
+    monkeypatch.setattr(tiny_llama.model.params, "prefill_chunk_size", 3)
+    out_tokens, logprobs = tiny_llama.generate(
+        prompt_tokens, 6, temperature=0, logprobs=True, echo=True
+    )
+    assert out_tokens == expected
+    torch.testing.assert_close(torch.tensor(logprobs), torch.tensor(expected_logprobs))
+
+
+@pytest.mark.parametrize("kv_block_size", [0, 8])
+def test_mixed_length_prompts_prefill_in_one_pass(
+    tiny_tokenizer_path, tiny_llama: Llama, monkeypatch, kv_block_size
+):
+    llama = build_tiny_llama(
+        tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_block_size=kv_block_size
+    )
+    llama.tokenizer.eos_id = -1
+    monkeypatch.setattr(tiny_llama.tokenizer, "eos_id", -1)
+    forward_lengths = []
+    forward = llama.model.forward
+
+    def spy(tokens, start_pos, slots=None, kv_len=None):
+        forward_lengths.append(tokens.shape[1])
+        return forward(tokens, start_pos, slots=slots, kv_len=kv_len)
+
+    llama.model.forward = spy
+    prompt_tokens = [llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    out_tokens, logprobs = llama.generate(prompt_tokens, 6, temperature=0, logprobs=True, echo=True)
+
+    # one pass over the longest prompt, then a single token per step
+    assert forward_lengths == [max(len(t) for t in prompt_tokens)] + [1] * 5
+    for tokens, out, row_logprobs in zip(prompt_tokens, out_tokens, logprobs):
+        assert out == tokens + greedy_without_cache(tiny_llama, tokens, 6)
+        expected = torch.log_softmax(tiny_llama.model.forward(torch.tensor([out]), 0)[0], dim=-1)
+        expected = expected[:-1].gather(-1, torch.tensor(out[1:])[:, None])[:, 0]
+        torch.testing.assert_close(torch.tensor(row_logprobs[1:]), expected)
+    if kv_block_size:
+        assert llama.model.block_manager.num_free_blocks == llama.model.block_manager.num_blocks
+
+
+def test_sample_top_p_per_row():
+    torch.manual_seed(0)
+    probs = torch.softmax(torch.randn(2, 50), dim=-1)
+    # p=0 keeps only the most likely token, p=1 the whole distribution
+    top_p = torch.tensor([0.0, 1.0])
+    generators = [torch.Generator().manual_seed(i) for i in range(2)]
+    tokens = sample_top_p(probs.clone(), top_p, generators).reshape(-1)
+    assert tokens[0] == probs[0].argmax()
+    assert 0 <= tokens[1] < 50
+
+
+@pytest.mark.parametrize("kv_block_size", [0, 8])
+def test_generate_retires_finished_rows(
+    tiny_tokenizer_path, tiny_llama: Llama, monkeypatch, kv_block_size
+):
+    llama = build_tiny_llama(
+        tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_block_size=kv_block_size
+    )
+    llama.tokenizer.eos_id = -1
+    monkeypatch.setattr(tiny_llama.tokenizer, "eos_id", -1)
+    batch_sizes = []
+    forward = llama.model.forward
+
+    def spy(tokens, start_pos, slots=None, kv_len=None):
+        batch_sizes.append(tokens.shape[0])
+        if isinstance(start_pos, torch.Tensor):
+            # decode steps get the attended length from the host instead of reading it back
+            assert kv_len == int(start_pos.max()) + 1
+        return forward(tokens, start_pos, slots=slots, kv_len=kv_len)
+
+    llama.model.forward = spy
+    prompt_tokens = [llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    max_gen_len = [2, 12, 5, 20]
+    out_tokens, _ = llama.generate(prompt_tokens, max_gen_len, temperature=0)
+
+    for tokens, out, n in zip(prompt_tokens, out_tokens, max_gen_len):
+        assert out == greedy_without_cache(tiny_llama, tokens, n)
+    # finished rows leave the batch, a row is retired one step after it finishes
+    assert batch_sizes[0] == 4
+    assert batch_sizes[-1] == 1
+    assert batch_sizes == sorted(batch_sizes, reverse=True)
+    if kv_block_size:
+        assert llama.model.block_manager.num_free_blocks == llama.model.block_manager.num_blocks
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_build_loads_checkpoint(
+    tiny_ckpt_dir, tiny_tokenizer_path, tiny_llama: Llama, restore_default_dtype, mmap
+):
+    llama = Llama.build(
+        tiny_ckpt_dir.as_posix(),
+        tiny_tokenizer_path.as_posix(),
+        max_seq_len=64,
+        max_batch_size=4,
+        device="cpu",
+        dtype=torch.float32,
+        mmap=mmap,
+    )
+    expected = tiny_llama.model.state_dict()
+    for key, tensor in llama.model.state_dict().items():
+        if key in expected:
+            torch.testing.assert_close(tensor, expected[key], rtol=0, atol=0)
+    assert set(llama.load_timings) == {"init", "open", "copy"}
+
+
+def test_load_checkpoint_without_mmap_and_assign(
+    tmp_path, tiny_tokenizer_path, tiny_llama: Llama, monkeypatch
+):
+    # torch<2.1 has neither, the checkpoint is read and copied
+    monkeypatch.setattr(checkpoint, "HAS_MMAP", False)
+    monkeypatch.setattr(checkpoint, "HAS_ASSIGN", False)
+    load_state_dict = torch.nn.Module.load_state_dict
+
+    def old_load_state_dict(self, state_dict, strict=True):
+        return load_state_dict(self, state_dict, strict=strict)
+
+    monkeypatch.setattr(torch.nn.Module, "load_state_dict", old_load_state_dict)
+    ckpt_path = tmp_path / "consolidated.00.pth"
+    torch.save(tiny_llama.model.state_dict(), ckpt_path)
+    model = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, seed=2).model
+    load_checkpoint(model, ckpt_path)
+    for key, tensor in tiny_llama.model.state_dict().items():
+        torch.testing.assert_close(model.state_dict()[key], tensor, rtol=0, atol=0)
+
+
+def test_load_checkpoint_converts_dtype(
+    tmp_path, tiny_tokenizer_path, tiny_llama: Llama, restore_default_dtype
+):
+    ckpt_path = tmp_path / "consolidated.00.pth"
+    # legacy format checkpoints cannot be memory mapped and are read instead
+    torch.save(tiny_llama.model.state_dict(), ckpt_path, _use_new_zipfile_serialization=False)
+    torch.set_default_dtype(torch.bfloat16)
+    model = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64).model
+    load_checkpoint(model, ckpt_path)
+    for key, tensor in tiny_llama.model.state_dict().items():
+        assert model.state_dict()[key].dtype == torch.bfloat16
+        torch.testing.assert_close(model.state_dict()[key], tensor.bfloat16())
@@ -0,0 +1,214 @@
+import pytest
+import torch
+
+from chimera_llama_grpc.llama.kv_cache import (
+    KV_CACHE_DTYPES,
+    BlockManager,
+    OutOfBlocks,
+    PrefixCache,
+    dequantize_kv,
+    quantize_kv,
+)
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+PROMPTS = [
+    "hello world",
+    "the quick brown fox jumps over the lazy dog",
+    "what is your name please",
+    "llama",
+    "cache batch stream user system assistant",
+]
+
+
+def test_block_manager():
+    manager = BlockManager(
+        num_blocks=4,
+        block_size=8,
+        max_batch_size=2,
+        max_seq_len=32,
+        n_layers=2,
+        n_kv_heads=2,
+        head_dim=16,
+    )
+    manager.allocate(0, 9)
+    assert manager.row_blocks[0] == [0, 1]
+    assert manager.block_tables[0, :2].tolist() == [0, 1]
+    manager.allocate(0, 16)
+    assert manager.num_free_blocks == 2
+
+    assert not manager.can_allocate(1, 17)
+    with pytest.raises(OutOfBlocks):
+        manager.allocate(1, 17)
+    assert manager.num_free_blocks == 2
+
+    report = manager.memory_report()
+    assert report["used_blocks"] == 2
+    assert report["bytes_per_block"] == 2 * 2 * 8 * 2 * 16 * 2
+    assert report["dense_equivalent_bytes"] == report["bytes_per_block"] * 4 * 2
+
+    manager.free(0)
+    assert manager.num_free_blocks == 4
+    assert 0 not in manager.row_blocks
+
+
+def test_device_block_tables_are_copied_after_changes_only():
+    manager = BlockManager(
+        num_blocks=4,
+        block_size=8,
+        max_batch_size=2,
+        max_seq_len=32,
+        n_layers=2,
+        n_kv_heads=2,
+        head_dim=16,
+    )
+    # the meta device makes a new tensor on every copy
+    tables = manager.device_block_tables("meta")
+    assert manager.device_block_tables("meta") is tables
+    manager.allocate(0, 8)
+    assert manager.device_block_tables("meta") is not tables
+    tables = manager.device_block_tables("meta")
+    manager.allocate(0, 8)  # nothing new to allocate
+    assert manager.device_block_tables("meta") is tables
+    manager.free(0)
+    assert manager.device_block_tables("meta") is not tables
+
+
+def run_greedy(llama, prompts, max_gen_len=12):
+    scheduler = Scheduler(llama)
+    sequences = [
+        scheduler.submit(
+            llama.tokenizer.encode(p, bos=True, eos=False), temperature=0, max_gen_len=max_gen_len
+        )
+        for p in prompts
+    ]
+    while scheduler.has_unfinished():
+        scheduler.step()
+    return [s.future.result() for s in sequences]
+
+
+@pytest.mark.parametrize("kv_num_blocks", [None, 16])
+def test_paged_matches_dense(tiny_tokenizer_path, tiny_llama, kv_num_blocks):
+    paged = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=4,
+        kv_block_size=4,
+        kv_num_blocks=kv_num_blocks,
+    )
+    assert paged.model.block_manager is not None
+
+    tokens = torch.tensor([paged.tokenizer.encode(PROMPTS[1], bos=True, eos=False)])
+    paged.model.block_manager.allocate(0, tokens.shape[1])
+    torch.testing.assert_close(paged.model.forward(tokens, 0), tiny_llama.model.forward(tokens, 0))
+    paged.model.block_manager.free(0)
+
+    # with 16 blocks of 4 positions the scheduler has to preempt and recompute sequences
+    assert run_greedy(paged, PROMPTS) == run_greedy(tiny_llama, PROMPTS)
+    assert paged.model.block_manager.num_free_blocks == paged.model.block_manager.num_blocks
+
+
+def test_prefix_cache(tiny_tokenizer_path, tiny_llama):
+    paged = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=4,
+        kv_block_size=4,
+        kv_num_blocks=32,
+        prefix_cache_bytes=1 << 20,
+    )
+    system = "system llama model please answer the user question "
+    prompts = [system + "hello world", system + "what is your name", system + "hello world"]
+
+    scheduler = Scheduler(paged)
+    prefix_cache = scheduler.prefix_cache
+    outputs = []
+    for p in prompts:
+        tokens = paged.tokenizer.encode(p, bos=True, eos=False)
+        sequence = scheduler.submit(tokens, temperature=0, max_gen_len=8)
+        while scheduler.has_unfinished():
+            scheduler.step()
+        outputs.append(sequence.future.result())
+
+    stats = scheduler.stats()["prefix_cache"]
+    assert stats["queries"] == 3
+    assert stats["hits"] == 2
+    assert stats["saved_prefill_tokens"] > 0
+    # reusing cached blocks must not change the generation
+    assert outputs == run_greedy(tiny_llama, prompts, max_gen_len=8)
+
+    # cached blocks are given back when the pool needs them
+    block_manager = paged.model.block_manager
+    assert block_manager.num_free_blocks < block_manager.num_blocks
+    block_manager.allocate(0, 64)
+    assert prefix_cache.stats()["evictions"] > 0
+    block_manager.free(0)
+    prefix_cache.evict(len(prefix_cache))
+    assert block_manager.num_free_blocks == block_manager.num_blocks
+
+
+def test_prefix_cache_budget(tiny_tokenizer_path):
+    paged = build_tiny_llama(
+        tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_block_size=4, kv_num_blocks=32
+    )
+    block_manager = paged.model.block_manager
+    prefix_cache = PrefixCache(block_manager, max_blocks=3)
+    block_manager.allocate(0, 20)
+    prefix_cache.insert(list(range(20)), block_manager.row_blocks[0])
+    assert len(prefix_cache) == 3
+    assert prefix_cache.match(list(range(20))) == block_manager.row_blocks[0][:3]
+    # blocks in use by a row cannot be evicted
+    assert prefix_cache.evict(3) == 0
+    block_manager.free(0)
+    assert prefix_cache.num_evictable() == 3
+
+
+@pytest.mark.parametrize("kv_cache_dtype,max_error", [("int8", 0.5 / 127), ("fp8", 1 / 16)])
+def test_quantize_kv_round_trip(kv_cache_dtype, max_error):
+    x = torch.randn(2, 5, 4, 16) * torch.tensor([0.01, 1.0, 10.0, 100.0])[:, None]
+    q, scales = quantize_kv(x, kv_cache_dtype)
+    assert scales.shape == (2, 5, 4, 1)
+    # error relative to the largest entry of every position and head
+    error = (dequantize_kv(q, scales, torch.float32) - x).abs() / x.abs().amax(-1, keepdim=True)
+    assert error.max() <= max_error + 1e-6
+
+
+def test_fp8_kv_cache_needs_float8(tiny_tokenizer_path, monkeypatch):
+    # torch<2.1 has no float8_e4m3fn, only asking for an fp8 cache fails
+    monkeypatch.setitem(KV_CACHE_DTYPES, "fp8", (None, 448.0))
+    with pytest.raises(ValueError, match="torch>=2.1"):
+        build_tiny_llama(
+            tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_cache_dtype="fp8"
+        )
+    build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_cache_dtype="int8")
+
+
+@pytest.mark.parametrize("kv_cache_dtype,max_kl", [("int8", 1e-3), ("fp8", 0.02)])
+def test_quantized_kv_cache(tiny_tokenizer_path, tiny_llama, kv_cache_dtype, max_kl):
+    dense = build_tiny_llama(
+        tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, kv_cache_dtype=kv_cache_dtype
+    )
+    paged = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=4,
+        kv_block_size=4,
+        kv_cache_dtype=kv_cache_dtype,
+    )
+    cache = dense.model.layers[0].attention.cache
+    full_cache = tiny_llama.model.layers[0].attention.cache
+    assert cache.cache_k.element_size() == 1
+    assert cache.cache_k.nbytes + cache.scale_k.nbytes < full_cache.cache_k.nbytes / 2
+    block_manager = paged.model.block_manager
+    assert block_manager.bytes_per_block == 2 * 2 * 4 * 2 * (16 + 4)
+
+    tokens = torch.tensor([dense.tokenizer.encode(PROMPTS[1], bos=True, eos=False)])
+    block_manager.allocate(0, tokens.shape[1])
+    logprobs = torch.log_softmax(dense.model.forward(tokens, 0), dim=-1)
+    torch.testing.assert_close(torch.log_softmax(paged.model.forward(tokens, 0), dim=-1), logprobs)
+    block_manager.free(0)
+    expected = torch.log_softmax(tiny_llama.model.forward(tokens, 0), dim=-1)
+    kl_divergence = (expected.exp() * (expected - logprobs)).sum(dim=-1)
+    assert kl_divergence.mean() < max_kl
+
+    assert run_greedy(paged, PROMPTS) == run_greedy(dense, PROMPTS)
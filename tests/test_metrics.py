@@ -0,0 +1,138 @@
+import asyncio
+import urllib.request
+
+import grpc
+import pytest
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+
+from chimera_llama_grpc import metrics
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+from chimera_llama_grpc.metrics import Counter, Gauge, Histogram, MetricsRegistry
+from chimera_llama_grpc.service import LlamaServicer
+
+
+def test_render():
+    registry = MetricsRegistry()
+    latency = registry.register(Histogram("latency_seconds", "Latency.", ("method",), (0.1, 1)))
+    tokens = registry.register(Counter("tokens_total", "Tokens.", ("model",)))
+    depth = registry.register(Gauge("queue_depth", "Depth."))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, method="Chat")
+    tokens.inc(3, model='a "b"')
+    tokens.inc(2, model='a "b"')
+    registry.add_collector(lambda: depth.set(7))
+
+    lines = registry.render().splitlines()
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{method="Chat",le="0.1"} 2.0' in lines
+    assert 'latency_seconds_bucket{method="Chat",le="1.0"} 3.0' in lines
+    assert 'latency_seconds_bucket{method="Chat",le="+Inf"} 4.0' in lines
+    assert 'latency_seconds_sum{method="Chat"} 3.65' in lines
+    assert 'latency_seconds_count{method="Chat"} 4.0' in lines
+    assert 'tokens_total{model="a \\"b\\""} 5.0' in lines
+    assert "queue_depth 7.0" in lines
+
+    with pytest.raises(ValueError):
+        tokens.inc(model="a", method="b")
+    with pytest.raises(ValueError):
+        registry.register(Gauge("queue_depth", "Again."))
+
+
+def test_metrics_endpoint(tiny_servicer: LlamaServicer):
+    request = chimera_llm_pb2.CompletionRequest(
+        prompt="hello world",
+        inference_args=chimera_llm_pb2.InferenceArgs(
+            max_gen_len=8, json_extra_args='{"temperature": 0}'
+        ),
+    )
+    generated_before = sum(v for _, _, v in metrics.GENERATED_TOKENS.samples())
+    completions_before = metrics.RPC_DURATION.value(method="Completion", status="ok")
+
+    async def run():
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(tiny_servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                await chimera_llm_pb2_grpc.LLMStub(channel).Completion(request)
+        finally:
+            await server.stop(None)
+
+    asyncio.run(run())
+
+    counts, _ = metrics.RPC_DURATION.value(method="Completion", status="ok")
+    assert sum(counts) == 1 + (sum(completions_before[0]) if completions_before else 0)
+    generated = sum(v for _, _, v in metrics.GENERATED_TOKENS.samples())
+    assert 0 < generated - generated_before <= 8
+
+    metrics.REGISTRY.add_collector(tiny_servicer.collect_metrics)
+    http_server = metrics.start_metrics_server(0, addr="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{http_server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            body = response.read().decode()
+    finally:
+        http_server.shutdown()
+        metrics.REGISTRY.remove_collector(tiny_servicer.collect_metrics)
+    assert 'chimera_rpc_duration_seconds_count{method="Completion",status="ok"}' in body
+    assert "chimera_time_to_first_token_seconds_bucket" in body
+    assert 'chimera_queue_depth{model=""} 0.0' in body
+    assert 'chimera_batch_occupancy{model=""} 0.0' in body
+    assert "chimera_kv_cache_utilization" in body
+
+
+def test_speculative_decoding_gauges(tiny_servicer: LlamaServicer, tiny_tokenizer_path):
+    host = tiny_servicer.model_manager.model_host
+    target = host.model
+    draft = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, seed=1)
+    host.model = Llama(target.model, target.tokenizer, draft=draft, num_speculative_tokens=2)
+    try:
+        prompt_tokens = target.tokenizer.encode("hello world", bos=True, eos=False)
+        host.model.generate([prompt_tokens], 8, temperature=0)
+        tiny_servicer.collect_metrics()
+    finally:
+        host.model = target
+    # an identical draft model has every proposal accepted
+    assert metrics.SPECULATIVE_ACCEPTANCE_RATE.value(model="") == 1.0
+    assert metrics.SPECULATIVE_TOKENS_PER_ROUND.value(model="") > 1
+    assert metrics.SPECULATIVE_TOKENS_PER_SECOND.value(model="") > 0
+
+    tiny_servicer.collect_metrics()
+    assert metrics.SPECULATIVE_ACCEPTANCE_RATE.value(model="") is None
+
+
+def test_prefix_cache_gauges(tiny_servicer: LlamaServicer, tiny_tokenizer_path):
+    host = tiny_servicer.model_manager.model_host
+    model, scheduler = host.model, host.scheduler
+    host.model = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=2,
+        kv_block_size=4,
+        kv_num_blocks=32,
+        prefix_cache_bytes=1 << 20,
+    )
+    host.scheduler = Scheduler(host.model)
+    try:
+        prompt_tokens = host.model.tokenizer.encode("the same prompt twice", bos=True, eos=False)
+        for _ in range(2):
+            host.scheduler.submit(prompt_tokens, temperature=0, max_gen_len=4)
+            while host.scheduler.has_unfinished():
+                host.scheduler.step()
+        tiny_servicer.collect_metrics()
+        stats = host.scheduler.stats()["prefix_cache"]
+    finally:
+        host.model, host.scheduler = model, scheduler
+    assert metrics.PREFIX_CACHE_HIT_RATE.value(model="") == 0.5
+    saved = metrics.PREFIX_CACHE_SAVED_PREFILL_TOKENS.value(model="")
+    assert saved == stats["saved_prefill_tokens"] > 0
+    assert metrics.PREFIX_CACHE_TOKEN_HIT_RATE.value(model="") == stats["token_hit_rate"]
+    assert metrics.PREFIX_CACHE_BLOCKS.value(model="") == stats["cached_blocks"] > 0
+
+    # models without a prefix cache export none
+    tiny_servicer.collect_metrics()
+    assert metrics.PREFIX_CACHE_HIT_RATE.value(model="") is None
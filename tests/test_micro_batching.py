@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from helpers import PROMPTS, greedy_without_cache
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.service import MicroBatcher
+
+
+def test_micro_batcher_batches_concurrent_requests(tiny_llama: Llama, monkeypatch):
+    calls = []
+    generate = tiny_llama.generate
+
+    def spy(prompt_tokens, **kwargs):
+        calls.append((len(prompt_tokens), kwargs["temperature"]))
+        return generate(prompt_tokens, **kwargs)
+
+    monkeypatch.setattr(tiny_llama, "generate", spy)
+    batcher = MicroBatcher(lambda: tiny_llama, max_wait_ms=50, max_batch_size=4)
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+
+    async def run():
+        return await asyncio.gather(
+            # requests with different sampling parameters share one generate call
+            batcher.submit(prompt_tokens[0], temperature=0, top_p=0.5, max_gen_len=4),
+            batcher.submit(prompt_tokens[1], temperature=0, top_p=0.9, max_gen_len=8),
+            batcher.submit(prompt_tokens[2], temperature=0, max_gen_len=6),
+            batcher.submit(prompt_tokens[3], temperature=0.8, top_p=0.9, max_gen_len=4),
+        )
+
+    results = asyncio.run(run())
+    assert calls == [(4, [0, 0, 0, 0.8])]
+    for tokens, result, max_gen_len in zip(prompt_tokens[:3], results, [4, 8, 6]):
+        assert result == greedy_without_cache(tiny_llama, tokens, max_gen_len)
+    assert len(results[3]) <= 4
+
+
+def test_micro_batcher_propagates_errors(tiny_llama: Llama):
+    batcher = MicroBatcher(lambda: tiny_llama, max_wait_ms=1)
+    too_long = [1] * tiny_llama.model.params.max_seq_len
+
+    async def run():
+        with pytest.raises(ValueError):
+            await batcher.submit(too_long, temperature=0)
+        # the worker survives a failed batch
+        return await batcher.submit([1, 2, 3], temperature=0, max_gen_len=2)
+
+    assert len(asyncio.run(run())) <= 2
@@ -1,6 +1,19 @@
+import asyncio
+import json
+import threading
+
+import grpc
 import pytest
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+from helpers import greedy_without_cache
 
-from chimera_llama_grpc.model_manager import ModelManager
+from chimera_llama_grpc.exceptions import NoSuchModel
+from chimera_llama_grpc.model_manager import (
+    STATUS_NOT_READY,
+    STATUS_READY,
+    ModelManager,
+)
+from chimera_llama_grpc.service import LlamaServicer
 
 
 @pytest.fixture
@@ -13,5 +26,282 @@ def test_model_manager(model_manager: ModelManager):
     assert len(model_manager.available_models) == 2
 
 
+def test_draft_model_path(model_manager: ModelManager):
+    by_name = model_manager._get_draft_path("llama-2-7b")
+    assert by_name.name == "llama-2-7b"
+    model_id = model_manager.available_models[by_name].model_id
+    assert model_manager._get_draft_path(model_id) == by_name
+    with pytest.raises(NoSuchModel):
+        model_manager._get_draft_path("llama-2-70b")
+
+
+TINY_MODEL_PARAMS = {"max_seq_len": 64, "max_batch_size": 2, "device": "cpu", "dtype": "float32"}
+
+
+@pytest.fixture
+def count_loads(monkeypatch):
+    loads = []
+    initialize_model = ModelManager._initialize_model
+
+    def spy(self, model_id, **kwargs):
+        loads.append(self.get_model_by_id(model_id).model_name)
+        return initialize_model(self, model_id, **kwargs)
+
+    monkeypatch.setattr(ModelManager, "_initialize_model", spy)
+    return loads
+
+
+def test_model_pool_keeps_alternating_models_resident(
+    tiny_models_dir, tiny_tokenizer_path, count_loads
+):
+    manager = ModelManager(
+        tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS), memory_budget=2**30
+    )
+    try:
+        for _ in range(3):
+            for name in ["llama-tiny", "llama-tiny-chat"]:
+                host = manager.get_model_host(name)
+                assert host.status == STATUS_READY
+                assert host.current_model.model_name == name
+        assert sorted(count_loads) == ["llama-tiny", "llama-tiny-chat"]
+        # routing does not change the current model
+        assert manager.model_host.model is None
+
+        manager.change_model(manager.find_model("llama-tiny").model_id)
+        assert len(count_loads) == 2
+        assert manager.current_model.model_name == "llama-tiny"
+
+        descriptions = [m.model_description for m in manager.resident_model_list()]
+        assert all("[resident" in d for d in descriptions)
+    finally:
+        manager.unload_models()
+
+
+def test_model_pool_evicts_least_recently_used(tiny_models_dir, tiny_tokenizer_path, count_loads):
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS))
+    try:
+        first = manager.get_model_host("llama-tiny")
+        second = manager.get_model_host("llama-tiny-chat")
+        # the default budget keeps a single model
+        assert list(manager.resident) == [second.current_model.model_id]
+        assert first.model is None and first.status == STATUS_NOT_READY
+        assert manager.get_model_host("llama-tiny").model is not None
+        assert count_loads == ["llama-tiny", "llama-tiny-chat", "llama-tiny"]
+
+        with pytest.raises(NoSuchModel):
+            manager.get_model_host("llama-2-70b")
+    finally:
+        manager.unload_models()
+
+
+def test_prewarm_loads_and_warms_up_preferred_model(tiny_models_dir, tiny_tokenizer_path):
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS))
+    try:
+        manager.prewarm()
+        assert manager.status == STATUS_READY
+        assert manager.current_model.model_name == "llama-tiny-chat"
+        assert "warmup" in manager.model_host.model.load_timings
+    finally:
+        manager.unload_models()
+
+
+def test_change_model_serves_previous_model_until_ready(
+    tiny_models_dir, tiny_tokenizer_path, monkeypatch
+):
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS))
+    manager.prewarm()
+    previous = manager.model_host
+    copying, release = threading.Event(), threading.Event()
+    initialize_model = ModelManager._initialize_model
+
+    def slow_initialize_model(self, model_id, on_progress=None):
+        def blocking_progress(phase, progress):
+            on_progress(phase, progress)
+            if phase == "copy" and not copying.is_set():
+                copying.set()
+                release.wait()
+
+        return initialize_model(self, model_id, on_progress=blocking_progress)
+
+    monkeypatch.setattr(ModelManager, "_initialize_model", slow_initialize_model)
+    switch = threading.Thread(
+        target=manager.change_model, args=(manager.find_model("llama-tiny").model_id,)
+    )
+    switch.start()
+    try:
+        assert copying.wait(timeout=30)
+        # requests still run on the previous model while the next one loads
+        assert manager.get_model_host() is previous
+        assert manager.status == STATUS_READY
+        assert manager.current_model.model_name == "llama-tiny-chat"
+        descriptions = {m.model_name: m.model_description for m in manager.resident_model_list()}
+        assert "[loading, copy" in descriptions["llama-tiny"]
+        assert "[resident" in descriptions["llama-tiny-chat"]
+    finally:
+        release.set()
+        switch.join()
+    try:
+        assert manager.current_model.model_name == "llama-tiny"
+        assert manager.status == STATUS_READY
+        # the default budget only keeps the new model once the switch is done
+        assert previous.model is None
+        assert list(manager.resident) == [manager.current_model.model_id]
+    finally:
+        manager.unload_models()
+
+
+def test_evicted_current_model_is_loaded_again(tiny_models_dir, tiny_tokenizer_path, count_loads):
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS))
+    try:
+        manager.change_model(manager.find_model("llama-tiny").model_id)
+        # routing a request to another model evicts the current one with the default budget
+        manager.get_model_host("llama-tiny-chat")
+        assert manager.model_host.model is None
+        assert manager.current_model.model_name == "llama-tiny"
+        # requests without a model load the current model again, not the preferred one
+        assert manager.get_model_host().current_model.model_name == "llama-tiny"
+        assert count_loads == ["llama-tiny", "llama-tiny-chat", "llama-tiny"]
+    finally:
+        manager.unload_models()
+
+
+def test_routing_at_budget_zero_finishes_requests_on_the_current_model(
+    tiny_models_dir, tiny_tokenizer_path
+):
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS))
+    try:
+        manager.prewarm()
+        current = manager.model_host
+        release = threading.Event()
+        sequence = current.scheduler.submit(
+            [1, 5, 6], temperature=0, max_gen_len=8, on_token=lambda _: release.wait(timeout=30)
+        )
+        # a single model fits in the default budget, the routed one replaces the current one
+        routed = manager.get_model_host("llama-tiny")
+        assert list(manager.resident.values()) == [routed]
+        assert current.model is None
+
+        release.set()
+        assert len(sequence.future.result(timeout=30)) == 8
+        assert manager.get_model_host().current_model.model_name == "llama-tiny-chat"
+    finally:
+        manager.unload_models()
+
+
+def test_reload_replaces_models_once_the_new_one_serves(tiny_models_dir, tiny_tokenizer_path):
+    manager = ModelManager(
+        tiny_models_dir, tiny_tokenizer_path, dict(TINY_MODEL_PARAMS), memory_budget=2**30
+    )
+    try:
+        manager.prewarm()
+        previous = manager.model_host
+        other = manager.get_model_host("llama-tiny")
+        # a request running on the current model while it is replaced
+        release = threading.Event()
+        sequence = previous.scheduler.submit(
+            [1, 5, 6], temperature=0, max_gen_len=8, on_token=lambda _: release.wait(timeout=30)
+        )
+
+        manager.model_params["max_seq_len"] = 48
+        manager.change_model(previous.current_model.model_id, reload=True)
+        host = manager.model_host
+        assert host is not previous and host.status == STATUS_READY
+        assert host.model.model.params.max_seq_len == 48
+        assert manager.current_model.model_name == "llama-tiny-chat"
+        # models built with the previous params are evicted
+        assert list(manager.resident.values()) == [host]
+        assert other.model is None and previous.model is None
+
+        release.set()
+        assert len(sequence.future.result(timeout=30)) == 8
+    finally:
+        manager.unload_models()
+
+
+def test_load_model_finishes_requests_on_the_previous_model(tiny_models_dir, tiny_tokenizer_path):
+    servicer = LlamaServicer(
+        tiny_models_dir,
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=2,
+        device="cpu",
+        dtype="float32",
+    )
+    manager = servicer.model_manager
+    try:
+        manager.prewarm()
+        previous = manager.model_host
+        # a request running on the current model while LoadModel switches to another one
+        release = threading.Event()
+        sequence = previous.scheduler.submit(
+            [1, 5, 6], temperature=0, max_gen_len=8, on_token=lambda _: release.wait(timeout=30)
+        )
+        request = chimera_llm_pb2.LoadModelRequest(
+            model_id=manager.find_model("llama-tiny").model_id
+        )
+        response = asyncio.run(servicer.LoadModel(request, None))
+        assert response.current_model.model_name == "llama-tiny"
+        # the default budget keeps only the new model
+        assert list(manager.resident.values()) == [manager.model_host]
+        assert previous.model is None
+
+        release.set()
+        assert len(sequence.future.result(timeout=30)) == 8
+    finally:
+        manager.unload_models()
+
+
+def test_completion_routes_to_requested_model(tiny_models_dir, tiny_tokenizer_path):
+    servicer = LlamaServicer(
+        tiny_models_dir,
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=2,
+        device="cpu",
+        dtype="float32",
+        memory_budget_gb=1,
+    )
+    manager = servicer.model_manager
+
+    async def complete(stub, model):
+        extra_args = json.dumps({"temperature": 0, "model": model})
+        request = chimera_llm_pb2.CompletionRequest(
+            prompt="hello world",
+            inference_args=chimera_llm_pb2.InferenceArgs(max_gen_len=8, json_extra_args=extra_args),
+        )
+        return (await stub.Completion(request)).generation
+
+    async def run():
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                stub = chimera_llm_pb2_grpc.LLMStub(channel)
+                generations = {
+                    model: await complete(stub, model)
+                    for model in ["llama-tiny", "llama-tiny-chat"]
+                }
+                with pytest.raises(grpc.aio.AioRpcError) as e:
+                    await complete(stub, "llama-2-70b")
+                assert e.value.code() == grpc.StatusCode.NOT_FOUND
+                inspect = await stub.Inspect(chimera_llm_pb2.InspectRequest()).read()
+                return generations, inspect
+        finally:
+            await server.stop(None)
+
+    try:
+        generations, inspect = asyncio.run(run())
+        for name, generation in generations.items():
+            llama = manager.get_model_host(name).model
+            prompt_tokens = llama.tokenizer.encode("hello world", bos=True, eos=False)
+            expected = greedy_without_cache(llama, prompt_tokens, 8)
+            assert generation == llama.tokenizer.decode(expected)
+        assert all("[resident" in m.model_description for m in inspect.avaliable_models)
+    finally:
+        manager.unload_models()
+
+
 if __name__ == "__main__":
     pytest.main(["-vv", "-s", __file__])
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import time
+
+import grpc
+import pytest
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+
+from chimera_llama_grpc import metrics
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.profiling import PHASES, PROFILER
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.service import PROFILE_METADATA_KEY, LlamaServicer
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(PROFILER, "trace_dir", tmp_path / "profiles")
+    PROFILER.drain()
+    yield PROFILER
+    PROFILER.enabled = False
+    PROFILER.drain()
+
+
+def test_disabled_profiler_is_a_no_op(tiny_llama: Llama, profiler):
+    assert not profiler.active
+    assert profiler.phase("prefill") is profiler.phase("sample")
+    prompt = tiny_llama.tokenizer.encode("hello world", bos=True, eos=False)
+    tiny_llama.tokenizer.decode(tiny_llama.generate([prompt], 4)[0][0])
+    assert profiler.drain() == {}
+
+
+def test_phase_timings(tiny_llama: Llama, profiler):
+    profiler.enabled = True
+    prompt = tiny_llama.tokenizer.encode("hello world", bos=True, eos=False)
+    tokens, _ = tiny_llama.generate([prompt], 4, temperature=0)
+    tiny_llama.tokenizer.decode(tokens[0])
+    timings = profiler.drain()
+    assert set(timings) == set(PHASES)
+    assert timings["prefill"][0] == timings["encode"][0] == timings["detokenize"][0] == 1
+    # the last sampled token is never fed back
+    assert timings["sample"][0] == timings["decode_step"][0] + 1 <= 4
+    assert all(seconds > 0 for _, seconds in timings.values())
+    assert profiler.drain() == {}
+
+    scheduler = Scheduler(tiny_llama)
+    sequence = scheduler.submit(prompt, temperature=0, max_gen_len=3)
+    while scheduler.has_unfinished():
+        scheduler.step()
+    assert sequence.future.result()
+    timings = profiler.drain()
+    assert timings["prefill"][0] == 1
+    assert timings["sample"][0] == len(sequence.output_tokens)
+
+
+def test_scheduler_trace(tiny_llama: Llama, profiler):
+    scheduler = Scheduler(tiny_llama)
+    prompt = tiny_llama.tokenizer.encode("hello world", bos=True, eos=False)
+    untraced = scheduler.submit(prompt, max_gen_len=2)
+    while scheduler.has_unfinished():
+        scheduler.step()
+    assert untraced.future.done() and not profiler.trace_dir.exists()
+
+    traced = scheduler.submit(prompt, max_gen_len=6, trace=True)
+    scheduler.step()
+    # the trace stays open while the traced sequence runs
+    assert profiler.active and scheduler._trace is not None
+    other = scheduler.submit(prompt, max_gen_len=20)
+    while not traced.finished:
+        scheduler.step()
+    assert not profiler.active and scheduler._trace is None
+    while scheduler.has_unfinished():
+        scheduler.step()
+    assert other.future.done()
+
+    (path,) = profiler.trace_dir.glob("scheduler-*.json")
+    names = {event.get("name") for event in json.loads(path.read_text())["traceEvents"]}
+    assert {"chimera::prefill", "chimera::decode_step", "chimera::sample"} <= names
+
+
+@pytest.mark.parametrize("batching", ["continuous", "micro"])
+def test_profile_metadata(tiny_servicer: LlamaServicer, profiler, batching):
+    tiny_servicer.batching = batching
+    profiler.enabled = True
+    request = chimera_llm_pb2.CompletionRequest(
+        prompt="hello world", inference_args=chimera_llm_pb2.InferenceArgs(max_gen_len=4)
+    )
+
+    async def run():
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(tiny_servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                stub = chimera_llm_pb2_grpc.LLMStub(channel)
+                await stub.Completion(request)
+                assert not profiler.trace_dir.exists()
+                await stub.Completion(request, metadata=((PROFILE_METADATA_KEY, "1"),))
+        finally:
+            await server.stop(None)
+
+    asyncio.run(run())
+    # the scheduler thread writes the trace after resolving the request
+    for _ in range(100):
+        if list(profiler.trace_dir.glob("*.json")):
+            break
+        time.sleep(0.05)
+    assert len(list(profiler.trace_dir.glob("*.json"))) == 1
+
+    prefills = metrics.PHASE_CALLS.value(phase="prefill") or 0
+    tiny_servicer.collect_metrics()
+    assert metrics.PHASE_CALLS.value(phase="prefill") == prefills + 2
+    assert metrics.PHASE_SECONDS.value(phase="encode") > 0
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+import torch
+import torch.nn.functional as F
+from helpers import PROMPTS
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.quantization import (
+    QuantizedLinear,
+    dequantize_weight,
+    quantize_checkpoint,
+    quantize_weight,
+)
+from chimera_llama_grpc.llama.tiny import init_model_parallel
+from chimera_llama_grpc.model_manager import ModelManager
+
+
+@pytest.mark.parametrize("mode,group_size", [("int8", 0), ("int8", 32), ("int4", 32)])
+def test_quantize_weight_round_trip(mode, group_size):
+    weight = torch.randn(48, 128)
+    state = quantize_weight(weight, mode, group_size)
+    restored = dequantize_weight(state["weight"], state["scales"], state.get("zeros"))
+    # rounding moves every weight by at most half a step of its group
+    steps = state["scales"].repeat_interleave(128 // state["scales"].shape[1], dim=1)
+    assert ((restored - weight).abs() <= steps / 2 + 1e-6).all()
+    assert state["weight"].numel() == weight.numel() // (2 if mode == "int4" else 1)
+
+
+@pytest.mark.parametrize("parallel", ["column", "row"])
+@pytest.mark.parametrize("mode,group_size", [("int8", 0), ("int4", 32)])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("tokens", [1, 40])
+def test_quantized_linear_matches_dequantized_weight(parallel, mode, group_size, dtype, tokens):
+    init_model_parallel()
+    torch.manual_seed(0)
+    weight = torch.randn(96, 64)
+    linear = QuantizedLinear(64, 96, mode, group_size, parallel)
+    linear.load_state_dict(quantize_weight(weight, mode, group_size), strict=False)
+    # the reference sees the same rounded input
+    x = torch.randn(2, tokens, 64).to(dtype)
+
+    # bfloat16 on CPU goes through the int8 / int4 kernels, float32 dequantizes the weight
+    output = linear(x)
+    dequantized = dequantize_weight(linear.weight, linear.scales, linear.zeros)
+    assert output.shape == (2, tokens, 96)
+    torch.testing.assert_close(
+        output.float(), F.linear(x.float(), dequantized), rtol=0.05, atol=0.1
+    )
+
+
+# random weights are noisier than trained ones, int4 changes the tiny model noticeably
+@pytest.mark.parametrize("mode,group_size,max_kl", [("int8", 0, 0.01), ("int4", 32, 0.5)])
+def test_quantized_checkpoint_builds_equivalent_model(
+    tiny_models_dir, tiny_tokenizer_path, mode, group_size, max_kl
+):
+    model_dir = tiny_models_dir / "llama-tiny"
+    output_dir = quantize_checkpoint(
+        model_dir, tiny_models_dir / f"llama-tiny-{mode}", mode, group_size
+    )
+    params = json.loads((output_dir / "params.json").read_text())
+    assert params["quantize"] == mode
+
+    build_args = dict(max_seq_len=64, max_batch_size=2, device="cpu", dtype=torch.float32)
+    default_dtype = torch.get_default_dtype()
+    try:
+        dense = Llama.build(model_dir.as_posix(), tiny_tokenizer_path.as_posix(), **build_args)
+        quantized = Llama.build(output_dir.as_posix(), tiny_tokenizer_path.as_posix(), **build_args)
+    finally:
+        torch.set_default_dtype(default_dtype)
+    assert isinstance(quantized.model.layers[0].feed_forward.w2, QuantizedLinear)
+
+    tokens = torch.tensor([dense.tokenizer.encode(PROMPTS[0], bos=True, eos=False)])
+    expected = torch.log_softmax(dense.model.forward(tokens, 0), dim=-1)
+    logprobs = torch.log_softmax(quantized.model.forward(tokens, 0), dim=-1)
+    kl_divergence = (expected.exp() * (expected - logprobs)).sum(dim=-1)
+    assert kl_divergence.mean() < max_kl
+
+    # and computes exactly what the dense model does with the rounded weights
+    with torch.no_grad():
+        for name, module in quantized.model.named_modules():
+            if isinstance(module, QuantizedLinear):
+                weight = dequantize_weight(module.weight, module.scales, module.zeros)
+                dense.model.get_submodule(name).weight.copy_(weight)
+    expected = torch.log_softmax(dense.model.forward(tokens, 0), dim=-1)
+    torch.testing.assert_close(logprobs, expected)
+
+    # the quantized model is listed next to its source
+    manager = ModelManager(tiny_models_dir, tiny_tokenizer_path, {})
+    assert f"llama-tiny-{mode}" in [m.model_name for m in manager.avaliable_model_list]
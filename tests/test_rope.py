@@ -0,0 +1,81 @@
+import math
+
+import pytest
+import torch
+
+from chimera_llama_grpc.llama import model as llama_model
+from chimera_llama_grpc.llama.model import cached_freqs_cis, precompute_freqs_cis
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+
+def test_freqs_cis_are_shared(tiny_tokenizer_path, monkeypatch):
+    cached_freqs_cis.cache_clear()
+    calls = []
+    precompute = llama_model.precompute_freqs_cis
+    monkeypatch.setattr(
+        llama_model, "precompute_freqs_cis", lambda *args: calls.append(args) or precompute(*args)
+    )
+    first = build_tiny_llama(tiny_tokenizer_path, max_seq_len=32, max_batch_size=2)
+    second = build_tiny_llama(tiny_tokenizer_path, max_seq_len=32, max_batch_size=2, seed=2)
+    assert first.model.freqs_cis is second.model.freqs_cis
+
+    # decode steps slice the shared table, nothing is recomputed or copied
+    tokens = torch.tensor([[1, 5, 7]])
+    first.model.forward(tokens, 0)
+    for pos in range(3, 8):
+        first.model.forward(tokens[:, :1], pos)
+        first.model.forward(tokens[:, :1], torch.tensor([pos]))
+    assert len(calls) == 1
+    assert first.model.freqs_cis is second.model.freqs_cis
+
+    longer = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=2)
+    assert longer.model.freqs_cis.shape[0] == 128
+    assert len(calls) == 2
+
+
+def test_rope_scaling():
+    base = precompute_freqs_cis(16, 64)
+    linear = precompute_freqs_cis(16, 64, scaling="linear", scaling_factor=2.0)
+    torch.testing.assert_close(linear[::2], base[:32])
+
+    ntk = precompute_freqs_cis(16, 64, scaling="ntk", scaling_factor=4.0)
+    angles, base_angles = torch.angle(ntk[1]), torch.angle(base[1])
+    # the highest frequency is kept, the lowest one is slowed down by the scaling factor
+    torch.testing.assert_close(angles[0], base_angles[0])
+    torch.testing.assert_close(angles[-1], base_angles[-1] / 4.0)
+
+    for scaling in ("linear", "ntk"):
+        torch.testing.assert_close(precompute_freqs_cis(16, 64, scaling=scaling), base)
+    with pytest.raises(ValueError):
+        precompute_freqs_cis(16, 64, scaling="yarn", scaling_factor=2.0)
+
+
+def perplexity(llama, tokens: torch.Tensor) -> float:
+    logits = llama.model.forward(tokens[:, :-1], 0)
+    nll = torch.nn.functional.cross_entropy(logits.transpose(1, 2), tokens[:, 1:])
+    return math.exp(nll.item())
+
+
+@pytest.mark.parametrize("rope_scaling", ["linear", "ntk"])
+def test_long_context_perplexity(tiny_tokenizer_path, rope_scaling):
+    # the "trained" context is 64 tokens, the scaled model serves 4 times as many
+    base = build_tiny_llama(tiny_tokenizer_path, max_seq_len=256, max_batch_size=1)
+    scaled = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=256,
+        max_batch_size=1,
+        rope_scaling=rope_scaling,
+        rope_scaling_factor=4.0,
+    )
+    scaled.model.load_state_dict(base.model.state_dict())
+    torch.manual_seed(0)
+    base.tokenizer.eos_id = -1
+    prompt = base.tokenizer.encode("the quick brown fox", bos=True, eos=False)
+    text, _ = base.generate([prompt], 256 - len(prompt), temperature=1.0, top_p=1.0)
+    tokens = torch.tensor([prompt + text[0]])
+
+    base_ppl = perplexity(base, tokens[:, :64])
+    long_ppl = perplexity(scaled, tokens)
+    assert math.isfinite(long_ppl)
+    # scaling stays within a small factor of what the model reaches inside its context
+    assert long_ppl < 4 * base_ppl
@@ -0,0 +1,112 @@
+import math
+
+import pytest
+import torch
+
+from chimera_llama_grpc.llama.generation import sample_top_p
+from chimera_llama_grpc.llama.sampling import (
+    PREFILTER_TOP_K,
+    _sort_rows,
+    multinomial,
+    sample,
+)
+
+VOCAB_SIZE = 1000
+NUM_SAMPLES = 10000
+
+
+def histogram(tokens: torch.Tensor) -> torch.Tensor:
+    return torch.bincount(tokens.reshape(-1), minlength=VOCAB_SIZE).float() / tokens.numel()
+
+
+def nucleus(logits: torch.Tensor, temperature: float, top_p: float) -> torch.Tensor:
+    """The exact distribution sample_top_p draws from."""
+    probs = torch.softmax(logits / temperature, dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, descending=True)
+    probs_sort[torch.cumsum(probs_sort, dim=-1) - probs_sort > top_p] = 0.0
+    return torch.zeros_like(probs).scatter(0, probs_idx, probs_sort / probs_sort.sum())
+
+
+@pytest.mark.parametrize(
+    "scale, temperature, top_p",
+    [
+        (4.0, 0.7, 0.9),  # peaked, the nucleus fits in the prefilter
+        (4.0, 1.0, 0.5),
+        (0.5, 1.0, 0.9),  # flat, falls back to a full sort
+        (2.0, 1.3, 1.0),
+    ],
+)
+def test_sample_matches_sample_top_p(scale, temperature, top_p):
+    torch.manual_seed(0)
+    logits = torch.randn(VOCAB_SIZE) * scale
+    batch = logits.expand(NUM_SAMPLES, VOCAB_SIZE)
+    expected = nucleus(logits, temperature, top_p)
+    # expected total variation distance of an empirical histogram, scaled up as a tolerance
+    noise = 0.5 * (2 / math.pi) ** 0.5 * (expected * (1 - expected) / NUM_SAMPLES).sqrt().sum()
+
+    current = histogram(sample_top_p(torch.softmax(batch / temperature, dim=-1), top_p))
+    optimized = histogram(
+        sample(batch, torch.full((NUM_SAMPLES,), temperature), torch.full((NUM_SAMPLES,), top_p))
+    )
+    for actual in (current, optimized):
+        assert actual[expected == 0].sum() == 0
+        assert (actual - expected).abs().sum() / 2 < 1.5 * noise + 0.005
+
+
+def test_sample_top_k_min_p_and_greedy():
+    torch.manual_seed(0)
+    logits = torch.randn(VOCAB_SIZE).expand(4, VOCAB_SIZE).contiguous()
+    ranking = logits[0].argsort(descending=True)
+    probs = torch.softmax(logits[0], dim=-1)
+    allowed_min_p = set((probs >= 0.5 * probs.max()).nonzero().reshape(-1).tolist())
+
+    for _ in range(50):
+        tokens = sample(
+            logits,
+            temperature=torch.tensor([1.0, 1.0, 0.0, 1.0]),
+            top_p=torch.tensor([1.0, 1.0, 1.0, 1.0]),
+            top_k=torch.tensor([5, 0, 0, PREFILTER_TOP_K + 10]),
+            min_p=torch.tensor([0.0, 0.5, 0.0, 0.0]),
+        )
+        assert tokens[0] in ranking[:5]
+        assert int(tokens[1]) in allowed_min_p
+        assert tokens[2] == ranking[0]
+        assert tokens[3] in ranking[: PREFILTER_TOP_K + 10]
+
+
+def test_sort_rows_picks_the_full_sort_per_row():
+    torch.manual_seed(0)
+    # a peaked row whose nucleus fits in the prefilter and a flat one that does not
+    logits = torch.randn(2, VOCAB_SIZE) * torch.tensor([[4.0], [0.3]])
+    values, indices = torch.topk(logits, PREFILTER_TOP_K, dim=-1)
+    probs = torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True))
+    truncated = probs.sum(dim=-1, keepdim=True) <= 0.9
+    assert truncated.reshape(-1).tolist() == [False, True]
+
+    rows_probs, rows_indices = _sort_rows(logits, probs, indices, truncated)
+    sorted_probs, sorted_indices = torch.sort(torch.softmax(logits, dim=-1), descending=True)
+    assert torch.equal(rows_probs[1], sorted_probs[1])
+    assert torch.equal(rows_indices[1], sorted_indices[1])
+    assert torch.equal(rows_probs[0, :PREFILTER_TOP_K], probs[0])
+    assert not rows_probs[0, PREFILTER_TOP_K:].any()
+    # the padding is never sampled, a seeded row draws the same token from either
+    for seed in range(20):
+        padded = multinomial(rows_probs[:1], [torch.Generator().manual_seed(seed)])
+        assert padded == multinomial(probs[:1], [torch.Generator().manual_seed(seed)])
+
+
+def test_sample_seeded_rows_are_reproducible():
+    torch.manual_seed(0)
+    logits = torch.randn(3, VOCAB_SIZE)
+    temperature, top_p = torch.ones(3), torch.full((3,), 0.95)
+
+    def run(rows, seeds):
+        generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+        return [
+            sample(logits[rows], temperature[rows], top_p[rows], generators).tolist()
+            for _ in range(10)
+        ]
+
+    batch = run([0, 1, 2], [7, 8, 9])
+    alone = run([1], [8])
+    assert [step[1] for step in batch] == [step[0] for step in alone]
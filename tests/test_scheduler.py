@@ -0,0 +1,145 @@
+import pytest
+from helpers import PROMPTS, greedy_without_cache
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+
+def test_continuous_batching_matches_single_sequence(tiny_llama: Llama):
+    scheduler = Scheduler(tiny_llama)
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS]
+    # more prompts than cache rows, late sequences are admitted while others are decoding
+    assert len(PROMPTS) > tiny_llama.model.params.max_batch_size
+    sequences = [
+        scheduler.submit(t, temperature=0, max_gen_len=5 + i) for i, t in enumerate(prompt_tokens)
+    ]
+    while scheduler.has_unfinished():
+        scheduler.step()
+
+    for i, (t, sequence) in enumerate(zip(prompt_tokens, sequences)):
+        assert sequence.finished
+        assert sequence.future.result() == greedy_without_cache(tiny_llama, t, 5 + i)
+    assert len(scheduler.free_slots) == tiny_llama.model.params.max_batch_size
+
+
+def test_scheduler_background_loop(tiny_llama: Llama):
+    scheduler = Scheduler(tiny_llama)
+    scheduler.start()
+    try:
+        sequences = [
+            scheduler.submit(tiny_llama.tokenizer.encode(p, bos=True, eos=False), max_gen_len=8)
+            for p in PROMPTS
+        ]
+        for sequence in sequences:
+            assert len(sequence.future.result(timeout=60)) <= 8
+    finally:
+        scheduler.stop()
+
+
+def test_cancelled_sequence_retires_without_failing_others(tiny_llama: Llama):
+    scheduler = Scheduler(tiny_llama)
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:5]]
+    # one more sequence than cache rows, the last one waits
+    sequences = [scheduler.submit(t, temperature=0, max_gen_len=12) for t in prompt_tokens]
+    cancelled, queued = sequences[0], sequences[-1]
+    scheduler.step()
+    scheduler.step()
+    assert cancelled in scheduler.running and queued in scheduler.waiting
+    # what asyncio.wrap_future does when the awaiting RPC is cancelled or hits its deadline
+    assert cancelled.future.cancel()
+    scheduler.cancel(queued)
+    scheduler.step()
+    assert cancelled.finished and cancelled not in scheduler.running
+    assert queued.finished and queued not in scheduler.waiting
+    generated = len(cancelled.output_tokens)
+    while scheduler.has_unfinished():
+        scheduler.step()
+
+    assert cancelled.future.cancelled() and queued.future.cancelled()
+    assert len(cancelled.output_tokens) == generated
+    for tokens, sequence in zip(prompt_tokens[1:-1], sequences[1:-1]):
+        assert sequence.future.result() == greedy_without_cache(tiny_llama, tokens, 12)
+    assert len(scheduler.free_slots) == tiny_llama.model.params.max_batch_size
+
+
+def test_scheduler_rejects_too_long_prompt(tiny_llama: Llama):
+    scheduler = Scheduler(tiny_llama)
+    with pytest.raises(ValueError):
+        scheduler.submit([1] * tiny_llama.model.params.max_seq_len)
+
+
+def test_scheduler_seeded_sampling(tiny_llama: Llama):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS]
+
+    def run(prompts):
+        scheduler = Scheduler(tiny_llama)
+        sequences = [
+            scheduler.submit(t, temperature=1.0, top_p=0.95, top_k=50, max_gen_len=8, seed=i)
+            for i, t in enumerate(prompts)
+        ]
+        while scheduler.has_unfinished():
+            scheduler.step()
+        return [s.future.result() for s in sequences]
+
+    batched = run(prompt_tokens[:4])
+    assert run(prompt_tokens[:1]) == batched[:1]
+    assert run(prompt_tokens[:4]) == batched
+
+
+def test_chunked_prefill_interleaves_decode_steps(tiny_llama: Llama, monkeypatch):
+    # the short sequence has to keep running
+    monkeypatch.setattr(tiny_llama.tokenizer, "eos_id", -1)
+    scheduler = Scheduler(tiny_llama, prefill_chunk_size=4)
+    short_tokens = tiny_llama.tokenizer.encode(PROMPTS[3], bos=True, eos=False)
+    long_tokens = tiny_llama.tokenizer.encode(" ".join(PROMPTS[:3]), bos=True, eos=False)
+    assert len(long_tokens) > 3 * 4
+
+    short = scheduler.submit(short_tokens, temperature=0, max_gen_len=24)
+    while not short.output_tokens:
+        scheduler.step()
+    long = scheduler.submit(long_tokens, temperature=0, max_gen_len=4)
+    # the long prompt takes a step per chunk and the short sequence decodes in every one of them
+    steps = 0
+    while not long.output_tokens:
+        generated = len(short.output_tokens)
+        scheduler.step()
+        steps += 1
+        assert len(short.output_tokens) == generated + 1
+        assert long.prefilled == min(len(long_tokens), 4 * steps)
+    assert steps == -(-len(long_tokens) // 4)
+
+    while scheduler.has_unfinished():
+        scheduler.step()
+    assert short.future.result() == greedy_without_cache(tiny_llama, short_tokens, 24)
+    assert long.future.result() == greedy_without_cache(tiny_llama, long_tokens, 4)
+
+
+def test_chunked_prefill_is_preempted_before_the_last_running_sequence(
+    tiny_tokenizer_path, tiny_llama: Llama, monkeypatch
+):
+    llama = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=32,
+        max_batch_size=2,
+        kv_block_size=4,
+        kv_num_blocks=6,
+        prefill_chunk_size=4,
+    )
+    for tokenizer in (llama.tokenizer, tiny_llama.tokenizer):
+        monkeypatch.setattr(tokenizer, "eos_id", -1)
+    scheduler = Scheduler(llama)
+    short_tokens = [1, 10, 11]
+    long_tokens = [1] + list(range(20, 39))
+    short = scheduler.submit(short_tokens, temperature=0, max_gen_len=12)
+    while not short.output_tokens:
+        scheduler.step()
+    # the long prompt takes the remaining blocks while it is prefilled a chunk at a time, the short
+    # sequence runs out of blocks before the prefill is done
+    long = scheduler.submit(long_tokens, temperature=0, max_gen_len=4)
+    while scheduler.has_unfinished():
+        scheduler.step()
+
+    assert short.future.result() == greedy_without_cache(tiny_llama, short_tokens, 12)
+    assert long.future.result() == greedy_without_cache(tiny_llama, long_tokens, 4)
+    assert llama.model.block_manager.num_free_blocks == 6
@@ -0,0 +1,58 @@
+import pytest
+from helpers import PROMPTS
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.tiny import build_tiny_llama
+
+MAX_GEN_LEN = [6, 12, 9, 16]
+
+
+@pytest.mark.parametrize("kv_block_size", [0, 8])
+def test_speculative_greedy_matches_target(tiny_tokenizer_path, tiny_llama: Llama, kv_block_size):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    expected, _ = tiny_llama.generate(prompt_tokens, MAX_GEN_LEN, temperature=0)
+
+    draft = build_tiny_llama(
+        tiny_tokenizer_path,
+        max_seq_len=64,
+        max_batch_size=4,
+        seed=2,
+        n_layers=1,
+        kv_block_size=kv_block_size,
+    )
+    speculative = Llama(
+        tiny_llama.model, tiny_llama.tokenizer, draft=draft, num_speculative_tokens=3
+    )
+    out_tokens, _ = speculative.generate(prompt_tokens, MAX_GEN_LEN, temperature=0)
+    assert out_tokens == expected
+
+    stats = speculative.speculative_stats
+    assert stats.generated == sum(len(t) for t in expected)
+    assert 0 <= stats.acceptance_rate <= 1
+    assert stats.tokens_per_s > 0
+
+
+def test_speculative_with_identical_draft_accepts_everything(tiny_tokenizer_path, tiny_llama):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    expected, _ = tiny_llama.generate(prompt_tokens, MAX_GEN_LEN, temperature=0)
+
+    draft = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, seed=1)
+    speculative = Llama(
+        tiny_llama.model, tiny_llama.tokenizer, draft=draft, num_speculative_tokens=4
+    )
+    out_tokens, _ = speculative.generate(prompt_tokens, MAX_GEN_LEN, temperature=0)
+    assert out_tokens == expected
+    assert speculative.speculative_stats.acceptance_rate == 1.0
+    assert speculative.speculative_stats.tokens_per_round > 1
+
+
+def test_speculative_sampling(tiny_tokenizer_path, tiny_llama: Llama):
+    prompt_tokens = [tiny_llama.tokenizer.encode(p, bos=True, eos=False) for p in PROMPTS[:4]]
+    draft = build_tiny_llama(tiny_tokenizer_path, max_seq_len=64, max_batch_size=4, seed=2)
+    speculative = Llama(tiny_llama.model, tiny_llama.tokenizer, draft=draft)
+    out_tokens, _ = speculative.generate(
+        prompt_tokens, MAX_GEN_LEN, temperature=[0.8, 1.0, 0.6, 0], top_p=0.9
+    )
+    for tokens, max_gen_len in zip(out_tokens, MAX_GEN_LEN):
+        assert len(tokens) <= max_gen_len
+        assert tiny_llama.tokenizer.eos_id not in tokens
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import random
+
+import grpc
+import pytest
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+from helpers import PROMPTS
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.scheduler import Scheduler
+from chimera_llama_grpc.llama.stopping import (
+    StopCriteria,
+    StopStringFilter,
+    truncate_at_stop,
+)
+from chimera_llama_grpc.llama.tokenizer import IncrementalDetokenizer
+from chimera_llama_grpc.service import (
+    LlamaServicer,
+    LLMStreamStub,
+    add_streaming_handlers_to_server,
+)
+
+MAX_GEN_LEN = 24
+
+
+def reference(llama: Llama, prompt: str):
+    prompt_tokens = llama.tokenizer.encode(prompt, bos=True, eos=False)
+    (tokens,), _ = llama.generate([prompt_tokens], MAX_GEN_LEN, temperature=0)
+    return prompt_tokens, tokens, llama.tokenizer.decode(tokens)
+
+
+def stop_in_middle(llama: Llama, tokens):
+    """A stop string from the middle of the text and the tokens up to the one completing it."""
+    text = llama.tokenizer.decode(tokens)
+    stop = text[len(text) // 2 : len(text) // 2 + 3]
+    # decode() shows an incomplete UTF-8 tail as U+FFFD, only text that no later token changes counts
+    detokenizer = IncrementalDetokenizer(llama.tokenizer)
+    streamed = ""
+    for end, token in enumerate(tokens, 1):
+        streamed += detokenizer.push_row(0, token)
+        if stop in streamed:
+            break
+    assert end < len(tokens)
+    return stop, tokens[:end]
+
+
+def test_truncate_at_stop():
+    assert truncate_at_stop("hello world", "o w") == "hell"
+    assert truncate_at_stop("hello world", ["xyz", "l"]) == "he"
+    assert truncate_at_stop("hello world", None) == "hello world"
+    # the stop string completed first wins
+    assert truncate_at_stop("abcd", ["bc", "abcd"]) == "a"
+    # an echoed prompt is not searched
+    assert truncate_at_stop("hello world", "l", start=5) == "hello wor"
+
+
+def test_stop_string_filter_matches_truncate_at_stop():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice("ab\n") for _ in range(rng.randrange(20)))
+        stop = ["".join(rng.choice("ab\n") for _ in range(rng.randrange(1, 4))) for _ in range(2)]
+        stop_filter = StopStringFilter(stop)
+        chunks, i = [], 0
+        while i < len(text):
+            n = rng.randrange(1, 4)
+            chunks.append(stop_filter.push(text[i : i + n]))
+            i += n
+        chunks.append(stop_filter.flush())
+        assert "".join(chunks) == truncate_at_stop(text, stop), (text, stop, chunks)
+
+
+@pytest.mark.parametrize("use_scheduler", [False, True])
+def test_stop_string_truncates_exactly(tiny_llama: Llama, use_scheduler: bool):
+    prompts, expected, stops = [], [], []
+    for prompt in PROMPTS[:4]:
+        prompt_tokens, tokens, text = reference(tiny_llama, prompt)
+        stop, stopped_tokens = stop_in_middle(tiny_llama, tokens)
+        prompts.append(prompt_tokens)
+        stops.append(stop)
+        expected.append((stopped_tokens, truncate_at_stop(text, stop)))
+    # a row without stop strings is not affected by the others
+    stops[-1] = None
+    expected[-1] = (reference(tiny_llama, PROMPTS[3])[1], reference(tiny_llama, PROMPTS[3])[2])
+
+    if use_scheduler:
+        scheduler = Scheduler(tiny_llama)
+        sequences = [
+            scheduler.submit(p, temperature=0, max_gen_len=MAX_GEN_LEN, stop=s)
+            for p, s in zip(prompts, stops)
+        ]
+        while scheduler.has_unfinished():
+            scheduler.step()
+        out_tokens = [s.future.result() for s in sequences]
+    else:
+        out_tokens, _ = tiny_llama.generate(prompts, MAX_GEN_LEN, temperature=0, stop=stops)
+
+    for tokens, stop, (expected_tokens, expected_text) in zip(out_tokens, stops, expected):
+        assert tokens == expected_tokens
+        assert truncate_at_stop(tiny_llama.tokenizer.decode(tokens), stop) == expected_text
+        if stop is not None:
+            assert stop not in expected_text
+            assert len(tokens) < MAX_GEN_LEN
+
+
+@pytest.mark.parametrize("use_scheduler", [False, True])
+def test_stop_token_ids(tiny_llama: Llama, use_scheduler: bool):
+    prompt_tokens, tokens, _ = reference(tiny_llama, PROMPTS[1])
+    stop_token = tokens[MAX_GEN_LEN // 2]
+    expected = tokens[: tokens.index(stop_token)]
+
+    if use_scheduler:
+        scheduler = Scheduler(tiny_llama)
+        sequence = scheduler.submit(
+            prompt_tokens, temperature=0, max_gen_len=MAX_GEN_LEN, stop_token_ids=[stop_token]
+        )
+        while scheduler.has_unfinished():
+            scheduler.step()
+        out = sequence.future.result()
+    else:
+        (out,), _ = tiny_llama.generate(
+            [prompt_tokens], MAX_GEN_LEN, temperature=0, stop_token_ids=[[stop_token]]
+        )
+    assert out == expected
+
+
+def test_stop_strings_only_see_emitted_tokens(tiny_llama: Llama, monkeypatch):
+    prompt_tokens, tokens, _ = reference(tiny_llama, PROMPTS[1])
+    stop_token = tokens[MAX_GEN_LEN // 2]
+    expected = tokens[: tokens.index(stop_token)]
+    pushed = []
+    push = StopCriteria.push
+
+    def spy(self, token):
+        pushed.append(token)
+        return push(self, token)
+
+    monkeypatch.setattr(StopCriteria, "push", spy)
+    # a stop string that never matches keeps the row feeding its tokens to the stop criteria
+    (out,), _ = tiny_llama.generate(
+        [prompt_tokens],
+        MAX_GEN_LEN,
+        temperature=0,
+        stop=["\x00never"],
+        stop_token_ids=[[stop_token]],
+    )
+    assert out == expected
+    assert stop_token not in pushed
+    assert pushed == expected
+
+
+def test_stop_args_over_rpc(tiny_servicer: LlamaServicer, tiny_llama: Llama):
+    _, tokens, text = reference(tiny_llama, PROMPTS[0])
+    stop, _ = stop_in_middle(tiny_llama, tokens)
+    inference_args = chimera_llm_pb2.InferenceArgs(
+        max_gen_len=MAX_GEN_LEN, json_extra_args=json.dumps({"temperature": 0, "stop": stop})
+    )
+    request = chimera_llm_pb2.CompletionRequest(prompt=PROMPTS[0], inference_args=inference_args)
+
+    async def run():
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(tiny_servicer, server)
+        add_streaming_handlers_to_server(tiny_servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                prediction = await chimera_llm_pb2_grpc.LLMStub(channel).Completion(request)
+                chunks = [r async for r in LLMStreamStub(channel).CompletionStream(request)]
+        finally:
+            await server.stop(None)
+        return prediction.generation, "".join(r.generation for r in chunks)
+
+    generation, streamed = asyncio.run(run())
+    assert generation == streamed == truncate_at_stop(text, stop)
@@ -0,0 +1,107 @@
+import asyncio
+import random
+import time
+
+import grpc
+from chimera_llm_proto import chimera_llm_pb2, chimera_llm_pb2_grpc
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.tokenizer import StreamDecoder
+from chimera_llama_grpc.service import (
+    LlamaServicer,
+    LLMStreamStub,
+    add_streaming_handlers_to_server,
+)
+
+
+def test_stream_decoder_never_splits_characters(tiny_llama: Llama):
+    tokenizer = tiny_llama.tokenizer
+    text = "hello 你好, wörld 🦙 llama"
+    tokens = tokenizer.encode(text, bos=False, eos=False)
+    # byte fallback spreads every CJK character and the emoji over several tokens
+    assert len(tokens) > len(text.split())
+
+    decoder = StreamDecoder(tokenizer)
+    deltas = [decoder.push(t) for t in tokens] + [decoder.flush()]
+    assert all("�" not in d for d in deltas)
+    assert "".join(deltas) == tokenizer.decode(tokens) == text
+
+
+def test_stream_decoder_random_tokens(tiny_llama: Llama):
+    tokenizer = tiny_llama.tokenizer
+    rng = random.Random(0)
+    for _ in range(20):
+        tokens = [rng.randrange(3, tokenizer.n_words) for _ in range(30)]
+        decoder = StreamDecoder(tokenizer)
+        deltas = [decoder.push(t) for t in tokens] + [decoder.flush()]
+        assert "".join(deltas) == tokenizer.decode(tokens)
+
+
+def test_streaming_rpc(tiny_servicer: LlamaServicer):
+    inference_args = chimera_llm_pb2.InferenceArgs(
+        max_gen_len=16, json_extra_args='{"temperature": 0}'
+    )
+
+    async def run():
+        server = grpc.aio.server()
+        chimera_llm_pb2_grpc.add_LLMServicer_to_server(tiny_servicer, server)
+        add_streaming_handlers_to_server(tiny_servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                stub = chimera_llm_pb2_grpc.LLMStub(channel)
+                stream_stub = LLMStreamStub(channel)
+
+                request = chimera_llm_pb2.CompletionRequest(
+                    prompt="hello world", inference_args=inference_args
+                )
+                chunks = [r async for r in stream_stub.CompletionStream(request)]
+                prediction = await stub.Completion(request)
+                assert len(chunks) > 1
+                assert len({r.response_id for r in chunks}) == 1
+                assert "".join(r.generation for r in chunks) == prediction.generation
+
+                request = chimera_llm_pb2.ChatRequest(
+                    messages=[chimera_llm_pb2.ChatMessage(role=chimera_llm_pb2.USER, content="hi")],
+                    inference_args=inference_args,
+                )
+                chunks = [r async for r in stream_stub.ChatStream(request)]
+                prediction = await stub.Chat(request)
+                assert "".join(r.message.content for r in chunks) == prediction.message.content
+        finally:
+            await server.stop(None)
+
+    asyncio.run(run())
+
+
+def test_abandoned_stream_cancels_its_sequence(tiny_servicer: LlamaServicer):
+    host = tiny_servicer.model_manager.model_host
+    scheduler = host.scheduler
+    sequences = []
+    submit = scheduler.submit
+
+    def spy(*args, **kwargs):
+        sequences.append(submit(*args, **kwargs))
+        return sequences[-1]
+
+    scheduler.submit = spy
+    prompt_tokens = host.model.tokenizer.encode("hello world", bos=True, eos=False)
+
+    async def run():
+        stream = tiny_servicer.generate_stream(host, prompt_tokens, temperature=0, max_gen_len=48)
+        await stream.__anext__()
+        # the consumer goes away after the first chunk, e.g. the client cancelled the RPC
+        await stream.aclose()
+
+    try:
+        asyncio.run(run())
+    finally:
+        del scheduler.submit
+    (sequence,) = sequences
+    assert sequence.future.cancelled()
+    deadline = time.monotonic() + 30
+    while scheduler.has_unfinished() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sequence.finished and len(sequence.output_tokens) < 48
+    assert len(scheduler.free_slots) == host.model.model.params.max_batch_size
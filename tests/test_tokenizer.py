@@ -0,0 +1,120 @@
+import random
+
+import torch
+
+from chimera_llama_grpc.llama import Llama
+from chimera_llama_grpc.llama.generation import B_INST, E_INST
+from chimera_llama_grpc.llama.tokenizer import (
+    IncrementalDetokenizer,
+    Tokenizer,
+    decode_bytes,
+)
+
+WORDS = "the quick brown fox jumps over lazy dog 你好 🦙 llama".split()
+
+
+def random_text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 12)))
+
+
+def test_encode_batch_and_cache(tiny_tokenizer_path):
+    tokenizer = Tokenizer(str(tiny_tokenizer_path), cache_size=2)
+    sp_model = tokenizer.sp_model
+    texts = ["hello world", "the fox", "hello world", ""]
+    encoded = tokenizer.encode_batch(texts, bos=True, eos=True)
+    assert encoded == [[1] + sp_model.encode(t) + [2] for t in texts]
+    assert tokenizer.encode("the fox", bos=False, eos=False) == sp_model.encode("the fox")
+    assert tokenizer.cache_hits == 1
+
+    # callers own the returned lists
+    encoded[1].append(7)
+    assert tokenizer.encode("the fox", bos=False, eos=False) == sp_model.encode("the fox")
+    assert tokenizer.cache_hits == 2
+
+    # least recently used strings are evicted first
+    tokenizer.encode("lazy dog", bos=False, eos=False)
+    assert list(tokenizer._cache) == ["the fox", "lazy dog"]
+
+    uncached = Tokenizer(str(tiny_tokenizer_path), cache_size=0)
+    assert uncached.encode_batch(texts, bos=False, eos=False) == [sp_model.encode(t) for t in texts]
+    assert not uncached._cache
+
+
+def test_decode_batch_and_token_texts(tiny_tokenizer_path):
+    tokenizer = Tokenizer(str(tiny_tokenizer_path))
+    rng = random.Random(0)
+    token_lists = [[rng.randrange(tokenizer.n_words) for _ in range(n)] for n in (0, 1, 17, 40)]
+    assert tokenizer.decode_batch(token_lists) == [tokenizer.decode(t) for t in token_lists]
+    assert tokenizer.decode_batch([]) == []
+
+    ids = list(range(tokenizer.n_words))
+    assert tokenizer.token_texts(ids) == [tokenizer.sp_model.decode(i) for i in ids]
+
+
+def test_encode_dialog_matches_per_turn_encoding(tiny_llama: Llama):
+    tokenizer = tiny_llama.tokenizer
+    rng = random.Random(0)
+    for turns in (1, 2, 5, 30):
+        dialog = [{"role": "system", "content": random_text(rng)}] if turns % 2 else []
+        for i in range(turns):
+            dialog.append({"role": "user", "content": random_text(rng)})
+            if i < turns - 1:
+                dialog.append({"role": "assistant", "content": random_text(rng)})
+
+        expected, rest = [], dialog
+        if dialog[0]["role"] == "system":
+            content = f"<<SYS>>\n{dialog[0]['content']}\n<</SYS>>\n\n{dialog[1]['content']}"
+            rest = [{"role": "user", "content": content}] + dialog[2:]
+        for prompt, answer in zip(rest[::2], rest[1::2]):
+            text = f"{B_INST} {prompt['content'].strip()} {E_INST} {answer['content'].strip()} "
+            expected += [1] + tokenizer.sp_model.encode(text) + [2]
+        expected += [1] + tokenizer.sp_model.encode(f"{B_INST} {rest[-1]['content']} {E_INST}")
+        assert tiny_llama.encode_dialog(dialog) == expected
+
+
+def random_stream(rng: random.Random, tokenizer: Tokenizer, n: int):
+    # plenty of leading-space markers, byte-fallback pieces of multi-byte characters and controls
+    tricky = [tokenizer.encode(c, bos=False, eos=False) for c in ("你", "🦙", " ", "é")]
+    tokens = []
+    while len(tokens) < n:
+        kind = rng.random()
+        if kind < 0.2:
+            tokens += rng.choice(tricky)[: rng.randrange(1, 5)]
+        elif kind < 0.3:
+            tokens.append(rng.choice([tokenizer.bos_id, tokenizer.eos_id, 0]))
+        else:
+            tokens.append(rng.randrange(3, tokenizer.n_words))
+    return tokens[:n]
+
+
+def test_decode_bytes_matches_sentencepiece(tiny_tokenizer_path):
+    tokenizer = Tokenizer(str(tiny_tokenizer_path))
+    rng = random.Random(0)
+    alphabet = [0x20, 0x61, 0x80, 0x90, 0x9F, 0xA0, 0xBD, 0xC3, 0xE0, 0xE4, 0xED, 0xF0, 0xF4, 0xFF]
+    for _ in range(2000):
+        data = bytes(rng.choice(alphabet) for _ in range(rng.randrange(1, 8)))
+        byte_tokens = [tokenizer.sp_model.piece_to_id(f"<0x{b:02X}>") for b in data]
+        assert decode_bytes(data, final=True) == (tokenizer.decode(byte_tokens), len(data))
+    # an incomplete character waits for its remaining bytes
+    assert decode_bytes("a你".encode()[:3], final=False) == ("a", 1)
+
+
+def test_incremental_detokenizer(tiny_tokenizer_path):
+    tokenizer = Tokenizer(str(tiny_tokenizer_path))
+    rng = random.Random(0)
+    for _ in range(20):
+        rows = [random_stream(rng, tokenizer, rng.randrange(0, 60)) for _ in range(8)]
+        detokenizer = IncrementalDetokenizer(tokenizer, batch_size=len(rows))
+        texts = [""] * len(rows)
+        for step in range(max(len(r) for r in rows)):
+            # finished rows push nothing
+            tokens = [r[step] if step < len(r) else None for r in rows]
+            texts = [t + delta for t, delta in zip(texts, detokenizer.push(tokens))]
+        texts = [t + delta for t, delta in zip(texts, detokenizer.flush())]
+        assert texts == tokenizer.decode_batch(rows)
+
+    tokens = tokenizer.encode("hello 你好 🦙", bos=True, eos=False)
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.push(torch.tensor([t]))[0] for t in tokens]
+    assert "�" not in "".join(deltas)
+    assert "".join(deltas) + detokenizer.flush()[0] == "hello 你好 🦙"